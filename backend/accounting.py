@@ -0,0 +1,166 @@
+import os, time, asyncio, logging, contextvars
+import store
+
+# Per-call Claude usage in the llm_usage table: input, output and prompt cache
+# tokens, model, latency, endpoint, and the shop (and product, when there is
+# one) the call was made for. record() only appends to an in-memory buffer; a
+# background task writes it in one executemany every USAGE_FLUSH_SECONDS, or as
+# soon as USAGE_BATCH_SIZE rows are waiting, so the request path never waits on
+# SQLite. Costs are worked out from token counts at query time, so changing
+# the LLM_PRICE_* settings reprices history.
+
+USAGE_FLUSH_SECONDS = float(os.getenv("USAGE_FLUSH_SECONDS", "1"))
+USAGE_BATCH_SIZE = int(os.getenv("USAGE_BATCH_SIZE", "200"))
+# Rows held while the database is unavailable; beyond this new rows are dropped
+USAGE_MAX_PENDING = int(os.getenv("USAGE_MAX_PENDING", "50000"))
+
+USAGE_FIELDS = ("input_tokens", "output_tokens", "cache_creation_input_tokens", "cache_read_input_tokens")
+
+# USD per million tokens
+PRICES = {
+    "input_tokens": float(os.getenv("LLM_PRICE_INPUT", "3")),
+    "output_tokens": float(os.getenv("LLM_PRICE_OUTPUT", "15")),
+    "cache_creation_input_tokens": float(os.getenv("LLM_PRICE_CACHE_WRITE", "3.75")),
+    "cache_read_input_tokens": float(os.getenv("LLM_PRICE_CACHE_READ", "0.30")),
+}
+# Message Batches are billed at half price
+ENDPOINT_PRICE_FACTOR = {"batch": 0.5}
+
+_attribution = contextvars.ContextVar("llm_attribution", default=(None, None))
+
+_pending = []
+_wakeup = None
+_flusher = None
+_stats = {"recorded": 0, "written": 0, "dropped": 0, "flushes": 0, "flush_errors": 0}
+
+log = logging.getLogger(__name__)
+
+def attribute(shop: str, product_id=None):
+    """Charge Claude calls made from here on in this task, and tasks it starts, to shop and product"""
+    _attribution.set((shop, str(product_id) if product_id is not None else None))
+
+def record(endpoint: str, model: str, usage: dict, seconds: float = None, shop: str = None, product_id=None):
+    """Queue one call's usage. shop and product_id default to the current attribution."""
+    if shop is None:
+        shop, product_id = _attribution.get()
+    _stats["recorded"] += 1
+    if len(_pending) >= USAGE_MAX_PENDING:
+        _stats["dropped"] += 1
+        return
+    usage = usage or {}
+    _pending.append((shop, str(product_id) if product_id is not None else None, endpoint, model,
+                     *(int(usage.get(field) or 0) for field in USAGE_FIELDS),
+                     round(seconds * 1000) if seconds is not None else None, int(time.time())))
+    if len(_pending) >= USAGE_BATCH_SIZE and _wakeup is not None:
+        _wakeup.set()
+
+async def flush():
+    """Write every queued row now"""
+    global _pending
+    if not _pending:
+        return
+    rows, _pending = _pending, []
+    try:
+        await store.executemany(
+            """INSERT INTO llm_usage(shop, product_id, endpoint, model, input_tokens, output_tokens,
+                 cache_creation_input_tokens, cache_read_input_tokens, latency_ms, created_at)
+               VALUES(?,?,?,?,?,?,?,?,?,?)""", rows)
+    except Exception as e:
+        log.warning("Usage flush of %d rows failed: %s", len(rows), e)
+        _stats["flush_errors"] += 1
+        # Keep them for the next flush, ahead of anything recorded since
+        _pending = (rows + _pending)[-USAGE_MAX_PENDING:]
+        return
+    _stats["flushes"] += 1
+    _stats["written"] += len(rows)
+
+async def _flush_forever():
+    while True:
+        waiter = asyncio.ensure_future(_wakeup.wait())
+        try:
+            await asyncio.wait([waiter], timeout=USAGE_FLUSH_SECONDS)
+        finally:
+            waiter.cancel()
+        _wakeup.clear()
+        await flush()
+
+def start_flusher():
+    global _flusher, _wakeup
+    if _flusher is None:
+        _wakeup = asyncio.Event()
+        _flusher = asyncio.create_task(_flush_forever())
+
+async def stop_flusher():
+    global _flusher, _wakeup
+    if _flusher is not None:
+        _flusher.cancel()
+        try:
+            await _flusher
+        except asyncio.CancelledError:
+            pass
+        _flusher, _wakeup = None, None
+    # Whatever was recorded during shutdown still gets written
+    await flush()
+
+def cost_usd(endpoint: str, tokens: dict) -> float:
+    factor = ENDPOINT_PRICE_FACTOR.get(endpoint, 1)
+    return sum(tokens[field] * PRICES[field] for field in USAGE_FIELDS) * factor / 1_000_000
+
+async def product_tokens(shop: str, product_ids: list) -> dict:
+    """{product_id: tokens} spent generating for each product since its last recorded run"""
+    if not product_ids:
+        return {}
+    await flush()
+    ids = [str(p) for p in product_ids]
+    rows = await store.fetchall(
+        f"""SELECT product_id, SUM({" + ".join(USAGE_FIELDS)}) AS tokens FROM llm_usage u
+            WHERE shop = ? AND product_id IN ({",".join("?" * len(ids))})
+              AND created_at > COALESCE((SELECT MAX(created_at) FROM runs r
+                                         WHERE r.shop = u.shop AND r.product_id = u.product_id), 0)
+            GROUP BY product_id""", (shop, *ids))
+    return {r["product_id"]: r["tokens"] for r in rows}
+
+def _totals():
+    return {"calls": 0, **{field: 0 for field in USAGE_FIELDS}, "cost_usd": 0.0, "latency_ms": 0, "timed": 0}
+
+def _add(totals: dict, row: dict):
+    totals["calls"] += row["calls"]
+    for field in USAGE_FIELDS:
+        totals[field] += row[field]
+    totals["cost_usd"] += cost_usd(row["endpoint"], row)
+    totals["latency_ms"] += row["latency_ms"] or 0
+    totals["timed"] += row["timed"]
+
+def _finish(totals: dict, **key):
+    # Batch results have no per-call latency
+    latency, timed = totals.pop("latency_ms"), totals.pop("timed")
+    return {**key, **totals, "cost_usd": round(totals["cost_usd"], 4),
+            "avg_latency_ms": round(latency / timed) if timed else None}
+
+async def summary(shop: str = None, days: int = 30):
+    """Usage and estimated cost over the last days, per shop (costliest first), per day and per endpoint"""
+    await flush()
+    where, params = "created_at >= ?", [int(time.time()) - days * 86400]
+    if shop:
+        where, params = where + " AND shop = ?", params + [shop]
+    rows = await store.fetchall(
+        f"""SELECT shop, date(created_at, 'unixepoch') AS day, endpoint, COUNT(*) AS calls,
+              {", ".join(f"SUM({field}) AS {field}" for field in USAGE_FIELDS)}, SUM(latency_ms) AS latency_ms,
+              COUNT(latency_ms) AS timed
+            FROM llm_usage WHERE {where} GROUP BY shop, day, endpoint""", params)
+    total, shops, by_day, endpoints = _totals(), {}, {}, {}
+    for row in rows:
+        for totals in (total, shops.setdefault(row["shop"], _totals()), by_day.setdefault(row["day"], _totals()),
+                       endpoints.setdefault(row["endpoint"], _totals())):
+            _add(totals, row)
+    return {
+        "days": days,
+        "prices_per_million": PRICES,
+        "total": _finish(total),
+        "per_shop": sorted((_finish(t, shop=s) for s, t in shops.items()), key=lambda s: -s["cost_usd"]),
+        "per_day": [_finish(by_day[d], day=d) for d in sorted(by_day)],
+        "per_endpoint": {e: _finish(t) for e, t in endpoints.items()},
+    }
+
+def stats():
+    return {**_stats, "pending": len(_pending)}
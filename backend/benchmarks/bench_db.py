@@ -0,0 +1,85 @@
+"""Micro-benchmark: per-request sqlite3 connect vs the pooled WAL store.
+
+Drives a shop lookup endpoint in-process at a fixed concurrency and prints
+requests/second for the old db() pattern (new connection + CREATE TABLE on
+every request, run synchronously inside an async handler) and for the
+store-backed /api/shops/me in main.py.
+
+    python benchmarks/bench_db.py --requests 2000 --concurrency 50
+"""
+import os, sys, time, json, sqlite3, asyncio, argparse, tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+from fastapi import FastAPI
+
+def legacy_app(path):
+    app = FastAPI()
+
+    def db():
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        conn.execute("""CREATE TABLE IF NOT EXISTS shops(
+          id INTEGER PRIMARY KEY, shop TEXT UNIQUE, access_token TEXT
+        )""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS runs(
+          id INTEGER PRIMARY KEY, shop TEXT, product_id TEXT, cost_tokens INTEGER, created_at INTEGER
+        )""")
+        return conn
+
+    @app.get("/api/shops/me")
+    async def me(shop: str):
+        c = db()
+        row = c.execute("SELECT * FROM shops WHERE shop = ?", (shop,)).fetchone()
+        return {"connected": bool(row)}
+
+    return app
+
+async def drive(app, requests, concurrency):
+    transport = httpx.ASGITransport(app=app)
+    sem = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def one(i):
+            async with sem:
+                r = await client.get("/api/shops/me", params={"shop": f"shop{i % 100}.myshopify.com"})
+                assert r.status_code == 200
+        start = time.perf_counter()
+        await asyncio.gather(*(one(i) for i in range(requests)))
+        return requests / (time.perf_counter() - start)
+
+async def main(args):
+    tmp = tempfile.mkdtemp()
+    legacy_path = os.path.join(tmp, "legacy.db")
+    store_path = os.path.join(tmp, "store.db")
+
+    conn = sqlite3.connect(legacy_path)
+    conn.execute("CREATE TABLE shops(id INTEGER PRIMARY KEY, shop TEXT UNIQUE, access_token TEXT)")
+    conn.executemany("INSERT INTO shops(shop, access_token) VALUES(?,?)",
+                     [(f"shop{i}.myshopify.com", "tok") for i in range(100)])
+    conn.commit()
+    conn.close()
+
+    os.environ["DB_PATH"] = store_path
+    import store
+    store.init_db()
+    await store.executemany("INSERT INTO shops(shop, access_token) VALUES(?,?)",
+                            [(f"shop{i}.myshopify.com", "tok") for i in range(100)])
+    import main as app_main
+
+    before = await drive(legacy_app(legacy_path), args.requests, args.concurrency)
+    after = await drive(app_main.app, args.requests, args.concurrency)
+    store.close_db()
+    print(json.dumps({
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "before_rps": round(before, 1),
+        "after_rps": round(after, 1),
+        "speedup": round(after / before, 2),
+    }, indent=2))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,299 @@
+"""Throughput and latency of the backend's endpoints against in-process fakes.
+
+Runs main.app with its Shopify and Anthropic clients pointed at fakes/shopify.py
+and fakes/anthropic.py over ASGI transports, so nothing leaves the process and
+no Claude tokens are spent. Each scenario sends --requests requests at
+--concurrency and reports req/s, p50/p95/p99 latency, status counts and the
+upstream calls it caused, as JSON.
+
+    python benchmarks/bench_endpoints.py --out bench.json
+    python benchmarks/bench_endpoints.py --claude-latency 0.8 --claude-429-rate 0.05 \\
+        --baseline bench.json --max-regression 0.2
+
+Endpoints that queue a job are timed until the job finishes, through
+/api/jobs/{id}/events. --baseline adds each scenario's change in req/s and p95
+against an earlier run's JSON; with --max-regression the exit status is 1 when
+any scenario got worse than that fraction.
+"""
+import os, sys, json, time, hmac, base64, random, asyncio, hashlib, argparse, platform, statistics
+import subprocess, tempfile, contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import httpx
+
+WEBHOOK_SECRET = "bench-secret"
+
+def shop_name(i: int):
+    return f"bench-{i}.myshopify.com"
+
+class Scenario:
+    """One endpoint under load. call(client, i) makes request i and returns its
+    outcome: the HTTP status, or the final status of the job it queued."""
+
+    def __init__(self, name: str, call, requests: int = None):
+        self.name = name
+        self.call = call
+        self.requests = requests
+
+def scenarios(args, products: int):
+    shops = [shop_name(i) for i in range(args.shops)]
+    shop = lambda i: shops[i % len(shops)]
+    # Spread requests over the catalog, but keep them inside it
+    product_id = lambda i: 1 + (i * 7919) % products
+    suggestion = lambda i: {"title": f"Bench title {i}", "description_html": "<p>Bench</p>", "tags": "bench",
+                            "seo_title": "Bench", "seo_description": "Bench",
+                            "discount_code": f"BENCH{i % 20}", "discount_percent": 5 + i % 20}
+
+    async def get(client, path, **params):
+        return (await client.get(path, params=params)).status_code
+
+    async def post(client, path, body, **params):
+        return (await client.post(path, json=body, params=params)).status_code
+
+    async def read(client, path, body):
+        # Streaming endpoints: the request is done when the whole body has arrived
+        async with client.stream("POST", path, json=body) as r:
+            async for _ in r.aiter_bytes():
+                pass
+            return r.status_code
+
+    async def job(client, path, body, **params):
+        r = await client.post(path, json=body, params=params)
+        if r.status_code != 202:
+            return r.status_code
+        status = "unknown"
+        async with client.stream("GET", f"/api/jobs/{r.json()['job_id']}/events",
+                                 params={"shop": (body or params)["shop"]}) as events:
+            async for line in events.aiter_lines():
+                if line.startswith("data:"):
+                    status = json.loads(line[5:])["status"]
+        return f"job:{status}"
+
+    async def webhook(client, i):
+        body = json.dumps({"id": product_id(i), "title": f"Updated {i}", "updated_at": "2025-01-01T00:00:00Z",
+                           "variants": [{"id": 1, "price": "9.99"}]}).encode()
+        digest = base64.b64encode(hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).digest()).decode()
+        r = await client.post("/webhooks", content=body, headers={
+            "x-shopify-hmac-sha256": digest, "x-shopify-shop-domain": shop(i),
+            "x-shopify-topic": "products/update", "x-shopify-webhook-id": f"bench-{time.time_ns()}-{i}"})
+        return r.status_code
+
+    async def create_bundle(client, i):
+        a, b = product_id(i), product_id(i + 1)
+        product = lambda p: {"id": p, "variants": [{"price": "19.99"}],
+                             "images": [{"src": f"https://cdn.example.com/{p}.jpg"}]}
+        return await job(client, "/api/create-bundle", {
+            "shop": shop(i), "product_a": product(a), "product_b": product(b),
+            "bundle": {"title": f"Bench bundle {i}", "description_html": "<p>Bench</p>", "tags": "bench",
+                       "bundle_price_percent_off": 10, "bundle_notes": "Bench"}})
+
+    batch = 10
+    return [
+        # Full sync first: later scenarios read products from the mirror it fills
+        Scenario("products_sync", lambda c, i: post(c, "/api/products/sync", None, shop=shop(i), full=True),
+                 requests=len(shops)),
+        Scenario("shops_me", lambda c, i: get(c, "/api/shops/me", shop=shop(i))),
+        Scenario("products_list", lambda c, i: get(c, "/api/products", shop=shop(i), limit=50)),
+        Scenario("generate", lambda c, i: post(c, "/api/generate", {
+            "shop": shop(i), "product_id": product_id(i), "force_refresh": True})),
+        Scenario("generate_cached", lambda c, i: post(c, "/api/generate", {
+            "shop": shop(i), "product_id": product_id(i)})),
+        Scenario("generate_stream", lambda c, i: read(c, "/api/generate/stream", {
+            "shop": shop(i), "product_id": product_id(i), "force_refresh": True})),
+        Scenario("generate_batch", lambda c, i: read(c, "/api/generate/batch", {
+            "shop": shop(i), "product_ids": [product_id(i * batch + n) for n in range(batch)],
+            "force_refresh": True}), requests=max(1, args.requests // batch)),
+        Scenario("generate_bundle", lambda c, i: post(c, "/api/generate-bundle", {
+            "shop": shop(i), "product_a_id": product_id(i), "product_b_id": product_id(i + 1),
+            "force_refresh": True})),
+        Scenario("bundles_suggest", lambda c, i: get(c, "/api/bundles/suggest", shop=shop(i), k=10)),
+        Scenario("bundles_suggest_product", lambda c, i: get(c, "/api/bundles/suggest", shop=shop(i),
+                                                            product_id=product_id(i), k=10)),
+        # After the catalog-only suggestions above: with orders synced, auto would rank by them
+        Scenario("orders_sync", lambda c, i: job(c, "/api/orders/sync", None, shop=shop(i), full=True),
+                 requests=len(shops)),
+        Scenario("bundles_suggest_orders", lambda c, i: get(c, "/api/bundles/suggest", shop=shop(i), k=10,
+                                                           source="orders")),
+        Scenario("bundles_suggest_orders_product", lambda c, i: get(c, "/api/bundles/suggest", shop=shop(i),
+                                                                   product_id=product_id(i), k=10,
+                                                                   source="orders")),
+        Scenario("generate_announcement", lambda c, i: post(c, "/api/generate-announcement", {
+            "shop": shop(i), "prompt": f"Summer sale {i}", "force_refresh": True})),
+        Scenario("generate_announcement_stream", lambda c, i: read(c, "/api/generate-announcement/stream", {
+            "shop": shop(i), "prompt": f"Winter sale {i}", "force_refresh": True})),
+        Scenario("apply", lambda c, i: job(c, "/api/apply", {
+            "shop": shop(i), "product_id": product_id(i), "suggestion": suggestion(i)})),
+        Scenario("apply_batch", lambda c, i: job(c, "/api/apply/batch", {
+            "shop": shop(i), "items": [{"product_id": product_id(i * batch + n), "suggestion": suggestion(i * batch + n)}
+                                       for n in range(batch)]}), requests=max(1, args.requests // batch)),
+        Scenario("create_bundle", create_bundle),
+        Scenario("publish_announcement", lambda c, i: post(c, "/api/publish-announcement", {
+            "shop": shop(i), "filename": "ai-announcement-bar.liquid", "content": f"<div>Bench {i}</div>"})),
+        Scenario("inject_announcement", lambda c, i: job(c, "/api/inject-announcement", {
+            "shop": shop(i), "filename": "ai-announcement-bar.liquid"})),
+        Scenario("webhooks", webhook),
+        Scenario("agent_intent", lambda c, i: post(c, "/api/agent-intent", {"prompt": "I want to bundle something"})),
+        Scenario("usage", lambda c, i: get(c, "/api/usage", shop=shop(i), days=30)),
+    ]
+
+def percentiles(latencies: list):
+    if len(latencies) < 2:
+        value = round(latencies[0] * 1000, 2) if latencies else None
+        return {"p50": value, "p95": value, "p99": value, "max": value}
+    cuts = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {"p50": round(cuts[49] * 1000, 2), "p95": round(cuts[94] * 1000, 2),
+            "p99": round(cuts[98] * 1000, 2), "max": round(max(latencies) * 1000, 2)}
+
+def succeeded(outcome):
+    return outcome == "job:succeeded" or (isinstance(outcome, int) and outcome < 400)
+
+async def run(scenario: Scenario, client, requests: int, concurrency: int, fakes: dict):
+    for fake in fakes.values():
+        fake.calls.clear()
+    slots = asyncio.Semaphore(concurrency)
+    latencies, outcomes = [], {}
+
+    async def one(i):
+        async with slots:
+            started = time.perf_counter()
+            try:
+                outcome = await scenario.call(client, i)
+            except Exception as e:
+                outcome = f"exception:{type(e).__name__}"
+            latencies.append(time.perf_counter() - started)
+            outcomes[str(outcome)] = outcomes.get(str(outcome), 0) + 1
+            return outcome
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(one(i) for i in range(requests)))
+    elapsed = time.perf_counter() - started
+    upstream_calls = {name: dict(sorted(fake.calls.items())) for name, fake in fakes.items()}
+    return {
+        "requests": requests,
+        "concurrency": min(concurrency, requests),
+        "seconds": round(elapsed, 3),
+        "rps": round(requests / elapsed, 1),
+        "ok": sum(1 for r in results if succeeded(r)),
+        "outcomes": outcomes,
+        "latency_ms": {**percentiles(latencies), "mean": round(statistics.fmean(latencies) * 1000, 2)},
+        "upstream_calls": upstream_calls,
+        "upstream_calls_per_request": {
+            name: round(sum(n for route, n in calls.items() if route.startswith(("GET", "POST", "PUT", "DELETE")))
+                        / requests, 2)
+            for name, calls in upstream_calls.items()},
+    }
+
+def commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        sha = subprocess.run(["git", "rev-parse", "HEAD"], cwd=here, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain"], cwd=here,
+                                    capture_output=True, text=True).stdout.strip())
+    except OSError:
+        return None, None
+    return sha or None, dirty
+
+def compare(results: dict, baseline: dict):
+    """Relative change per scenario against baseline: positive rps_change is faster,
+    positive p95_change is slower"""
+    changes = {}
+    for name, now in results.items():
+        before = baseline.get("scenarios", {}).get(name)
+        if not before or not before.get("rps") or not before["latency_ms"].get("p95"):
+            continue
+        changes[name] = {
+            "rps_change": round(now["rps"] / before["rps"] - 1, 3),
+            "p95_change": round(now["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1, 3),
+        }
+    return {"commit": baseline.get("commit"), "scenarios": changes}
+
+async def drive(args, app_main, store, upstream, metrics, logs, fakes: dict):
+    """Run the app with its upstream clients on the fakes; {scenario: result}"""
+    results = {}
+    async with app_main.lifespan(app_main.app):
+        await upstream.close_clients()
+        # Instrumented like the real clients, so /metrics and Server-Timing see the fakes' calls
+        for name, fake in (("shopify", fakes["shopify"]), ("claude", fakes["anthropic"])):
+            upstream._clients[name] = httpx.AsyncClient(
+                transport=metrics.InstrumentedTransport(httpx.ASGITransport(app=fake.app), name),
+                event_hooks={"request": [logs.tag_outbound]})
+        await store.executemany("INSERT INTO shops(shop, access_token) VALUES(?,?)",
+                                [(shop_name(i), "bench-token") for i in range(args.shops)])
+        only = set(args.only.split(",")) if args.only else None
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app_main.app), base_url="http://bench",
+                                     timeout=None) as client:
+            for scenario in scenarios(args, args.products):
+                if only and scenario.name not in only and scenario.name != "products_sync":
+                    continue
+                results[scenario.name] = await run(scenario, client, scenario.requests or args.requests,
+                                                   args.concurrency, fakes)
+                print(f"{scenario.name}: {results[scenario.name]['rps']} req/s, "
+                      f"p95 {results[scenario.name]['latency_ms']['p95']} ms", file=sys.stderr)
+    return results
+
+async def main(args):
+    os.environ["DB_PATH"] = os.path.join(tempfile.mkdtemp(), "bench.db")
+    os.environ["CLAUDE_API_KEY"] = "bench"
+    os.environ["SHOPIFY_API_SECRET"] = WEBHOOK_SECRET
+    os.environ["FAKE_PRODUCTS"] = str(args.products)
+    os.environ.setdefault("FAKE_BULK_SECONDS", "0.2")
+    os.environ.setdefault("SHOPIFY_BULK_POLL_SECONDS", "0.2")
+    os.environ.setdefault("JOB_POLL_SECONDS", "0.2")
+    random.seed(args.seed)
+
+    import store, upstream, metrics, logs, main as app_main
+    from fakes import shopify as fake_shopify, anthropic as fake_anthropic
+    fake_shopify.config.update(latency=args.shopify_latency, error_rate=args.shopify_error_rate,
+                               rate_limit_rate=args.shopify_429_rate)
+    fake_anthropic.config.update(latency=args.claude_latency, error_rate=args.claude_error_rate,
+                                 rate_limit_rate=args.claude_429_rate)
+    fakes = {"shopify": fake_shopify, "anthropic": fake_anthropic}
+
+    # The app's logs go to stdout; keep it for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        results = await drive(args, app_main, store, upstream, metrics, logs, fakes)
+
+    sha, dirty = commit()
+    report = {
+        "commit": sha,
+        "dirty": dirty,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("out", "baseline", "max_regression")},
+        "scenarios": results,
+    }
+    regressed = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["baseline"] = compare(results, json.load(f))
+        if args.max_regression is not None:
+            regressed = [name for name, c in report["baseline"]["scenarios"].items()
+                         if c["rps_change"] < -args.max_regression or c["p95_change"] > args.max_regression]
+            report["baseline"]["regressed"] = regressed
+    output = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    return 1 if regressed else 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--shops", type=int, default=10)
+    parser.add_argument("--products", type=int, default=1000, help="products in each fake shop")
+    parser.add_argument("--only", help="comma-separated scenario names")
+    parser.add_argument("--seed", type=int, default=1, help="seed for the fakes' injected failures")
+    parser.add_argument("--claude-latency", type=float, default=0.0, help="seconds per Messages call")
+    parser.add_argument("--claude-error-rate", type=float, default=0.0, help="fraction answered 529")
+    parser.add_argument("--claude-429-rate", type=float, default=0.0, help="fraction answered 429")
+    parser.add_argument("--shopify-latency", type=float, default=0.0, help="seconds per Admin API call")
+    parser.add_argument("--shopify-error-rate", type=float, default=0.0, help="fraction answered 503")
+    parser.add_argument("--shopify-429-rate", type=float, default=0.0, help="fraction answered 429")
+    parser.add_argument("--out", help="also write the JSON report here")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    parser.add_argument("--max-regression", type=float,
+                        help="exit 1 if any scenario's req/s fell or p95 rose by more than this fraction")
+    sys.exit(asyncio.run(main(parser.parse_args())))
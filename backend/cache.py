@@ -0,0 +1,89 @@
+import time
+from collections import OrderedDict
+
+# Process-local TTL + LRU cache with hit/miss counters.
+# A shared store (anything with async get/set/delete, e.g. a Redis wrapper) can
+# be plugged in so several uvicorn workers see each other's writes and
+# invalidations; the local layer then only bounds how long a worker may serve
+# a value another worker has already invalidated (at most `ttl` seconds).
+
+_MISSING = object()
+
+# Registry of every cache in the process, for the stats endpoint
+caches = {}
+
+class TTLCache:
+    def __init__(self, name: str, maxsize: int = 1024, ttl: float = 300, shared=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        caches[name] = self
+
+    def get(self, key, default=None):
+        entry = self._data.get(key, _MISSING)
+        if entry is not _MISSING:
+            value, expires = entry
+            if expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return default
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def delete(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    # Shared-store aware variants; fall back to local-only when no store is set
+
+    async def aget(self, key, default=None):
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        if self.shared is not None:
+            value = await self.shared.get(f"{self.name}:{key}")
+            if value is not None:
+                self.set(key, value)
+                return value
+        return default
+
+    async def aset(self, key, value, ttl: float = None):
+        self.set(key, value, ttl)
+        if self.shared is not None:
+            await self.shared.set(f"{self.name}:{key}", value, self.ttl if ttl is None else ttl)
+
+    async def adelete(self, key):
+        self.delete(key)
+        if self.shared is not None:
+            await self.shared.delete(f"{self.name}:{key}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / total, 4) if total else None,
+            "shared": type(self.shared).__name__ if self.shared is not None else None,
+        }
+
+def stats():
+    return {name: cache.stats() for name, cache in caches.items()}
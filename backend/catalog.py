@@ -0,0 +1,292 @@
+import os, json, time, asyncio, logging
+import store
+import upstream
+import shopify
+import webhooks
+import similarity
+from singleflight import SingleFlight
+from shopify import ShopifyError, admin_url, next_page_url
+
+# Per-shop local mirror of the Shopify product catalog.
+# The first sync is a full one; after that only products with updated_at >=
+# last sync start are fetched. Full syncs walk every page via Link-header
+# cursors, or for large catalogs run as a GraphQL bulk operation whose JSONL
+# result is streamed in.
+# Reads are served from SQLite with keyset pagination, search and field projection.
+
+PAGE_SIZE = 250
+CATALOG_REFRESH_SECONDS = float(os.getenv("CATALOG_REFRESH_SECONDS", "60"))
+# With webhooks registered, a quiet mirror is trusted for up to this long
+CATALOG_MAX_AGE_SECONDS = float(os.getenv("CATALOG_MAX_AGE_SECONDS", "3600"))
+# Overlap between incremental windows so clock skew can't drop an update
+SYNC_OVERLAP_SECONDS = 5
+# Full syncs of catalogs at least this large use a bulk operation instead of paging
+CATALOG_BULK_THRESHOLD = int(os.getenv("CATALOG_BULK_THRESHOLD", "5000"))
+BULK_BATCH_SIZE = 500
+
+# The fields products.json returns that the app uses, in GraphQL terms
+PRODUCTS_BULK_QUERY = """
+{
+  products {
+    edges { node {
+      id legacyResourceId title handle vendor productType tags status descriptionHtml
+      createdAt updatedAt publishedAt
+      variants { edges { node { id legacyResourceId title sku price inventoryQuantity } } }
+      images { edges { node { id url altText } } }
+    } }
+  }
+}
+"""
+
+_locks = {}
+_tasks = set()
+# Concurrent misses for the same product share one Shopify fetch
+product_flight = SingleFlight("shopify_product")
+
+log = logging.getLogger(__name__)
+
+def _lock(shop):
+    lock = _locks.get(shop)
+    if lock is None:
+        lock = _locks[shop] = asyncio.Lock()
+    return lock
+
+def _row(shop, p, synced):
+    return (shop, int(p["id"]), p.get("title"), p.get("vendor"), p.get("product_type"),
+            p.get("tags"), p.get("status"), p.get("updated_at"), json.dumps(p), synced)
+
+_COLUMNS = ["title", "vendor", "product_type", "tags", "status", "updated_at", "data", "synced"]
+
+async def upsert(shop: str, products: list, newer_only: bool = False):
+    """Mirror products. With newer_only (webhooks, which Shopify may deliver out
+    of order) a row is only replaced by a payload at least as recent as it."""
+    if products:
+        synced = int(time.time())
+        sql = f"""INSERT INTO products(shop, id, {", ".join(_COLUMNS)}) VALUES(?,?,?,?,?,?,?,?,?,?)
+                  ON CONFLICT(shop, id) DO UPDATE SET {", ".join(f"{c} = excluded.{c}" for c in _COLUMNS)}"""
+        if newer_only:
+            # julianday() understands the UTC offsets in Shopify's timestamps
+            sql += """ WHERE excluded.updated_at IS NULL OR products.updated_at IS NULL
+                       OR julianday(excluded.updated_at) >= julianday(products.updated_at)"""
+        await store.executemany(sql, [_row(shop, p, synced) for p in products])
+        similarity.mark_stale(shop)
+
+async def delete(shop: str, product_id):
+    await store.execute("DELETE FROM products WHERE shop = ? AND id = ?", (shop, int(product_id)))
+    similarity.mark_stale(shop)
+
+async def fetch_pages(shop: str, token: str, params: dict, priority: int = shopify.BULK):
+    """Yield every page of products.json for params, mirroring each page as it arrives"""
+    url, query = admin_url(shop, "products.json"), {"limit": PAGE_SIZE, **params}
+    while url:
+        r = await shopify.request(shop, "GET", url, token, priority, params=query)
+        if r.status_code != 200:
+            raise ShopifyError(r.status_code, r.text)
+        products = r.json().get("products", [])
+        await upsert(shop, products)
+        yield products
+        # page_info URLs already carry every allowed parameter
+        url, query = next_page_url(r.headers.get("link")), None
+
+async def _fetch_all(shop: str, token: str, params: dict, priority: int = shopify.BULK):
+    count = 0
+    async for products in fetch_pages(shop, token, params, priority):
+        count += len(products)
+    return count
+
+async def _synced_at(shop: str):
+    row = await store.fetchone("SELECT synced_at FROM catalog_sync WHERE shop = ?", (shop,))
+    return row["synced_at"] if row else None
+
+async def _mark_synced(shop: str, started: float):
+    await store.execute("INSERT OR REPLACE INTO catalog_sync(shop, synced_at) VALUES(?,?)", (shop, int(started)))
+
+def _from_graphql(node: dict):
+    """products.json shape of a bulk product line"""
+    return {
+        "id": int(node["legacyResourceId"]),
+        "title": node.get("title"),
+        "handle": node.get("handle"),
+        "vendor": node.get("vendor"),
+        "product_type": node.get("productType"),
+        "tags": ", ".join(node.get("tags") or []),
+        "status": (node.get("status") or "").lower() or None,
+        "body_html": node.get("descriptionHtml"),
+        "created_at": node.get("createdAt"),
+        "updated_at": node.get("updatedAt"),
+        "published_at": node.get("publishedAt"),
+        "variants": [],
+        "images": [],
+    }
+
+def _attach(product: dict, child: dict):
+    # gid://shopify/ProductImage/1
+    if child["id"].split("/")[3] == "ProductImage":
+        product["images"].append({"id": int(child["id"].rsplit("/", 1)[1]), "product_id": product["id"],
+                                  "src": child.get("url"), "alt": child.get("altText")})
+    else:
+        product["variants"].append({"id": int(child["legacyResourceId"]), "product_id": product["id"],
+                                    "title": child.get("title"), "sku": child.get("sku"),
+                                    "price": child.get("price"),
+                                    "inventory_quantity": child.get("inventoryQuantity")})
+
+async def _bulk_products(url: str):
+    """Yield products from a bulk result file as it downloads. Nested connections
+    come as separate lines right after their parent, so only one product is
+    ever held in memory."""
+    async with upstream.shopify_client().stream("GET", url) as r:
+        if r.status_code != 200:
+            raise ShopifyError(r.status_code, (await r.aread()).decode(errors="replace")[:500])
+        product, parent = None, None
+        async for line in r.aiter_lines():
+            if not line.strip():
+                continue
+            node = json.loads(line)
+            if "__parentId" not in node:
+                if product is not None:
+                    yield product
+                product, parent = _from_graphql(node), node["id"]
+            elif node["__parentId"] == parent:
+                _attach(product, node)
+        if product is not None:
+            yield product
+
+async def _bulk_fetch_all(shop: str, token: str):
+    url = await shopify.run_bulk_query(shop, token, PRODUCTS_BULK_QUERY)
+    count, batch = 0, []
+    if url:
+        async for product in _bulk_products(url):
+            batch.append(product)
+            if len(batch) >= BULK_BATCH_SIZE:
+                await upsert(shop, batch)
+                count, batch = count + len(batch), []
+        await upsert(shop, batch)
+    return count + len(batch)
+
+async def _product_count(shop: str, token: str, priority: int = shopify.BULK):
+    r = await shopify.request(shop, "GET", admin_url(shop, "products/count.json"), token, priority)
+    if r.status_code != 200:
+        raise ShopifyError(r.status_code, r.text)
+    return r.json()["count"]
+
+async def full_sync(shop: str, token: str, bulk: bool = None):
+    """Re-mirror the whole catalog. bulk=None picks a bulk operation for large catalogs."""
+    async with _lock(shop):
+        return await _full_sync(shop, token, bulk)
+
+async def _full_sync(shop: str, token: str, bulk: bool, priority: int = shopify.BULK):
+    started = time.time()
+    if bulk is None:
+        bulk = await _product_count(shop, token, priority) >= CATALOG_BULK_THRESHOLD
+    count = await (_bulk_fetch_all(shop, token) if bulk else _fetch_all(shop, token, {}, priority))
+    # Anything not seen during this pass was deleted upstream
+    await store.execute("DELETE FROM products WHERE shop = ? AND synced < ?", (shop, int(started)))
+    similarity.mark_stale(shop)
+    await _mark_synced(shop, started)
+    return count
+
+async def incremental_sync(shop: str, token: str, priority: int = shopify.BULK):
+    async with _lock(shop):
+        synced_at = await _synced_at(shop)
+        if synced_at is None:
+            # Nothing mirrored yet: a large catalog loads faster as one bulk operation
+            return await _full_sync(shop, token, None, priority)
+        started = time.time()
+        since = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(synced_at - SYNC_OVERLAP_SECONDS))
+        count = await _fetch_all(shop, token, {"updated_at_min": since}, priority)
+        await _mark_synced(shop, started)
+        return count
+
+async def _refresh_in_background(shop: str, token: str):
+    try:
+        await incremental_sync(shop, token)
+    except Exception as e:
+        log.warning("Catalog refresh failed: %s", e, extra={"shop": shop})
+
+async def _stale(shop: str, synced_at: int):
+    age = time.time() - synced_at
+    # Product webhooks write straight into the mirror, so once they are
+    # registered polling is only a safety net for missed deliveries
+    if await webhooks.registered(shop):
+        return age > CATALOG_MAX_AGE_SECONDS
+    return age > CATALOG_REFRESH_SECONDS
+
+async def ensure_fresh(shop: str, token: str):
+    """Block on the initial sync; afterwards refresh stale mirrors in the background."""
+    synced_at = await _synced_at(shop)
+    if synced_at is None:
+        # Someone is waiting on this one
+        await incremental_sync(shop, token, shopify.INTERACTIVE)
+    elif not _lock(shop).locked() and await _stale(shop, synced_at):
+        task = asyncio.create_task(_refresh_in_background(shop, token))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+def _project(product: dict, fields):
+    return {k: product[k] for k in fields if k in product} if fields else product
+
+async def list_page(shop: str, limit: int = 10, cursor: str = None, q: str = None, fields: str = None):
+    limit = max(1, min(limit, PAGE_SIZE))
+    sql, params = "SELECT id, data FROM products WHERE shop = ?", [shop]
+    if cursor:
+        sql += " AND id > ?"
+        params.append(int(cursor))
+    if q:
+        like = f"%{q}%"
+        sql += " AND (title LIKE ? OR vendor LIKE ? OR product_type LIKE ? OR tags LIKE ?)"
+        params += [like] * 4
+    sql += " ORDER BY id LIMIT ?"
+    params.append(limit + 1)
+    rows = await store.fetchall(sql, params)
+    field_list = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    products = [_project(json.loads(r["data"]), field_list) for r in rows[:limit]]
+    next_cursor = str(rows[limit - 1]["id"]) if len(rows) > limit else None
+    return {"products": products, "next_cursor": next_cursor}
+
+async def get_product(shop: str, product_id):
+    row = await store.fetchone("SELECT data FROM products WHERE shop = ? AND id = ?", (shop, int(product_id)))
+    return json.loads(row["data"]) if row else None
+
+async def get_products(shop: str, product_ids: list):
+    """Mirrored products for product_ids, keyed by ID; missing IDs are absent"""
+    found = {}
+    ids = [int(i) for i in product_ids]
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        rows = await store.fetchall(
+            f"SELECT id, data FROM products WHERE shop = ? AND id IN ({','.join('?' * len(chunk))})", [shop, *chunk])
+        found.update({r["id"]: json.loads(r["data"]) for r in rows})
+    return found
+
+async def load_products(shop: str, token: str, product_ids: list):
+    """Mirror first, then one products.json?ids= request per 250 misses. Returns {id: product}."""
+    found = await get_products(shop, product_ids)
+    missing = [int(i) for i in product_ids if int(i) not in found]
+    for i in range(0, len(missing), PAGE_SIZE):
+        ids = ",".join(str(m) for m in missing[i:i + PAGE_SIZE])
+        async for products in fetch_pages(shop, token, {"ids": ids}):
+            found.update({p["id"]: p for p in products})
+    return found
+
+async def load_collection(shop: str, token: str, collection_id):
+    """Every product in a collection, straight from Shopify (membership isn't mirrored)"""
+    products = []
+    async for page in fetch_pages(shop, token, {"collection_id": collection_id}):
+        products.extend(page)
+    return products
+
+async def fetch_product(shop: str, token: str, product_id):
+    """Fetch one product from Shopify and refresh its mirror row"""
+    r = await shopify.request(shop, "GET", admin_url(shop, f"products/{product_id}.json"), token)
+    if r.status_code != 200:
+        raise ShopifyError(r.status_code, r.text)
+    product = r.json()["product"]
+    await upsert(shop, [product])
+    return product
+
+async def load_product(shop: str, token: str, product_id):
+    """Local mirror first, Shopify on a miss"""
+    product = await get_product(shop, product_id)
+    if product is None:
+        product = await product_flight.do((shop, str(product_id)), lambda: fetch_product(shop, token, product_id))
+    return product
@@ -0,0 +1,158 @@
+import os, json, time, asyncio, logging
+import store
+import upstream
+import llm
+
+# Offline generation through Anthropic's Message Batches API.
+# Jobs are submitted in one request, their Anthropic batch IDs are persisted,
+# and a background poller collects results into SQLite once a batch has ended.
+# Latency is hours at worst, but cost is half of the synchronous API.
+
+BATCH_POLL_SECONDS = float(os.getenv("CLAUDE_BATCH_POLL_SECONDS", "30"))
+BATCH_MAX_REQUESTS = 100_000  # Anthropic's per-batch cap
+
+_wakeup = None
+_poller = None
+_handlers = {}
+
+log = logging.getLogger(__name__)
+
+def on_result(kind: str, handler):
+    """Register handler(item, message) -> value that turns a succeeded message into a stored result"""
+    _handlers[kind] = handler
+
+async def submit(shop: str, kind: str, items: list, api_key: str):
+    """items: [{"custom_id", "product_id", "cache_key", "params"}]. Returns the local job ID."""
+    if len(items) > BATCH_MAX_REQUESTS:
+        raise ValueError(f"Too many requests for one batch ({len(items)} > {BATCH_MAX_REQUESTS})")
+    r = await upstream.claude_client().post(
+        upstream.claude_url("/v1/messages/batches"), headers=llm.headers(api_key),
+        json={"requests": [{"custom_id": i["custom_id"], "params": i["params"]} for i in items]})
+    r.raise_for_status()
+    batch = r.json()
+    now = int(time.time())
+
+    def insert(conn):
+        with conn:
+            cur = conn.execute(
+                """INSERT INTO claude_batches(shop, kind, anthropic_id, status, request_counts, created_at, updated_at)
+                   VALUES(?,?,?,?,?,?,?)""",
+                (shop, kind, batch["id"], batch.get("processing_status", "in_progress"),
+                 json.dumps(batch.get("request_counts", {})), now, now))
+            job_id = cur.lastrowid
+            conn.executemany(
+                """INSERT INTO claude_batch_items(batch_id, custom_id, product_id, cache_key, status)
+                   VALUES(?,?,?,?,'pending')""",
+                [(job_id, i["custom_id"], str(i.get("product_id", "")), i.get("cache_key")) for i in items])
+            return job_id
+
+    job_id = await store.run(insert)
+    if _wakeup is not None:
+        _wakeup.set()
+    return job_id
+
+async def get_job(job_id: int, shop: str = None, with_results: bool = True):
+    job = await store.fetchone("SELECT * FROM claude_batches WHERE id = ?", (job_id,))
+    if job is None or (shop is not None and job["shop"] != shop):
+        return None
+    job["request_counts"] = json.loads(job["request_counts"] or "{}")
+    if with_results:
+        items = await store.fetchall(
+            "SELECT custom_id, product_id, status, result, error FROM claude_batch_items WHERE batch_id = ? ORDER BY rowid",
+            (job_id,))
+        for item in items:
+            item["result"] = json.loads(item["result"]) if item["result"] else None
+        job["items"] = items
+    return job
+
+async def _store_results(job: dict, api_key: str, results_url: str):
+    handler = _handlers.get(job["kind"])
+    items = {r["custom_id"]: r for r in await store.fetchall(
+        "SELECT custom_id, product_id, cache_key FROM claude_batch_items WHERE batch_id = ?", (job["id"],))}
+    updates = []
+
+    async def flush():
+        if updates:
+            await store.executemany(
+                "UPDATE claude_batch_items SET status = ?, result = ?, error = ? WHERE batch_id = ? AND custom_id = ?",
+                updates)
+            updates.clear()
+
+    # Results are JSONL and can be large; stream them rather than loading the file
+    async with upstream.claude_client().stream("GET", results_url, headers=llm.headers(api_key)) as r:
+        r.raise_for_status()
+        async for line in r.aiter_lines():
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            item = items.get(entry.get("custom_id"))
+            if item is None:
+                continue
+            result = entry.get("result", {})
+            status, value, error = result.get("type", "errored"), None, None
+            if status == "succeeded":
+                llm.record_usage("batch", result["message"].get("usage"), result["message"].get("model"),
+                                 shop=job["shop"], product_id=item.get("product_id") or None)
+                try:
+                    value = await handler(item, result["message"]) if handler else result["message"]
+                except Exception as e:
+                    status, error = "errored", getattr(e, "detail", None) or str(e)
+            else:
+                error = json.dumps(result.get("error")) if result.get("error") else status
+            updates.append((status, json.dumps(value) if value is not None else None, error,
+                            job["id"], entry["custom_id"]))
+            if len(updates) >= 500:
+                await flush()
+    await flush()
+
+async def poll_once(api_key: str):
+    # ended_at is set once results are stored, which a batch that had already
+    # ended when submitted still needs
+    jobs = await store.fetchall("SELECT * FROM claude_batches WHERE ended_at IS NULL")
+    for job in jobs:
+        try:
+            r = await upstream.claude_client().get(
+                upstream.claude_url(f"/v1/messages/batches/{job['anthropic_id']}"), headers=llm.headers(api_key))
+            r.raise_for_status()
+            batch = r.json()
+            status = batch.get("processing_status", job["status"])
+            if status == "ended" and batch.get("results_url"):
+                await _store_results(job, api_key, batch["results_url"])
+            await store.execute(
+                "UPDATE claude_batches SET status = ?, request_counts = ?, updated_at = ?, ended_at = ? WHERE id = ?",
+                (status, json.dumps(batch.get("request_counts", {})), int(time.time()),
+                 int(time.time()) if status == "ended" else None, job["id"]))
+        except Exception as e:
+            log.warning("Claude batch poll failed: %s", e, extra={"job_id": job["id"], "batch_id": job["anthropic_id"]})
+    return len(jobs)
+
+async def _poll_forever(api_key: str):
+    while True:
+        try:
+            await poll_once(api_key)
+        except Exception as e:
+            log.exception("Claude batch poller error")
+        # asyncio.wait rather than wait_for: wait_for can swallow a cancel that
+        # races with its timeout, which would keep the poller alive on shutdown
+        waiter = asyncio.ensure_future(_wakeup.wait())
+        try:
+            await asyncio.wait([waiter], timeout=BATCH_POLL_SECONDS)
+        finally:
+            waiter.cancel()
+        _wakeup.clear()
+
+def start_poller(api_key: str):
+    global _poller, _wakeup
+    if _poller is None and api_key:
+        _wakeup = asyncio.Event()
+        _poller = asyncio.create_task(_poll_forever(api_key))
+
+async def stop_poller():
+    global _poller, _wakeup
+    if _poller is not None:
+        _poller.cancel()
+        try:
+            await _poller
+        except asyncio.CancelledError:
+            pass
+        _poller, _wakeup = None, None
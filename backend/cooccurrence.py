@@ -0,0 +1,279 @@
+import os, time, asyncio, itertools
+import numpy as np
+from scipy import sparse
+import store
+import cache
+
+# Per-shop product co-occurrence over stored order lines (see orders.py): how
+# many orders contain both products of a pair, kept as a symmetric sparse
+# matrix next to per-product order counts. Pairs are ranked by lift, how much
+# more often they are bought together than if purchases were independent,
+# among pairs seen together in at least COOC_MIN_SUPPORT orders.
+#
+# The matrix is built from order lines in chunks of COOC_CHUNK_LINES, each
+# turned into an order x product incidence matrix B and added as B.T @ B, and
+# is then kept up to date by adding only lines stored since. An order whose
+# lines were stored at different times (a webhook then a sync, a split batch)
+# is still one basket: when more of its lines arrive, the lines counted before
+# are read back and its old basket is replaced by the whole one. Memory is
+# bounded by the chunk size, the counted order IDs (8 bytes each) and
+# COOC_MAX_PAIRS: past that, pairs seen together fewer
+# than min_count times are dropped (min_count doubles until the matrix fits),
+# and reported in stats. Orders with more than COOC_MAX_BASKET products
+# (wholesale, staff) are counted as orders but add no pairs.
+
+COOC_MIN_SUPPORT = int(os.getenv("COOC_MIN_SUPPORT", "3"))
+COOC_MAX_BASKET = int(os.getenv("COOC_MAX_BASKET", "50"))
+COOC_MAX_PAIRS = int(os.getenv("COOC_MAX_PAIRS", "5000000"))
+COOC_CHUNK_LINES = int(os.getenv("COOC_CHUNK_LINES", "200000"))
+COOC_MAX_AGE = float(os.getenv("COOC_MAX_AGE", "60"))
+COOC_MAX_SHOPS = int(os.getenv("COOC_MAX_SHOPS", "200"))
+COOC_IDLE_TTL = float(os.getenv("COOC_IDLE_TTL", "3600"))
+
+matrices = cache.TTLCache("cooccurrence", COOC_MAX_SHOPS, COOC_IDLE_TTL)
+_stale = set()
+_generations = {}
+_locks = {}
+_stats = {"builds": 0, "updates": 0, "lines_read": 0, "recounted_orders": 0, "prunes": 0, "queries": 0}
+
+def _distinct(values: np.ndarray) -> np.ndarray:
+    # Sorting is cheaper than np.unique's hashing for IDs that arrive nearly in order
+    values = np.sort(values)
+    return values[np.concatenate([[True], values[1:] != values[:-1]])]
+
+class Matrix:
+    """One shop's co-occurrence counts; indices into it are positions in products"""
+
+    def __init__(self):
+        self.products = np.zeros(0, dtype=np.int64)   # product ID per index
+        self.rows = {}                                # product ID -> index
+        self.counts = np.zeros(0, dtype=np.int64)     # orders containing each product
+        self.pairs = sparse.csr_matrix((0, 0), dtype=np.int32)  # orders containing both
+        self.orders = 0
+        self.order_ids = np.zeros(0, dtype=np.int64)  # every order counted, sorted
+        self.last_line = 0   # order_lines.id of the newest line counted
+        self.min_count = 1   # pairs seen fewer times than this were pruned
+        self.checked_at = time.monotonic()
+        self._top = {}
+
+    def _indices(self, product_ids: np.ndarray) -> np.ndarray:
+        """Index of each product ID, adding products not seen before"""
+        distinct, positions = np.unique(product_ids, return_inverse=True)
+        new = [p for p in distinct.tolist() if p not in self.rows]
+        if new:
+            start = len(self.products)
+            self.rows.update({p: start + n for n, p in enumerate(new)})
+            self.products = np.concatenate([self.products, np.array(new, dtype=np.int64)])
+            self.counts = np.concatenate([self.counts, np.zeros(len(new), dtype=np.int64)])
+        return np.array([self.rows[p] for p in distinct.tolist()], dtype=np.int64)[positions]
+
+    def new_orders(self, order_ids: np.ndarray) -> np.ndarray:
+        """The distinct order_ids not counted yet"""
+        distinct = _distinct(order_ids)
+        return distinct[~np.isin(distinct, self.order_ids, assume_unique=True)]
+
+    @staticmethod
+    def _together(order_ids: np.ndarray, columns: np.ndarray, size: int):
+        """Orders containing both products of each pair, over whole baskets of lines"""
+        orders, order_rows = np.unique(order_ids, return_inverse=True)
+        baskets = sparse.csr_matrix((np.ones(len(columns), dtype=np.int32), (order_rows, columns)),
+                                    shape=(len(orders), size))
+        basket_sizes = np.diff(baskets.indptr)
+        baskets = baskets[(basket_sizes > 1) & (basket_sizes <= COOC_MAX_BASKET)]
+        together = (baskets.T @ baskets).tocsr()
+        together.setdiag(0)
+        together.eliminate_zeros()
+        return together
+
+    def add(self, order_ids: np.ndarray, product_ids: np.ndarray, earlier=None):
+        """Count a chunk of order lines; every line of each order stored so far must be
+        in the chunk or in earlier, the (order_ids, product_ids) of its lines counted before"""
+        columns = self._indices(product_ids)
+        size = len(self.products)
+        # Lines are unique per order and product, so each is one more order for its product
+        self.counts = self.counts + np.bincount(columns, minlength=size)
+        self.order_ids = np.sort(np.concatenate([self.order_ids, self.new_orders(order_ids)]))
+        self.orders = len(self.order_ids)
+        together = self._together(order_ids, columns, size)
+        if earlier is not None and len(earlier[0]):
+            # Swap the baskets counted before for the whole ones
+            earlier_columns = self._indices(earlier[1])
+            together = (self._together(np.concatenate([order_ids, earlier[0]]),
+                                       np.concatenate([columns, earlier_columns]), size)
+                        - self._together(earlier[0], earlier_columns, size))
+        # Grow to the new products without touching the arrays readers may hold
+        grown = np.pad(self.pairs.indptr, (0, size + 1 - len(self.pairs.indptr)), mode="edge")
+        pairs = sparse.csr_matrix((self.pairs.data, self.pairs.indices, grown), shape=(size, size))
+        self.pairs = (pairs + together).tocsr()
+        if earlier is not None and len(earlier[0]):
+            # Pairs pruned since an order was first counted would go negative
+            self.pairs.data[self.pairs.data < 0] = 0
+            self.pairs.eliminate_zeros()
+        while self.pairs.nnz > COOC_MAX_PAIRS:
+            self.min_count *= 2
+            self.pairs.data[self.pairs.data < self.min_count] = 0
+            self.pairs.eliminate_zeros()
+            _stats["prunes"] += 1
+        self._top = {}
+
+    def ranked(self, a: np.ndarray, b: np.ndarray, together: np.ndarray):
+        """Lift and confidence (of b given a) for pairs a-b seen together in `together` orders"""
+        counts_a, counts_b = self.counts[a].astype(np.float64), self.counts[b].astype(np.float64)
+        lift = together * self.orders / np.maximum(counts_a * counts_b, 1)
+        return lift, together / np.maximum(counts_a, 1)
+
+    @property
+    def nbytes(self) -> int:
+        return (self.pairs.data.nbytes + self.pairs.indices.nbytes + self.pairs.indptr.nbytes
+                + self.products.nbytes + self.counts.nbytes + self.order_ids.nbytes)
+
+def _lines(conn, shop: str, after: int):
+    return conn.execute(
+        "SELECT id, order_id, product_id FROM order_lines WHERE shop = ? AND id > ? ORDER BY id LIMIT ?",
+        (shop, after, COOC_CHUNK_LINES)).fetchall()
+
+def _counted_lines(conn, shop: str, order_ids: np.ndarray, last_line: int):
+    """(order_ids, product_ids) of the lines of order_ids already counted (id <= last_line)"""
+    rows = []
+    for i in range(0, len(order_ids), 500):
+        chunk = order_ids[i:i + 500].tolist()
+        # +id keeps SQLite on the (shop, order_id, product_id) index rather than a range scan of ids
+        rows += conn.execute(
+            f"SELECT order_id, product_id FROM order_lines WHERE shop = ? AND order_id IN ({','.join('?' * len(chunk))})"
+            " AND +id <= ?", [shop, *chunk, last_line]).fetchall()
+    lines = np.array(rows, dtype=np.int64).reshape(-1, 2)
+    return lines[:, 0], lines[:, 1]
+
+def _update(conn, shop: str, old: Matrix) -> Matrix:
+    """A matrix that also counts the order lines stored since old (or all of them).
+    Runs on a DB worker thread and leaves old untouched for queries meanwhile;
+    reads in chunks that never split an order."""
+    lines = _lines(conn, shop, old.last_line if old is not None else 0)
+    if old is not None and not lines:
+        old.checked_at = time.monotonic()
+        return old
+    matrix = Matrix()
+    if old is not None:
+        matrix.__dict__.update(old.__dict__, rows=dict(old.rows), _top={})
+    while lines:
+        # fromiter over the flattened rows is several times faster than np.array on tuples
+        chunk = np.fromiter(itertools.chain.from_iterable(lines), dtype=np.int64,
+                            count=3 * len(lines)).reshape(-1, 3)
+        full = len(lines) == COOC_CHUNK_LINES
+        if full:
+            # The last order may continue in the next chunk: leave it for then,
+            # unless it alone fills the chunk
+            rest = chunk[chunk[:, 1] != chunk[-1, 1]]
+            if len(rest):
+                chunk = rest
+        orders = _distinct(chunk[:, 1])
+        seen = orders[np.isin(orders, matrix.order_ids, assume_unique=True)]
+        earlier = _counted_lines(conn, shop, seen, matrix.last_line) if len(seen) else None
+        _stats["recounted_orders"] += len(seen)
+        matrix.add(chunk[:, 1], chunk[:, 2], earlier)
+        matrix.last_line = int(chunk[:, 0].max())
+        _stats["lines_read"] += len(chunk)
+        lines = _lines(conn, shop, matrix.last_line) if full else None
+    matrix.checked_at = time.monotonic()
+    return matrix
+
+def _lock(shop):
+    lock = _locks.get(shop)
+    if lock is None:
+        lock = _locks[shop] = asyncio.Lock()
+    return lock
+
+def mark_stale(shop: str):
+    """New order lines were stored for the shop; count them before the next query"""
+    _stale.add(shop)
+
+def forget(shop: str):
+    """Drop the shop's matrix, e.g. after its order lines were replaced"""
+    _generations[shop] = _generations.get(shop, 0) + 1
+    matrices.delete(shop)
+
+async def get_matrix(shop: str) -> Matrix:
+    matrix = matrices.get(shop)
+    if matrix is not None and shop not in _stale and time.monotonic() - matrix.checked_at < COOC_MAX_AGE:
+        return matrix
+    async with _lock(shop):
+        matrix = matrices.get(shop)
+        if matrix is None or shop in _stale or time.monotonic() - matrix.checked_at >= COOC_MAX_AGE:
+            _stale.discard(shop)
+            generation = _generations.get(shop, 0)
+            updated = await store.run(_update, shop, matrix)
+            _stats["builds" if matrix is None else "updates"] += 1
+            # A full re-sync replaced the lines while this ran; don't keep counts of the old ones
+            if _generations.get(shop, 0) == generation:
+                matrices.set(shop, updated)
+            matrix = updated
+    return matrix
+
+def _pair(matrix: Matrix, a: int, b: int, together: int, lift: float, confidence: float) -> dict:
+    return {"product_a_id": int(matrix.products[a]), "product_b_id": int(matrix.products[b]),
+            "score": round(float(lift), 4), "lift": round(float(lift), 4),
+            "confidence": round(float(confidence), 4), "orders_together": int(together)}
+
+def partners(matrix: Matrix, product_id: int, k: int = 10) -> list:
+    """The k products bought with product_id with the highest lift"""
+    a = matrix.rows[int(product_id)]
+    start, end = matrix.pairs.indptr[a], matrix.pairs.indptr[a + 1]
+    b, together = matrix.pairs.indices[start:end], matrix.pairs.data[start:end]
+    supported = together >= COOC_MIN_SUPPORT
+    b, together = b[supported], together[supported]
+    lift, confidence = matrix.ranked(np.full(len(b), a), b, together)
+    order = np.lexsort((-together, -lift))[:k]
+    return [_pair(matrix, a, int(b[n]), together[n], lift[n], confidence[n]) for n in order]
+
+def top_pairs(matrix: Matrix, k: int = 10) -> list:
+    """The k pairs with the highest lift across the shop, each product in at most one pair"""
+    upper = sparse.triu(matrix.pairs, k=1, format="coo")
+    supported = upper.data >= COOC_MIN_SUPPORT
+    a, b, together = upper.row[supported], upper.col[supported], upper.data[supported]
+    lift, confidence = matrix.ranked(a, b, together)
+    # Enough candidates that the one-pair-per-product rule still leaves k
+    want = min(4 * k, len(lift))
+    candidates = np.argpartition(-lift, want - 1)[:want] if want else []
+    pairs, used = [], set()
+    for n in sorted(candidates, key=lambda n: (-lift[n], -together[n])):
+        if a[n] not in used and b[n] not in used:
+            used.update((a[n], b[n]))
+            pairs.append(_pair(matrix, a[n], b[n], together[n], lift[n], confidence[n]))
+            if len(pairs) == k:
+                break
+    return pairs
+
+async def _describe(shop: str, pairs: list) -> list:
+    """Attach id/title/product_type/vendor of both products from the catalog mirror"""
+    ids = sorted({p[f"product_{side}_id"] for p in pairs for side in "ab"})
+    info = {}
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        rows = await store.fetchall(
+            "SELECT id, title, product_type, vendor, updated_at FROM products "
+            f"WHERE shop = ? AND id IN ({','.join('?' * len(chunk))})", [shop, *chunk])
+        info.update({r["id"]: r for r in rows})
+    return [{**p, "product_a": info.get(p["product_a_id"], {"id": p["product_a_id"]}),
+             "product_b": info.get(p["product_b_id"], {"id": p["product_b_id"]})} for p in pairs]
+
+async def suggest(shop: str, product_id=None, k: int = 10):
+    """Top-k pairs by lift, or product_id's top-k partners. None if product_id was never ordered."""
+    matrix = await get_matrix(shop)
+    _stats["queries"] += 1
+    if product_id is not None:
+        if int(product_id) not in matrix.rows:
+            return None
+        pairs = partners(matrix, product_id, k)
+    else:
+        pairs = matrix._top.get(k)
+        if pairs is None:
+            # Vectorised over every pair, but still worth keeping off the event loop
+            pairs = matrix._top[k] = await asyncio.to_thread(top_pairs, matrix, k)
+    return {"pairs": await _describe(shop, pairs), "orders": matrix.orders}
+
+def stats():
+    shops = [matrix for matrix, _ in matrices._data.values()]
+    return {**_stats, "shops": len(shops), "orders": sum(m.orders for m in shops),
+            "products": sum(len(m.products) for m in shops), "pairs": sum(m.pairs.nnz for m in shops),
+            "pruned_below": max([m.min_count for m in shops], default=1),
+            "bytes": sum(m.nbytes for m in shops)}
@@ -0,0 +1,32 @@
+import re, random, asyncio
+from collections import Counter
+
+# Shared by the fakes: per-route call counts, and injected latency, errors and
+# rate limiting, all read from a fake's config dict on every request so a
+# benchmark can change them between runs.
+
+_IDS = re.compile(r"/(\d+|msgbatch_\w+|[0-9a-f]{12})(?=[/.]|$)")
+
+def route_name(method: str, path: str) -> str:
+    """"GET /admin/api/{version}/products/{id}.json" for a request, IDs collapsed"""
+    path = re.sub(r"^/admin/api/[^/]+/", "/admin/api/{version}/", path)
+    return f"{method} {_IDS.sub('/{id}', path)}"
+
+def instrument(app, config: dict, calls: Counter, failure, rate_limited):
+    """Count every request into calls and apply config's latency (seconds),
+    error_rate and rate_limit_rate (fractions of requests). failure() and
+    rate_limited() build the responses for an injected error or 429."""
+
+    @app.middleware("http")
+    async def inject(request, call_next):
+        calls[route_name(request.method, request.url.path)] += 1
+        if config["latency"]:
+            await asyncio.sleep(config["latency"])
+        roll = random.random()
+        if roll < config["rate_limit_rate"]:
+            calls["429"] += 1
+            return rate_limited()
+        if roll < config["rate_limit_rate"] + config["error_rate"]:
+            calls["errors"] += 1
+            return failure()
+        return await call_next(request)
@@ -0,0 +1,182 @@
+"""Local stand-in for the Anthropic Messages and Message Batches APIs.
+
+    uvicorn fakes.anthropic:app --port 9001
+    ANTHROPIC_BASE_URL=http://localhost:9001 python main.py
+
+Batches end FAKE_BATCH_SECONDS after creation. Every request succeeds with a
+canned launch-asset suggestion, except custom_ids listed in FAKE_BATCH_ERRORS
+(comma-separated), which come back errored. Streamed messages send their text
+in FAKE_STREAM_CHUNK-character deltas, FAKE_STREAM_DELAY seconds apart.
+System blocks marked cache_control are reported as prompt cache writes the
+first time and reads after that, once they reach FAKE_CACHE_MIN_TOKENS.
+
+Every request waits FAKE_CLAUDE_LATENCY seconds; FAKE_CLAUDE_ERROR_RATE of them
+fail with 529 overloaded and FAKE_CLAUDE_429_RATE with a 429 carrying
+retry-after FAKE_CLAUDE_RETRY_AFTER. Call counts per route are kept in calls.
+"""
+import os, json, time, uuid, asyncio
+from collections import Counter
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fakes import instrument
+
+FAKE_BATCH_SECONDS = float(os.getenv("FAKE_BATCH_SECONDS", "2"))
+FAKE_STREAM_CHUNK = int(os.getenv("FAKE_STREAM_CHUNK", "8"))
+FAKE_STREAM_DELAY = float(os.getenv("FAKE_STREAM_DELAY", "0.02"))
+FAKE_BATCH_ERRORS = {c for c in os.getenv("FAKE_BATCH_ERRORS", "").split(",") if c}
+FAKE_CACHE_MIN_TOKENS = int(os.getenv("FAKE_CACHE_MIN_TOKENS", "1024"))
+
+config = {
+    "latency": float(os.getenv("FAKE_CLAUDE_LATENCY", "0")),
+    "error_rate": float(os.getenv("FAKE_CLAUDE_ERROR_RATE", "0")),
+    "rate_limit_rate": float(os.getenv("FAKE_CLAUDE_429_RATE", "0")),
+    "retry_after": float(os.getenv("FAKE_CLAUDE_RETRY_AFTER", "1")),
+}
+
+app = FastAPI()
+batches = {}
+cached_prefixes = set()
+calls = Counter()
+
+def error(status: int, kind: str, message: str, headers=None):
+    return JSONResponse({"type": "error", "error": {"type": kind, "message": message}}, status, headers=headers)
+
+instrument(app, config, calls,
+           failure=lambda: error(529, "overloaded_error", "Overloaded"),
+           rate_limited=lambda: error(429, "rate_limit_error", "Rate limited",
+                                      {"retry-after": str(config["retry_after"])}))
+
+def suggestion_for(params: dict):
+    prompt = params["messages"][0]["content"]
+    prompt = prompt if isinstance(prompt, str) else json.dumps(prompt)
+    return {
+        "title": "Fake optimized title",
+        "description_html": "<ul><li>Fake</li></ul>",
+        "bullets": ["One", "Two", "Three", "Four", "Five"],
+        "tags": "fake, launch",
+        "seo_title": "Fake SEO title",
+        "seo_description": "Fake SEO description",
+        "discount_code": "LAUNCH10",
+        "discount_percent": 10,
+        "banner_copy": f"Launching now ({len(prompt)} prompt chars)",
+    }
+
+def announcement_for(params: dict):
+    bar = "<div style='background: #000; color: #fff; padding: 12px; text-align: center;'>Fake announcement</div>"
+    return {
+        "filename": "ai-announcement-bar.liquid",
+        "content": bar,
+        "preview_html": f"<!DOCTYPE html><html><head><meta charset='utf-8'></head><body>{bar}</body></html>",
+    }
+
+def bundle_for(params: dict):
+    return {
+        "title": "Fake Bundle",
+        "description_html": "<p>Both products together</p>",
+        "tags": "bundle, fake",
+        "bundle_price_percent_off": 10,
+        "bundle_notes": "Fake bundle notes",
+    }
+
+def usage_for(params: dict):
+    system = params.get("system") or []
+    system = [{"text": system}] if isinstance(system, str) else system
+    prefix = "".join(block.get("text", "") for block in system)
+    prefix_tokens = len(prefix) // 4
+    usage = {"input_tokens": 100 + prefix_tokens, "output_tokens": 50,
+             "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0}
+    if any(block.get("cache_control") for block in system) and prefix_tokens >= FAKE_CACHE_MIN_TOKENS:
+        field = "cache_read_input_tokens" if prefix in cached_prefixes else "cache_creation_input_tokens"
+        usage["input_tokens"], usage[field] = 100, prefix_tokens
+        cached_prefixes.add(prefix)
+    return usage
+
+def message_for(params: dict):
+    prompt = json.dumps(params["messages"])
+    if "announcement bar snippet" in prompt:
+        answer = announcement_for(params)
+    elif "Product A:" in prompt:
+        answer = bundle_for(params)
+    else:
+        answer = suggestion_for(params)
+    return {
+        "id": f"msg_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": params.get("model"),
+        "content": [{"type": "text", "text": json.dumps(answer)}],
+        "stop_reason": "end_turn",
+        "usage": usage_for(params),
+    }
+
+def view(batch: dict, base_url: str):
+    ended = time.time() - batch["created"] >= FAKE_BATCH_SECONDS
+    n = len(batch["requests"])
+    errored = sum(1 for r in batch["requests"] if r["custom_id"] in FAKE_BATCH_ERRORS)
+    return {
+        "id": batch["id"],
+        "type": "message_batch",
+        "processing_status": "ended" if ended else "in_progress",
+        "request_counts": {
+            "processing": 0 if ended else n,
+            "succeeded": n - errored if ended else 0,
+            "errored": errored if ended else 0,
+            "canceled": 0,
+            "expired": 0,
+        },
+        "results_url": f"{base_url}v1/messages/batches/{batch['id']}/results" if ended else None,
+    }
+
+def stream_events(message: dict):
+    def event(data):
+        return f"event: {data['type']}\ndata: {json.dumps(data)}\n\n"
+
+    async def events():
+        text = message["content"][0]["text"]
+        yield event({"type": "message_start", "message": {**message, "content": [], "stop_reason": None,
+                                                          "usage": {**message["usage"], "output_tokens": 1}}})
+        yield event({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        for i in range(0, len(text), FAKE_STREAM_CHUNK):
+            await asyncio.sleep(FAKE_STREAM_DELAY)
+            yield event({"type": "content_block_delta", "index": 0,
+                         "delta": {"type": "text_delta", "text": text[i:i + FAKE_STREAM_CHUNK]}})
+        yield event({"type": "content_block_stop", "index": 0})
+        yield event({"type": "message_delta", "delta": {"stop_reason": message["stop_reason"]},
+                     "usage": {"output_tokens": message["usage"]["output_tokens"]}})
+        yield event({"type": "message_stop"})
+    return events()
+
+@app.post("/v1/messages")
+async def create_message(request: Request):
+    body = await request.json()
+    message = message_for(body)
+    if body.get("stream"):
+        return StreamingResponse(stream_events(message), media_type="text/event-stream")
+    return message
+
+@app.post("/v1/messages/batches")
+async def create_batch(request: Request):
+    body = await request.json()
+    batch_id = f"msgbatch_{uuid.uuid4().hex[:24]}"
+    batches[batch_id] = {"id": batch_id, "created": time.time(), "requests": body["requests"]}
+    return view(batches[batch_id], str(request.base_url))
+
+@app.get("/v1/messages/batches/{batch_id}")
+async def get_batch(batch_id: str, request: Request):
+    if batch_id not in batches:
+        raise HTTPException(404, "not_found_error")
+    return view(batches[batch_id], str(request.base_url))
+
+@app.get("/v1/messages/batches/{batch_id}/results")
+async def batch_results(batch_id: str):
+    batch = batches.get(batch_id)
+    if batch is None or time.time() - batch["created"] < FAKE_BATCH_SECONDS:
+        raise HTTPException(404, "not_found_error")
+    lines = []
+    for r in batch["requests"]:
+        if r["custom_id"] in FAKE_BATCH_ERRORS:
+            result = {"type": "errored", "error": {"type": "invalid_request_error", "message": "fake error"}}
+        else:
+            result = {"type": "succeeded", "message": message_for(r["params"])}
+        lines.append(json.dumps({"custom_id": r["custom_id"], "result": result}))
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="application/binary")
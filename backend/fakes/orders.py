@@ -0,0 +1,109 @@
+"""Synthetic orders with a known co-purchase structure, for the fake Shopify
+server, the benchmarks and checks of the bundle ranking.
+
+Products come in planted pairs (1, 2), (3, 4), ...: a basket holding one of a
+pair also holds the other with probability pair_rate, and the rest of it is
+drawn at random with low product IDs the most popular. Order i is generated
+from its own seed and placed ORDER_SPACING seconds after order i - 1, so any
+page can be produced without the ones before it.
+
+Written straight into a database's order_lines, for scale tests without a
+fake server:
+
+    python -m fakes.orders --db /tmp/orders.db --shop fake.myshopify.com --orders 300000 --products 5000
+"""
+import os, sys, json, time, random, argparse
+
+FAKE_ORDER_PAIR_RATE = float(os.getenv("FAKE_ORDER_PAIR_RATE", "0.6"))
+ORDER_SPACING = 60
+# Order 1 is placed FAKE_ORDERS_SPAN_DAYS ago, whatever the number of orders
+FAKE_ORDERS_SPAN_DAYS = float(os.getenv("FAKE_ORDERS_SPAN_DAYS", "300"))
+EPOCH = int(time.time() - FAKE_ORDERS_SPAN_DAYS * 86400)
+
+def created_at(i: int) -> int:
+    return EPOCH + i * ORDER_SPACING
+
+def first_since(unix_time: float) -> int:
+    """Number of the first order created at or after unix_time"""
+    return max(1, -(-(int(unix_time) - EPOCH) // ORDER_SPACING))
+
+def cancelled(i: int) -> bool:
+    # A few cancelled orders, which ingestion skips
+    return i % 97 == 0
+
+def partner(product: int, products: int):
+    other = product + 1 if product % 2 else product - 1
+    return other if 1 <= other <= products else None
+
+def basket(i: int, products: int, pair_rate: float = FAKE_ORDER_PAIR_RATE, seed: int = 0) -> dict:
+    """{product_id: quantity} of order i"""
+    rng = random.Random(seed * 1_000_003 + i)
+    size = rng.choice((1, 1, 2, 2, 2, 3, 3, 4, 5))
+    # Log-uniform: product 1 is bought far more often than product 1000
+    anchor = min(products, int(products ** rng.random()))
+    items = {anchor: rng.randint(1, 3)}
+    mate = partner(anchor, products)
+    if mate and rng.random() < pair_rate:
+        items[mate] = rng.randint(1, 2)
+    while len(items) < size:
+        items.setdefault(rng.randint(1, products), 1)
+    return items
+
+def order(i: int, products: int, pair_rate: float = FAKE_ORDER_PAIR_RATE, seed: int = 0) -> dict:
+    """orders.json shape of order i"""
+    stamp = lambda t: time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+    return {
+        "id": i,
+        "created_at": stamp(created_at(i)),
+        "cancelled_at": stamp(created_at(i) + 3600) if cancelled(i) else None,
+        "line_items": [{"id": i * 100 + n, "product_id": p, "quantity": q, "title": f"Product {p}"}
+                       for n, (p, q) in enumerate(basket(i, products, pair_rate, seed).items())],
+    }
+
+def bulk_lines(first: int, end: int, products: int, pair_rate: float = FAKE_ORDER_PAIR_RATE):
+    """Bulk operation JSONL for orders first..end-1: each order, then its line items"""
+    for i in range(first, end):
+        o = order(i, products, pair_rate)
+        gid = f"gid://shopify/Order/{i}"
+        yield json.dumps({"id": gid, "legacyResourceId": str(i), "createdAt": o["created_at"],
+                          "cancelledAt": o["cancelled_at"]}) + "\n"
+        for item in o["line_items"]:
+            yield json.dumps({"id": f"gid://shopify/LineItem/{item['id']}", "quantity": item["quantity"],
+                              "product": {"legacyResourceId": str(item["product_id"])},
+                              "__parentId": gid}) + "\n"
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic order lines into a database")
+    parser.add_argument("--db", required=True)
+    parser.add_argument("--shop", default="fake.myshopify.com")
+    parser.add_argument("--orders", type=int, default=100_000)
+    parser.add_argument("--products", type=int, default=5000)
+    parser.add_argument("--pair-rate", type=float, default=FAKE_ORDER_PAIR_RATE)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.environ["DB_PATH"] = args.db
+    import store
+    store.init_db()
+    conn = store._connect()
+    lines, batch = 0, []
+
+    def flush():
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO order_lines(shop, order_id, product_id, quantity, created_at) "
+                             "VALUES(?,?,?,?,?)", batch)
+
+    for i in range(1, args.orders + 1):
+        if not cancelled(i):
+            batch += [(args.shop, i, p, q, created_at(i))
+                      for p, q in basket(i, args.products, args.pair_rate, args.seed).items()]
+        if len(batch) >= 50_000:
+            flush()
+            lines, batch = lines + len(batch), []
+    flush()
+    lines += len(batch)
+    conn.close()
+    print(f"{args.orders} orders, {lines} line items for {args.shop} in {args.db}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""Local stand-in for the Shopify Admin API endpoints the backend calls.
+
+    uvicorn fakes.shopify:app --port 9002
+    SHOPIFY_BASE_URL=http://localhost:9002 python main.py
+
+Every shop sees the same catalog of FAKE_PRODUCTS products with FAKE_VARIANTS
+variants and one image each; products created through the API are added to it.
+It also has FAKE_ORDERS synthetic orders of those products (see fakes/orders.py).
+Serves products and orders (REST, including Link-header pagination and counts),
+product creation and metafields, themes and theme assets, webhook
+subscriptions, and the GraphQL product update, code discount and bulk
+operation (products or orders) calls.
+
+A bulkOperationRunQuery completes FAKE_BULK_SECONDS after it starts; its result
+file is generated line by line as it is downloaded.
+
+Every request waits FAKE_SHOPIFY_LATENCY seconds; FAKE_SHOPIFY_ERROR_RATE of
+them fail with 503 and FAKE_SHOPIFY_429_RATE with a 429 carrying Retry-After
+FAKE_SHOPIFY_RETRY_AFTER. Call counts per route are kept in calls.
+"""
+import os, re, json, time, uuid, itertools
+from datetime import datetime
+from collections import Counter
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from fakes import instrument
+from fakes import orders as fake_orders
+
+FAKE_PRODUCTS = int(os.getenv("FAKE_PRODUCTS", "10000"))
+FAKE_VARIANTS = int(os.getenv("FAKE_VARIANTS", "3"))
+FAKE_BULK_SECONDS = float(os.getenv("FAKE_BULK_SECONDS", "1"))
+FAKE_ORDERS = int(os.getenv("FAKE_ORDERS", "2000"))
+
+config = {
+    "latency": float(os.getenv("FAKE_SHOPIFY_LATENCY", "0")),
+    "error_rate": float(os.getenv("FAKE_SHOPIFY_ERROR_RATE", "0")),
+    "rate_limit_rate": float(os.getenv("FAKE_SHOPIFY_429_RATE", "0")),
+    "retry_after": float(os.getenv("FAKE_SHOPIFY_RETRY_AFTER", "1")),
+}
+
+LAYOUT = "<!doctype html><html><head><title>{{ shop.name }}</title></head><body>{{ content_for_layout }}</body></html>"
+THEME_ID = 1
+
+app = FastAPI()
+operations = {}
+calls = Counter()
+created = {}  # products created through the API, by ID
+assets = {}  # (shop, key) -> value
+discounts = {}  # (shop, CODE) -> discount node ID
+discount_percentages = {}  # discount node ID -> percentage (0-1)
+_ids = itertools.count(10_000_000)
+
+instrument(app, config, calls,
+           failure=lambda: PlainTextResponse("Service Unavailable", 503),
+           rate_limited=lambda: JSONResponse({"errors": "Exceeded 2 calls per second for api client."}, 429,
+                                             headers={"Retry-After": str(config["retry_after"])}))
+
+@app.middleware("http")
+async def call_limit(request: Request, call_next):
+    response = await call_next(request)
+    # Plenty of room in the REST bucket, so the scheduler never holds requests back
+    response.headers["X-Shopify-Shop-Api-Call-Limit"] = "1/40"
+    return response
+
+def cost(requested: int = 10):
+    return {"cost": {"requestedQueryCost": requested, "actualQueryCost": requested,
+                     "throttleStatus": {"maximumAvailable": 1000.0, "currentlyAvailable": 990,
+                                        "restoreRate": 50.0}}}
+
+def shop_of(request: Request):
+    return request.headers.get("host", "")
+
+def product(i: int):
+    """products.json shape of catalog product i"""
+    if i in created:
+        return created[i]
+    return {
+        "id": i, "title": f"Product {i}", "handle": f"product-{i}", "vendor": "Fake Vendor",
+        "product_type": "Fake", "tags": f"fake, group-{i % 10}", "status": "active",
+        "body_html": f"<p>Description of product {i}</p>",
+        "created_at": "2024-01-01T00:00:00Z", "updated_at": "2024-06-01T00:00:00Z",
+        "published_at": "2024-01-01T00:00:00Z",
+        "options": [{"name": "Size", "values": [f"Variant {v}" for v in range(FAKE_VARIANTS)]}],
+        "variants": [{"id": i * 100 + v, "product_id": i, "title": f"Variant {v}", "sku": f"SKU-{i}-{v}",
+                      "price": "19.99", "inventory_quantity": 5} for v in range(FAKE_VARIANTS)],
+        "images": [{"id": i, "product_id": i, "src": f"https://cdn.example.com/{i}.jpg", "alt": None}],
+    }
+
+def exists(i: int):
+    return 1 <= i <= FAKE_PRODUCTS or i in created
+
+# REST
+
+@app.get("/admin/api/{version}/products.json")
+async def list_products(request: Request, limit: int = 50, page_info: str = None, ids: str = None,
+                        title: str = None, collection_id: int = None):
+    if ids:
+        return {"products": [product(int(i)) for i in ids.split(",") if exists(int(i))]}
+    if title is not None:
+        return {"products": [p for p in created.values() if p["title"] == title]}
+    # Collection n holds the products in group-n; page_info is an offset, though
+    # real cursors are opaque and carry the filters themselves
+    members = range(1, FAKE_PRODUCTS + 1)
+    if collection_id:
+        members = range(collection_id % 10 or 10, FAKE_PRODUCTS + 1, 10)
+    start, limit = int(page_info or 0), min(limit, 250)
+    end = min(start + limit, len(members))
+    headers = {}
+    if end < len(members):
+        query = f"limit={limit}&page_info={end}" + (f"&collection_id={collection_id}" if collection_id else "")
+        headers["Link"] = f'<{str(request.url).split("?")[0]}?{query}>; rel="next"'
+    return JSONResponse({"products": [product(i) for i in members[start:end]]}, headers=headers)
+
+@app.get("/admin/api/{version}/products/count.json")
+async def product_count(version: str):
+    return {"count": FAKE_PRODUCTS + len(created)}
+
+@app.get("/admin/api/{version}/products/{product_id}.json")
+async def get_product(version: str, product_id: int):
+    if not exists(product_id):
+        raise HTTPException(404, "Not Found")
+    return {"product": product(product_id)}
+
+@app.post("/admin/api/{version}/products.json", status_code=201)
+async def create_product(version: str, request: Request):
+    body = (await request.json())["product"]
+    i = next(_ids)
+    created[i] = {
+        **body, "id": i, "status": "active", "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "variants": [{**v, "id": i * 100 + n, "product_id": i} for n, v in enumerate(body.get("variants") or [])],
+        "images": [{**img, "id": i * 100 + n, "product_id": i} for n, img in enumerate(body.get("images") or [])],
+    }
+    return {"product": created[i]}
+
+def orders_since(created_at_min: str = None) -> range:
+    first = 1
+    if created_at_min:
+        first = fake_orders.first_since(datetime.fromisoformat(created_at_min.replace("Z", "+00:00")).timestamp())
+    return range(first, FAKE_ORDERS + 1)
+
+@app.get("/admin/api/{version}/orders.json")
+async def list_orders(request: Request, limit: int = 50, page_info: str = None, created_at_min: str = None):
+    # page_info is an offset into the orders created since created_at_min
+    members, start, limit = orders_since(created_at_min), int(page_info or 0), min(limit, 250)
+    end = min(start + limit, len(members))
+    headers = {}
+    if end < len(members):
+        query = f"limit={limit}&page_info={end}" + (f"&created_at_min={created_at_min}" if created_at_min else "")
+        headers["Link"] = f'<{str(request.url).split("?")[0]}?{query}>; rel="next"'
+    return JSONResponse({"orders": [fake_orders.order(i, FAKE_PRODUCTS) for i in members[start:end]]},
+                        headers=headers)
+
+@app.get("/admin/api/{version}/orders/count.json")
+async def order_count(version: str, created_at_min: str = None):
+    return {"count": len(orders_since(created_at_min))}
+
+@app.post("/admin/api/{version}/metafields.json", status_code=201)
+async def create_metafield(version: str, request: Request):
+    return {"metafield": {**(await request.json())["metafield"], "id": next(_ids)}}
+
+@app.post("/admin/api/{version}/webhooks.json", status_code=201)
+async def create_webhook(version: str, request: Request):
+    return {"webhook": {**(await request.json())["webhook"], "id": next(_ids)}}
+
+@app.get("/admin/api/{version}/themes.json")
+async def list_themes(version: str):
+    return {"themes": [{"id": THEME_ID, "name": "Dawn", "role": "main"},
+                       {"id": THEME_ID + 1, "name": "Draft", "role": "unpublished"}]}
+
+@app.get("/admin/api/{version}/themes/{theme_id}/assets.json")
+async def get_asset(version: str, theme_id: int, request: Request):
+    if theme_id != THEME_ID:
+        raise HTTPException(404, "Not Found")
+    key = request.query_params.get("asset[key]")
+    shop = shop_of(request)
+    if key is None:
+        keys = {"layout/theme.liquid", *(k for s, k in assets if s == shop)}
+        return {"assets": [{"key": k, "theme_id": theme_id} for k in sorted(keys)]}
+    value = assets.get((shop, key), LAYOUT if key == "layout/theme.liquid" else None)
+    if value is None:
+        raise HTTPException(404, "Not Found")
+    return {"asset": {"key": key, "value": value, "theme_id": theme_id}}
+
+@app.put("/admin/api/{version}/themes/{theme_id}/assets.json")
+async def put_asset(version: str, theme_id: int, request: Request):
+    if theme_id != THEME_ID:
+        raise HTTPException(404, "Not Found")
+    asset = (await request.json())["asset"]
+    assets[(shop_of(request), asset["key"])] = asset["value"]
+    return {"asset": {"key": asset["key"], "theme_id": theme_id}}
+
+# GraphQL
+
+def operation_view(op: dict, base_url: str):
+    done = time.time() - op["created"] >= FAKE_BULK_SECONDS
+    found = len(op["orders"]) if op["orders"] is not None else FAKE_PRODUCTS
+    return {
+        "id": op["id"],
+        "status": "COMPLETED" if done else "RUNNING",
+        "errorCode": None,
+        "objectCount": str(found) if done else "0",
+        "url": f"{base_url}bulk/{op['key']}.jsonl" if done and found else None,
+    }
+
+def create_discount(shop: str, discount: dict):
+    key = (shop, discount["code"].upper())
+    if key in discounts:
+        return {"codeDiscountNode": None,
+                "userErrors": [{"field": ["basicCodeDiscount", "code"], "code": "TAKEN",
+                                "message": "Code must be unique."}]}
+    discounts[key] = f"gid://shopify/DiscountCodeNode/{next(_ids)}"
+    discount_percentages[discounts[key]] = discount["customerGets"]["value"].get("percentage")
+    return {"codeDiscountNode": {"id": discounts[key]}, "userErrors": []}
+
+def update_product(product_input: dict):
+    i = int(product_input["id"].rsplit("/", 1)[1])
+    if not exists(i):
+        return {"product": None, "userErrors": [{"field": ["id"], "message": "Product does not exist"}]}
+    return {"product": {"id": product_input["id"], "title": product_input.get("title"),
+                        "descriptionHtml": product_input.get("descriptionHtml"),
+                        "tags": product_input.get("tags") or [],
+                        "updatedAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())},
+            "userErrors": []}
+
+@app.post("/admin/api/{version}/graphql.json")
+async def graphql(version: str, request: Request):
+    body = await request.json()
+    query, variables = body["query"], body.get("variables") or {}
+    shop = shop_of(request)
+    if "bulkOperationRunQuery" in query:
+        calls["graphql bulkOperationRunQuery"] += 1
+        key = uuid.uuid4().hex[:12]
+        since = re.search(r"created_at:>='([^']+)'", variables.get("query", ""))
+        op = operations[key] = {"id": f"gid://shopify/BulkOperation/{key}", "key": key, "created": time.time(),
+                                # Orders the query covers, or None for a products query
+                                "orders": orders_since(since and since.group(1))
+                                if "orders(" in variables.get("query", "") else None}
+        return {"data": {"bulkOperationRunQuery": {
+            "bulkOperation": {"id": op["id"], "status": "CREATED"}, "userErrors": []}},
+            "extensions": cost()}
+    if "BulkOperation" in query:
+        calls["graphql node(BulkOperation)"] += 1
+        op = operations.get(variables.get("id", "").rsplit("/", 1)[-1])
+        return {"data": {"node": operation_view(op, str(request.base_url)) if op else None}, "extensions": cost(1)}
+    if "productUpdate" in query:
+        calls["graphql productUpdate"] += 1
+        return {"data": {"productUpdate": update_product(variables["input"])}, "extensions": cost()}
+    if "discountCodeBasicCreate" in query:
+        calls["graphql discountCodeBasicCreate"] += 1
+        return {"data": {"discountCodeBasicCreate": create_discount(shop, variables["discount"])},
+                "extensions": cost()}
+    if "codeDiscountNodeByCode" in query:
+        calls["graphql codeDiscountNodeByCode"] += 1
+        node_id = discounts.get((shop, variables["code"].upper()))
+        node = {"id": node_id, "codeDiscount": {"customerGets": {"value": {
+            "percentage": discount_percentages.get(node_id)}}}} if node_id else None
+        return {"data": {"codeDiscountNodeByCode": node}, "extensions": cost(1)}
+    if "discountRedeemCodeBulkAdd" in query:
+        calls["graphql discountRedeemCodeBulkAdd"] += 1
+        for c in variables["codes"]:
+            discounts.setdefault((shop, c["code"].upper()), variables["id"])
+        return {"data": {"discountRedeemCodeBulkAdd": {"bulkCreation": {"id": f"gid://shopify/DiscountRedeemCodeBulkCreation/{next(_ids)}"},
+                                                       "userErrors": []}}, "extensions": cost()}
+    return {"errors": [{"message": "The fake does not serve this query"}]}
+
+def product_chunks():
+    # Starlette iterates sync generators in a thread per item; a chunk of
+    # products per item keeps the fake from being the bottleneck
+    for start in range(1, FAKE_PRODUCTS + 1, 100):
+        yield "".join(product_lines(start, min(start + 100, FAKE_PRODUCTS + 1)))
+
+def product_lines(first: int, end: int):
+    for i in range(first, end):
+        gid = f"gid://shopify/Product/{i}"
+        yield json.dumps({
+            "id": gid, "legacyResourceId": str(i), "title": f"Product {i}", "handle": f"product-{i}",
+            "vendor": "Fake Vendor", "productType": "Fake", "tags": ["fake", f"group-{i % 10}"],
+            "status": "ACTIVE", "descriptionHtml": f"<p>Description of product {i}</p>",
+            "createdAt": "2024-01-01T00:00:00Z", "updatedAt": "2024-06-01T00:00:00Z",
+            "publishedAt": "2024-01-01T00:00:00Z",
+        }) + "\n"
+        for v in range(FAKE_VARIANTS):
+            variant_id = i * 100 + v
+            yield json.dumps({
+                "id": f"gid://shopify/ProductVariant/{variant_id}", "legacyResourceId": str(variant_id),
+                "title": f"Variant {v}", "sku": f"SKU-{i}-{v}", "price": "19.99", "inventoryQuantity": 5,
+                "__parentId": gid,
+            }) + "\n"
+        yield json.dumps({
+            "id": f"gid://shopify/ProductImage/{i}", "url": f"https://cdn.example.com/{i}.jpg",
+            "altText": None, "__parentId": gid,
+        }) + "\n"
+
+def order_chunks(members: range):
+    for start in range(members.start, members.stop, 500):
+        yield "".join(fake_orders.bulk_lines(start, min(start + 500, members.stop), FAKE_PRODUCTS))
+
+@app.get("/bulk/{key}.jsonl")
+async def bulk_result(key: str):
+    if key not in operations:
+        raise HTTPException(404, "NoSuchKey")
+    members = operations[key]["orders"]
+    return StreamingResponse(product_chunks() if members is None else order_chunks(members),
+                             media_type="application/jsonl")
@@ -0,0 +1,266 @@
+import os, json, time, uuid, random, socket, asyncio, logging
+import httpx
+import store
+import logs
+
+# Durable background jobs for multi-call Shopify writes.
+# Jobs are rows in SQLite, claimed one at a time by JOB_WORKERS async workers.
+# Handlers split their work into named steps; each step's result is
+# checkpointed, so a retried job (transient failure) or a resumed one (process
+# restart) skips the steps that already completed instead of repeating them.
+# A claimed job is leased to its process for JOB_LEASE_SECONDS and renewed
+# while it runs; only jobs whose lease ran out (their process died) are taken
+# over, so several app processes can share the table without running a job twice.
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "5"))
+JOB_BACKOFF_MAX = float(os.getenv("JOB_BACKOFF_MAX", "60"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))
+
+# This process, as recorded on the jobs it runs
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+TERMINAL = ("succeeded", "failed")
+
+log = logging.getLogger(__name__)
+
+class JobError(Exception):
+    """A step failed; retryable failures are run again after a backoff"""
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+class Job:
+    def __init__(self, row: dict):
+        self.id = row["id"]
+        self.shop = row["shop"]
+        self.kind = row["kind"]
+        self.attempts = row["attempts"]
+        self.created_at = row["created_at"]
+        self.payload = json.loads(row["payload"])
+        self.checkpoint = json.loads(row["checkpoint"] or "{}")
+        self._saving = asyncio.Lock()
+
+    async def step(self, name: str, fn):
+        """Result of fn(), run at most once to completion per job. Steps may run concurrently."""
+        if name in self.checkpoint:
+            return self.checkpoint[name]
+        await _update(self.id, step=name)
+        result = await fn()
+        self.checkpoint[name] = result
+        # Writes go through a thread pool; one at a time so a stale snapshot can't land last
+        async with self._saving:
+            await _update(self.id, checkpoint=json.dumps(self.checkpoint))
+        return result
+
+_handlers = {}
+_workers = []
+_heartbeat = None
+_wakeup = None
+_changed = {}
+
+def register(kind: str, handler):
+    """handler(job) -> result runs every job of this kind"""
+    _handlers[kind] = handler
+
+def _notify(job_id: int):
+    for event in _changed.get(job_id, ()):
+        event.set()
+
+async def _update(job_id: int, **fields):
+    fields["updated_at"] = int(time.time())
+    await store.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                        (*fields.values(), job_id))
+    _notify(job_id)
+
+async def enqueue(shop: str, kind: str, payload: dict, idempotency_key: str = None):
+    """Queue a job and return its ID. A repeated idempotency_key for the same kind
+    of job returns the existing job instead."""
+    now, request_id = int(time.time()), logs.request_id()
+    # Keys are scoped to the job kind: an apply key never returns a bundle job
+    key = f"{kind}:{idempotency_key}" if idempotency_key else None
+
+    def insert(conn):
+        with conn:
+            # Insert-or-nothing then select, so concurrent retries with one key
+            # both get the job the first of them created
+            cursor = conn.execute(
+                """INSERT INTO jobs(shop, kind, idempotency_key, status, payload, request_id, created_at, updated_at)
+                   VALUES(?,?,?,'queued',?,?,?,?) ON CONFLICT(shop, idempotency_key) DO NOTHING""",
+                (shop, kind, key, json.dumps(payload), request_id, now, now))
+            if cursor.rowcount:
+                return cursor.lastrowid
+            return conn.execute("SELECT id FROM jobs WHERE shop = ? AND idempotency_key = ?",
+                                (shop, key)).fetchone()["id"]
+
+    job_id = await store.run(insert)
+    if _wakeup is not None:
+        _wakeup.set()
+    return job_id
+
+def _view(row: dict):
+    checkpoint = json.loads(row.pop("checkpoint") or "{}")
+    row.pop("payload")
+    row.pop("idempotency_key")
+    row.pop("owner")
+    row.pop("lease_until")
+    row["steps_done"] = list(checkpoint)
+    row["result"] = json.loads(row["result"]) if row["result"] else None
+    return row
+
+async def get(job_id: int, shop: str = None):
+    row = await store.fetchone("SELECT * FROM jobs WHERE id = ?", (job_id,))
+    if row is None or (shop is not None and row["shop"] != shop):
+        return None
+    return _view(row)
+
+async def watch(job_id: int, shop: str = None):
+    """Yield the job each time it changes, until it succeeds or fails"""
+    event = asyncio.Event()
+    _changed.setdefault(job_id, set()).add(event)
+    try:
+        last = None
+        while True:
+            event.clear()
+            job = await get(job_id, shop)
+            if job is None:
+                return
+            if job != last:
+                yield job
+                last = job
+            if job["status"] in TERMINAL:
+                return
+            waiter = asyncio.ensure_future(event.wait())
+            try:
+                await asyncio.wait([waiter], timeout=JOB_POLL_SECONDS)
+            finally:
+                waiter.cancel()
+    finally:
+        _changed[job_id].discard(event)
+        if not _changed[job_id]:
+            del _changed[job_id]
+
+def _claim(conn):
+    now = int(time.time())
+    # Queued jobs, and running ones whose process stopped renewing their lease
+    claimable = ("(status = 'queued' AND run_after <= :now)"
+                 " OR (status = 'running' AND coalesce(lease_until, 0) < :now)")
+    with conn:
+        row = conn.execute(f"SELECT * FROM jobs WHERE {claimable} ORDER BY run_after, id LIMIT 1",
+                           {"now": now}).fetchone()
+        if row is None:
+            return None
+        # Another pooled connection or process may have claimed it first
+        claimed = conn.execute(
+            f"""UPDATE jobs SET status = 'running', owner = :owner, lease_until = :lease, attempts = attempts + 1,
+                updated_at = :now WHERE id = :id AND ({claimable})""",
+            {"owner": OWNER, "lease": int(now + JOB_LEASE_SECONDS), "now": now, "id": row["id"]}).rowcount
+        if claimed and row["status"] == "running":
+            log.warning("Resuming job whose lease expired", extra={"job_id": row["id"], "kind": row["kind"],
+                                                                   "owner": row["owner"]})
+        return {**dict(row), "attempts": row["attempts"] + 1} if claimed else None
+
+async def renew_leases():
+    """Extend the lease of every job this process is running"""
+    await store.execute("UPDATE jobs SET lease_until = ? WHERE owner = ? AND status = 'running'",
+                        (int(time.time() + JOB_LEASE_SECONDS), OWNER))
+
+async def _renew_forever():
+    while True:
+        # Renewed three times per lease, so one slow write doesn't lose it
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            await renew_leases()
+        except Exception:
+            log.exception("Job lease renewal failed")
+
+def is_retryable(e: Exception):
+    """Whether a failure is worth running the job again for"""
+    if isinstance(e, JobError):
+        return e.retryable
+    if isinstance(e, httpx.RequestError):
+        return True
+    return getattr(e, "status_code", None) in (429, 500, 502, 503, 504)
+
+async def _run(row: dict):
+    job = Job(row)
+    # Workers are long-lived tasks: log and call upstreams as the request that queued the job
+    token = logs.set_request_id(row.get("request_id") or f"job-{job.id}")
+    try:
+        await _execute(job)
+    finally:
+        logs.reset_request_id(token)
+
+async def _execute(job):
+    _notify(job.id)
+    handler = _handlers.get(job.kind)
+    try:
+        if handler is None:
+            raise JobError(f"No handler for job kind {job.kind!r}")
+        result = await handler(job)
+    except asyncio.CancelledError:
+        # Shutting down: leave it for the next start to resume from its checkpoint
+        await _update(job.id, status="queued")
+        raise
+    except Exception as e:
+        error = getattr(e, "detail", None) or str(e)
+        if is_retryable(e) and job.attempts < JOB_MAX_ATTEMPTS:
+            delay = min(JOB_BACKOFF_MAX, 2 ** job.attempts) * random.uniform(0.5, 1.0)
+            log.warning("Job attempt failed, retrying in %.1fs: %s", delay, error,
+                        extra={"job_id": job.id, "kind": job.kind, "attempt": job.attempts})
+            await _update(job.id, status="queued", error=error, run_after=int(time.time() + delay))
+        else:
+            log.error("Job failed: %s", error, extra={"job_id": job.id, "kind": job.kind, "attempt": job.attempts})
+            await _update(job.id, status="failed", error=error)
+        return
+    await _update(job.id, status="succeeded", step=None, error=None, result=json.dumps(result))
+
+async def _work():
+    while True:
+        try:
+            row = await store.run(_claim)
+        except Exception:
+            log.exception("Job claim failed")
+            row = None
+        if row is not None:
+            await _run(row)
+            continue
+        waiter = asyncio.ensure_future(_wakeup.wait())
+        try:
+            await asyncio.wait([waiter], timeout=JOB_POLL_SECONDS)
+        finally:
+            waiter.cancel()
+        _wakeup.clear()
+
+async def start_workers():
+    global _wakeup, _heartbeat
+    if _workers:
+        return
+    # Jobs left running by a process that died resume from their last
+    # checkpoint once their lease runs out; live processes keep theirs
+    _wakeup = asyncio.Event()
+    _heartbeat = asyncio.create_task(_renew_forever())
+    _workers.extend(asyncio.create_task(_work()) for _ in range(JOB_WORKERS))
+
+async def stop_workers():
+    global _wakeup, _heartbeat
+    for task in _workers:
+        task.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    # Interrupted jobs were put back in the queue; nothing left to renew
+    if _heartbeat is not None:
+        _heartbeat.cancel()
+        await asyncio.gather(_heartbeat, return_exceptions=True)
+        _heartbeat = None
+    _wakeup = None
+
+async def stats():
+    rows = await store.fetchall("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")
+    return {
+        "workers": len(_workers),
+        "owner": OWNER,
+        "watchers": sum(len(v) for v in _changed.values()),
+        **{r["status"]: r["n"] for r in rows},
+    }
@@ -0,0 +1,57 @@
+import json
+
+# Incremental parsing of a JSON object as it is generated. Claude's text arrives
+# a few characters at a time; FieldStream tracks nesting and string state and
+# hands back each top-level member as soon as its value is complete, so the UI
+# can show the title long before the description has finished.
+
+class FieldStream:
+    def __init__(self):
+        self.buf = ""
+        self.pos = 0
+        self.start = None  # index where the current top-level member begins
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.done = False
+
+    def feed(self, chunk: str):
+        """Add text; returns the (key, value) pairs completed by it"""
+        self.buf += chunk
+        fields = []
+        while self.pos < len(self.buf) and not self.done:
+            c = self.buf[self.pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == "\\":
+                    self.escape = True
+                elif c == '"':
+                    self.in_string = False
+            elif self.start is None:
+                # Anything before the opening brace (code fences, "json") is ignored
+                if c == "{":
+                    self.start, self.depth = self.pos + 1, 1
+            elif c == '"':
+                self.in_string = True
+            elif c in "{[":
+                self.depth += 1
+            elif c in "}]":
+                self.depth -= 1
+                if self.depth == 0:
+                    fields += self._member(self.buf[self.start:self.pos])
+                    self.done = True
+            elif c == "," and self.depth == 1:
+                fields += self._member(self.buf[self.start:self.pos])
+                self.start = self.pos + 1
+            self.pos += 1
+        return fields
+
+    def _member(self, text: str):
+        if not text.strip():
+            return []
+        try:
+            return list(json.loads("{" + text + "}").items())
+        except json.JSONDecodeError:
+            # Left to the final parse of the whole response to report
+            return []
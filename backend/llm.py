@@ -0,0 +1,267 @@
+import os, json, time, random, asyncio
+import httpx
+import upstream, accounting, metrics
+
+# Single client for the Anthropic Messages API. Every call gets an overall
+# deadline for its endpoint; transient failures (429, 529 overloaded, 5xx,
+# network errors) are retried with jittered exponential backoff, honouring
+# retry-after, for as long as the deadline allows. A circuit breaker counts
+# consecutive upstream failures and, once open, fails calls immediately until
+# a probe after LLM_BREAKER_COOLDOWN seconds succeeds. Token usage, including
+# prompt cache reads and writes, is totalled per endpoint and each call's usage
+# is recorded for the shop it was made for (see accounting.py).
+
+CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY")
+ANTHROPIC_VERSION = "2023-06-01"
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "8"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+# Seconds a whole call, retries included, may take per endpoint
+DEADLINES = {
+    "generate": float(os.getenv("LLM_DEADLINE_GENERATE", "60")),
+    "bundle": float(os.getenv("LLM_DEADLINE_BUNDLE", "45")),
+    "announcement": float(os.getenv("LLM_DEADLINE_ANNOUNCEMENT", "90")),
+    "test": float(os.getenv("LLM_DEADLINE_TEST", "15")),
+}
+
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+# Token counts summed from each response's usage
+USAGE_FIELDS = accounting.USAGE_FIELDS
+
+class LLMError(Exception):
+    def __init__(self, detail: str, status_code: int = None, http_status: int = 500):
+        super().__init__(detail)
+        self.detail = detail
+        self.status_code = status_code  # Anthropic's status, if it answered
+        self.http_status = http_status  # status to answer our own client with
+
+def headers(api_key: str = None):
+    return {
+        "x-api-key": api_key or CLAUDE_API_KEY,
+        "anthropic-version": ANTHROPIC_VERSION,
+        "content-type": "application/json"
+    }
+
+def error_detail(response: httpx.Response):
+    error_detail = f"Claude API error: {response.status_code}"
+    if response.status_code == 401:
+        error_detail = "Invalid Claude API key. Please check your CLAUDE_API_KEY in .env file."
+    elif response.status_code == 404:
+        error_detail = "Claude API endpoint not found (404). Please verify your API key and endpoint are correct."
+    elif response.status_code == 429:
+        error_detail = "Claude API rate limit exceeded. Please try again later."
+    try:
+        error_data = response.json()
+        if "error" in error_data:
+            error_detail = error_data["error"].get("message", error_detail)
+    except Exception:
+        error_detail = f"{error_detail} - Response: {response.text[:200]}"
+    return error_detail
+
+def response_text(response: dict) -> str:
+    """Text of the first content block of a Messages response"""
+    blocks = response.get("content") or []
+    if not blocks:
+        raise LLMError("Claude API returned empty response")
+    text = (blocks[0].get("text") or "").strip()
+    if not text:
+        raise LLMError("Claude API returned empty text content")
+    return text
+
+def parse_json(response: dict, required: tuple = ()) -> dict:
+    """The JSON object a Messages response was asked for. Tolerates ```json fences
+    and prose around the object; LLMError if it is missing a required field."""
+    text = response_text(response)
+    if text.startswith("```"):
+        # Drop the opening fence and its language tag, and the closing fence
+        text = text.split("\n", 1)[1] if "\n" in text else text.strip("`")
+        if text.rstrip().endswith("```"):
+            text = text.rstrip()[:-3]
+        text = text.strip()
+    if text.lower().startswith("json"):
+        text = text[4:].strip()
+    first, last = text.find("{"), text.rfind("}")
+    if first != -1 and last > first:
+        text = text[first:last + 1]
+    try:
+        value = json.loads(text)
+    except json.JSONDecodeError as e:
+        start = max(0, e.pos - 100)
+        raise LLMError(f"Claude returned invalid JSON at position {e.pos}: {e}. "
+                       f"Context: ...{text[start:e.pos + 100]}...")
+    missing = [f for f in required if not isinstance(value, dict) or f not in value]
+    if missing:
+        raise LLMError(f"Invalid response format: missing required fields: {', '.join(missing)}")
+    return value
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.rejected = 0
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.cooldown else "open"
+
+    def check(self):
+        """Raise instead of calling upstream while open. Once the cooldown is
+        over one probe is let through; returns True for that call."""
+        state = self.state
+        if state == "closed":
+            return False
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return True
+        self.rejected += 1
+        raise LLMError("Claude API is temporarily unavailable. Please try again shortly.", http_status=503)
+
+    def success(self):
+        self.failures, self.opened_at, self.probing = 0, None, False
+
+    def failure(self):
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.threshold):
+            if self.opened_at is None:
+                self.trips += 1
+            self.opened_at, self.probing = time.monotonic(), False
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
+breaker = CircuitBreaker(LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN)
+
+_stats = {}
+
+def _endpoint_stats(endpoint: str):
+    s = _stats.get(endpoint)
+    if s is None:
+        s = _stats[endpoint] = {"calls": 0, "succeeded": 0, "failed": 0, "retries": 0, "seconds": 0.0,
+                                **{field: 0 for field in USAGE_FIELDS}}
+    return s
+
+def record_usage(endpoint: str, usage: dict, model: str = None, seconds: float = None, **attribution):
+    """Add a response's usage (input, output and prompt cache tokens) to endpoint's
+    totals and queue it for the usage table. attribution (shop, product_id)
+    defaults to accounting.attribute's."""
+    s = _endpoint_stats(endpoint)
+    for field in USAGE_FIELDS:
+        tokens = (usage or {}).get(field) or 0
+        s[field] += tokens
+        if tokens:
+            metrics.claude_tokens.inc(tokens, endpoint=endpoint, type=field.removesuffix("_tokens"))
+    accounting.record(endpoint, model, usage, seconds, **attribution)
+
+def _backoff(attempt: int, response: httpx.Response = None):
+    if response is not None:
+        try:
+            return float(response.headers["retry-after"])
+        except (KeyError, ValueError):
+            pass
+    # Full jitter: concurrent callers that failed together retry apart
+    return random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+
+async def _send(payload: dict, endpoint: str, stream: bool):
+    deadline = time.monotonic() + DEADLINES.get(endpoint, DEADLINES["generate"])
+    client = upstream.claude_client()
+    attempt = 0
+    while True:
+        probe = breaker.check()
+        response, remaining = None, deadline - time.monotonic()
+        try:
+            async with asyncio.timeout(remaining):
+                request = client.build_request("POST", upstream.claude_url("/v1/messages"),
+                                               headers=headers(), json=payload)
+                response = await client.send(request, stream=stream)
+        except asyncio.CancelledError:
+            if probe:
+                breaker.probing = False
+            raise
+        except TimeoutError:
+            breaker.failure()
+            raise LLMError(f"Claude API did not respond within the {endpoint} deadline", http_status=504)
+        except httpx.RequestError as e:
+            breaker.failure()
+            error = LLMError(f"Network error connecting to Claude API: {str(e)}")
+        else:
+            if response.status_code == 200:
+                breaker.success()
+                return response
+            if stream:
+                await response.aread()
+                await response.aclose()
+            error = LLMError(f"AI generation failed: {error_detail(response)}", response.status_code)
+            if response.status_code >= 500:
+                breaker.failure()
+            else:
+                # Anthropic answered, so it is up; the request was rejected or rate limited
+                breaker.success()
+            if response.status_code not in RETRY_STATUSES:
+                raise error
+        delay = _backoff(attempt, response)
+        if attempt >= LLM_MAX_RETRIES or time.monotonic() + delay >= deadline:
+            raise error
+        attempt += 1
+        _endpoint_stats(endpoint)["retries"] += 1
+        await asyncio.sleep(delay)
+
+async def _call(payload: dict, endpoint: str, stream: bool):
+    s = _endpoint_stats(endpoint)
+    s["calls"] += 1
+    started = time.monotonic()
+    try:
+        response = await _send(payload, endpoint, stream)
+    except LLMError:
+        s["failed"] += 1
+        raise
+    finally:
+        s["seconds"] += time.monotonic() - started
+    s["succeeded"] += 1
+    return response
+
+async def messages(payload: dict, endpoint: str = "generate"):
+    """Messages API response body for payload"""
+    started = time.monotonic()
+    response = await _call(payload, endpoint, stream=False)
+    data = response.json()
+    record_usage(endpoint, data.get("usage"), data.get("model") or payload.get("model"),
+                 time.monotonic() - started)
+    return data
+
+async def stream(payload: dict, endpoint: str = "generate"):
+    """Open a streaming Messages request. Retries apply until the response
+    headers arrive; the caller reads the events, must aclose() it and
+    passes the usage, model and duration it saw to record_usage."""
+    return await _call({**payload, "stream": True}, endpoint, stream=True)
+
+def _cache_read_ratio(s: dict):
+    """Share of input tokens served from the prompt cache"""
+    total = s["input_tokens"] + s["cache_creation_input_tokens"] + s["cache_read_input_tokens"]
+    return round(s["cache_read_input_tokens"] / total, 4) if total else None
+
+def stats():
+    return {
+        "breaker": breaker.stats(),
+        "endpoints": {
+            name: {**s, "seconds": round(s["seconds"], 3),
+                   "avg_seconds": round(s["seconds"] / s["calls"], 3) if s["calls"] else None,
+                   "cache_read_ratio": _cache_read_ratio(s)}
+            for name, s in _stats.items()
+        },
+    }
@@ -0,0 +1,145 @@
+import os, re, sys, copy, json, time, uuid, queue, logging, contextvars, logging.handlers
+
+# Structured logging that never blocks the event loop on stdout: handlers only
+# put records on a bounded queue and a listener thread formats and writes them
+# (one JSON object per line by default). When the queue is full, records are
+# dropped and counted rather than waited on.
+#
+# Every HTTP request gets a request ID (the caller's X-Request-ID if it sent a
+# sane one) that is attached to each record logged while handling it, echoed
+# in the response, and sent as X-Request-ID on its Shopify and Anthropic calls.
+# Jobs carry the ID of the request that queued them.
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")  # json | text
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# One line per request with its route, status and duration
+LOG_ACCESS = os.getenv("LOG_ACCESS", "true").lower() in ("1", "true", "yes")
+
+_request_id = contextvars.ContextVar("request_id", default=None)
+_VALID_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+
+_stats = {"dropped": 0}
+_plain = logging.Formatter()
+_listener = None
+
+def request_id():
+    return _request_id.get()
+
+def set_request_id(value: str):
+    """Use value as the request ID for the rest of this task and tasks it starts"""
+    return _request_id.set(value)
+
+def reset_request_id(token):
+    _request_id.reset(token)
+
+def new_request_id(incoming: str = None) -> str:
+    return incoming if incoming and _VALID_ID.match(incoming) else uuid.uuid4().hex
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _stats["dropped"] += 1
+
+    def prepare(self, record):
+        # The record is read on the listener thread: take the request ID now, and
+        # render args and tracebacks, which may not be safe to hold on to
+        record = copy.copy(record)
+        record.request_id = _request_id.get()
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = _plain.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+# Attributes every LogRecord has; anything else came in through extra=
+_STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        entry.update({k: v for k, v in vars(record).items() if k not in _STANDARD})
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    def format(self, record):
+        fields = {k: v for k, v in vars(record).items() if k not in _STANDARD}
+        request = f" [{record.request_id}]" if getattr(record, "request_id", None) else ""
+        line = f"{record.levelname} {record.name}{request}: {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{k}={v}" for k, v in fields.items())
+        return line + (f"\n{record.exc_text}" if record.exc_text else "")
+
+def setup():
+    """Route every logger through the queue; the listener thread writes to stdout"""
+    global _listener
+    if _listener is not None:
+        return
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JSONFormatter() if LOG_FORMAT == "json" else TextFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [_DroppingQueueHandler(records)]
+    root.setLevel(LOG_LEVEL)
+    # httpx logs every call at INFO; /metrics already counts them
+    logging.getLogger("httpx").setLevel(max(logging.WARNING, root.level))
+    _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+def shutdown():
+    """Write out what is still queued"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def stats():
+    return {**_stats, "level": LOG_LEVEL, "format": LOG_FORMAT}
+
+access_log = logging.getLogger("access")
+
+class RequestIdMiddleware:
+    """Assigns each request its ID, returns it as X-Request-ID and logs the request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        headers = dict(scope.get("headers") or [])
+        rid = new_request_id(headers.get(b"x-request-id", b"").decode("latin-1"))
+        token, started, status = _request_id.set(rid), time.perf_counter(), 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = {**message, "headers": [*message.get("headers", []), (b"x-request-id", rid.encode())]}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            if LOG_ACCESS:
+                access_log.info("%s %s %s", scope["method"], scope["path"], status, extra={
+                    "method": scope["method"], "path": scope["path"], "status": status,
+                    "duration_ms": round((time.perf_counter() - started) * 1000, 1)})
+            _request_id.reset(token)
+
+async def tag_outbound(request):
+    """httpx request hook: pass the request ID on to upstream APIs"""
+    rid = _request_id.get()
+    if rid:
+        request.headers["X-Request-ID"] = rid
@@ -1,21 +1,89 @@
-import os, json, time, hmac, base64, hashlib, sqlite3
+import os, json, time, hmac, base64, hashlib, asyncio, logging
+from contextlib import asynccontextmanager
 from urllib.parse import urlencode, quote
-from fastapi import FastAPI, Request, HTTPException
+from fastapi import FastAPI, Request, Response, HTTPException, BackgroundTasks, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import RedirectResponse, StreamingResponse, PlainTextResponse
 from dotenv import load_dotenv
 import httpx
 
-# Load environment variables from .env file
+# Load environment variables from .env file; before the local imports below,
+# which read their settings at import time
 load_dotenv()
 
+import upstream
+import store
+import shopify
+import cache
+import catalog
+import webhooks
+import suggestions
+import singleflight
+import claude_batches
+import json_stream
+import llm
+import jobs
+import themes
+import prompting
+import accounting
+import metrics
+import logs
+import profiler
+import similarity
+import orders
+import cooccurrence
+from suggestions import suggestion_cache
+from shopify import ShopifyError
+
 APP_URL = os.getenv("APP_URL")
 FRONTEND_URL = os.getenv("FRONTEND_URL")
 SHOPIFY_API_KEY = os.getenv("SHOPIFY_API_KEY")
 SHOPIFY_API_SECRET = os.getenv("SHOPIFY_API_SECRET")
 CLAUDE_API_KEY = os.getenv("CLAUDE_API_KEY")
+CLAUDE_MODEL = os.getenv("CLAUDE_MODEL", "claude-sonnet-4-20250514")
+
+# Batch generation: default/max Claude calls in flight per batch request, and
+# across all batch requests in this process (keeps us under Anthropic limits)
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+BATCH_GLOBAL_CONCURRENCY = int(os.getenv("BATCH_GLOBAL_CONCURRENCY", "8"))
+BATCH_MAX_PRODUCTS = int(os.getenv("BATCH_MAX_PRODUCTS", "500"))
+batch_claude_slots = asyncio.Semaphore(BATCH_GLOBAL_CONCURRENCY)
+
+# shop -> access_token, filled on OAuth callback and evicted on logout.
+# Set token_cache.shared to a shared store to keep multiple workers coherent.
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "300"))
+token_cache = cache.TTLCache("shop_tokens", TOKEN_CACHE_SIZE, TOKEN_CACHE_TTL)
+
+log = logging.getLogger(__name__)
 
-app = FastAPI()
+def log_shopify_error(status_code: int, text: str):
+    log.warning("Shopify API error", extra={"status": status_code, "body": text[:1000]})
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Schema migration runs once here; shared upstream connection pools and the
+    # DB worker pool live for the lifetime of the app
+    logs.setup()
+    store.init_db()
+    upstream.open_clients()
+    await webhooks.prune()
+    claude_batches.start_poller(CLAUDE_API_KEY)
+    accounting.start_flusher()
+    suggestions.start_sweeper()
+    await jobs.start_workers()
+    yield
+    await jobs.stop_workers()
+    await claude_batches.stop_poller()
+    await accounting.stop_flusher()
+    await suggestions.stop_sweeper()
+    await upstream.close_clients()
+    store.close_db()
+    profiler.stop()
+    logs.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS configuration - use FRONTEND_URL in production, allow all in development
 cors_origins = [FRONTEND_URL] if FRONTEND_URL and FRONTEND_URL != "http://localhost:3000" and FRONTEND_URL != "http://127.0.0.1:3000" else ["*"]
@@ -26,32 +94,32 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets the browser's devtools show the Server-Timing breakdown cross-origin
+    expose_headers=["Server-Timing", "X-Request-ID"],
 )
-
-def db():
-    conn = sqlite3.connect("app.db")
-    conn.row_factory = sqlite3.Row
-    conn.execute("""CREATE TABLE IF NOT EXISTS shops(
-      id INTEGER PRIMARY KEY, shop TEXT UNIQUE, access_token TEXT
-    )""")
-    conn.execute("""CREATE TABLE IF NOT EXISTS runs(
-      id INTEGER PRIMARY KEY, shop TEXT, product_id TEXT, cost_tokens INTEGER, created_at INTEGER
-    )""")
-    return conn
+# Added last is outermost: the request ID is set before metrics and profiling run
+app.add_middleware(profiler.ProfilerMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+app.add_middleware(logs.RequestIdMiddleware)
 
 def hmac_valid(params: dict, hmac_val: str) -> bool:
     sorted_params = "&".join([f"{k}={v}" for k,v in sorted(params.items()) if k != "hmac"])
     digest = hmac.new(SHOPIFY_API_SECRET.encode(), sorted_params.encode(), hashlib.sha256).hexdigest()
     return hmac.compare_digest(digest, hmac_val)
 
+def webhook_hmac_valid(body: bytes, hmac_header: str) -> bool:
+    # Webhooks sign the raw request body and send the digest base64-encoded
+    digest = base64.b64encode(hmac.new(SHOPIFY_API_SECRET.encode(), body, hashlib.sha256).digest()).decode()
+    return hmac.compare_digest(digest, hmac_header or "")
+
 @app.get("/auth/install")
 async def install(shop: str):
     # Request all scopes needed for product launch optimization
     # Note: Merchant must approve these scopes during OAuth installation
     # If you get "requires merchant approval" errors, re-install the app to get fresh approval
     # Required scopes: read_products (view products), write_products (edit products), 
-    # read_content, write_content, write_discounts
-    scopes = "read_products,write_products,read_content,write_content,write_discounts,read_themes,write_themes"
+    # read_content, write_content, write_discounts, read_orders (bundle pairs from purchases)
+    scopes = "read_products,write_products,read_content,write_content,write_discounts,read_themes,write_themes,read_orders"
     redirect_uri = f"{APP_URL}/auth/callback"
     state = "nonce123"  # add a real nonce in production
     q = urlencode({
@@ -61,49 +129,196 @@ async def install(shop: str):
     return {"install_url": f"https://{shop}/admin/oauth/authorize?{q}"}
 
 @app.get("/auth/callback")
-async def callback(shop: str, code: str, state: str, hmac: str, request: Request):
+async def callback(shop: str, code: str, state: str, hmac: str, request: Request, background_tasks: BackgroundTasks):
     params = dict(request.query_params)
     if not hmac_valid(params, hmac): raise HTTPException(400, "Invalid HMAC")
-    async with httpx.AsyncClient() as client:
-        r = await client.post(f"https://{shop}/admin/oauth/access_token.json", json={
-            "client_id": SHOPIFY_API_KEY, "client_secret": SHOPIFY_API_SECRET, "code": code
-        })
+    r = await upstream.shopify_client().post(f"https://{shop}/admin/oauth/access_token.json", json={
+        "client_id": SHOPIFY_API_KEY, "client_secret": SHOPIFY_API_SECRET, "code": code
+    })
     if r.status_code != 200: raise HTTPException(400, "Token exchange failed")
     token = r.json()["access_token"]
-    c = db()
-    c.execute("INSERT OR REPLACE INTO shops(shop, access_token) VALUES(?,?)", (shop, token))
-    c.commit()
+    await store.save_shop(shop, token)
+    await token_cache.aset(shop, token)
+    # Subscribe to catalog/uninstall webhooks after the redirect has gone out
+    background_tasks.add_task(webhooks.register, shop, token, APP_URL)
     # Redirect back to frontend with success
     return RedirectResponse(url=f"{FRONTEND_URL}?shop={shop}&connected=true")
 
-def shopify_headers(token: str):
-    return {"X-Shopify-Access-Token": token, "Content-Type": "application/json", "Accept": "application/json"}
+async def get_access_token(shop: str):
+    # Checked in-process first so hot paths skip the SQLite round trip
+    token = await token_cache.aget(shop)
+    if token is None:
+        row = await store.get_shop(shop)
+        if row:
+            token = row["access_token"]
+            await token_cache.aset(shop, token)
+    return token
+
+async def require_token(shop: str) -> str:
+    token = await get_access_token(shop)
+    if not token: raise HTTPException(401, "Not connected")
+    return token
+
+async def process_webhook(shop: str, topic: str, payload: dict):
+    try:
+        if topic in ("products/create", "products/update"):
+            await catalog.upsert(shop, [payload], newer_only=True)
+        elif topic == "products/delete":
+            await catalog.delete(shop, payload["id"])
+        elif topic == "orders/create":
+            await orders.ingest(shop, [payload])
+        elif topic == "themes/publish":
+            # A different theme is live now; rediscover it on the next publish
+            await themes.forget(shop)
+        elif topic == "app/uninstalled":
+            # Token is already revoked on Shopify's side; drop every local copy
+            await store.delete_shop(shop)
+            await token_cache.adelete(shop)
+            await webhooks.forget(shop)
+            return
+        resource = webhooks.RESOURCES.get(topic)
+        if resource:
+            await webhooks.mark_changed(shop, resource)
+    except Exception:
+        log.exception("Webhook processing failed", extra={"shop": shop, "topic": topic})
+
+@app.post("/webhooks")
+async def receive_webhook(request: Request, background_tasks: BackgroundTasks):
+    """HMAC-verified receiver for every subscribed Shopify webhook topic"""
+    body = await request.body()
+    if not webhook_hmac_valid(body, request.headers.get("x-shopify-hmac-sha256")):
+        raise HTTPException(401, "Invalid webhook HMAC")
+    shop = request.headers.get("x-shopify-shop-domain", "")
+    topic = request.headers.get("x-shopify-topic", "")
+    webhook_id = request.headers.get("x-shopify-webhook-id") or hashlib.sha256(body).hexdigest()
+    # Parsed before the receipt is recorded, so a bad body isn't remembered as handled
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        raise HTTPException(400, "Invalid webhook body")
+    # Shopify retries deliveries; acknowledge duplicates without reprocessing
+    if not await webhooks.record_receipt(webhook_id, shop, topic):
+        return {"ok": True, "duplicate": True}
+    # Acknowledge immediately and process after the response is sent
+    background_tasks.add_task(process_webhook, shop, topic, payload)
+    return {"ok": True}
 
 @app.get("/api/shops/me")
-def me(shop: str):
-    c = db()
-    row = c.execute("SELECT * FROM shops WHERE shop = ?", (shop,)).fetchone()
-    return {"connected": bool(row)}
+async def me(shop: str):
+    return {"connected": bool(await get_access_token(shop))}
 
 @app.delete("/api/shops/logout")
-def logout(shop: str):
-    c = db()
-    c.execute("DELETE FROM shops WHERE shop = ?", (shop,))
-    c.commit()
+async def logout(shop: str):
+    await store.delete_shop(shop)
+    await token_cache.adelete(shop)
     return {"ok": True, "message": "Logged out successfully"}
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Request, upstream, DB and Claude token metrics in the Prometheus text format"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/logs/stats")
+async def logs_stats():
+    """Log level and format, and records dropped because the log queue was full"""
+    return logs.stats()
+
+def require_profiler(token: str):
+    if not profiler.enabled():
+        raise HTTPException(404, "Profiler is disabled: set PROFILER_TOKEN")
+    if not hmac.compare_digest(token or "", profiler.PROFILER_TOKEN):
+        raise HTTPException(403, "Invalid profiler token")
+
+@app.post("/api/profiler/start")
+async def profiler_start(data: dict = None, x_profiler_token: str = Header(None)):
+    """Profile this worker's requests for a while, keeping the slowest ones"""
+    require_profiler(x_profiler_token)
+    data = data or {}
+    return profiler.start(float(data.get("seconds", 60)), int(data.get("keep", 10)),
+                          float(data.get("interval_ms", 5)), float(data.get("sample_rate", 1.0)))
+
+@app.post("/api/profiler/stop")
+async def profiler_stop(x_profiler_token: str = Header(None)):
+    require_profiler(x_profiler_token)
+    return profiler.stop()
+
+@app.get("/api/profiler")
+async def profiler_status(x_profiler_token: str = Header(None)):
+    """Current session and the slowest requests profiled so far, slowest first"""
+    require_profiler(x_profiler_token)
+    return profiler.status()
+
+@app.get("/api/profiler/{request_id}")
+async def profiler_profile(request_id: str, x_profiler_token: str = Header(None)):
+    """Collapsed stacks of one kept request, for flamegraph.pl or speedscope"""
+    require_profiler(x_profiler_token)
+    profile = profiler.profile(request_id)
+    if profile is None:
+        raise HTTPException(404, "No profile kept for that request")
+    return PlainTextResponse(profile.collapsed())
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    """Hit/miss counters for the in-process caches"""
+    return cache.stats()
+
+@app.get("/api/singleflight/stats")
+async def singleflight_stats():
+    """Coalesced vs issued upstream calls per single-flight group"""
+    return singleflight.stats()
+
+@app.get("/api/llm/stats")
+async def llm_stats():
+    """Claude call/retry counts per endpoint and circuit breaker state"""
+    return llm.stats()
+
+@app.get("/api/usage")
+async def usage(shop: str, days: int = 30):
+    """Claude token usage and estimated cost of one installed shop, per day and per endpoint"""
+    await require_token(shop)
+    if not 1 <= days <= 366:
+        raise HTTPException(400, "days must be between 1 and 366")
+    return await accounting.summary(shop, days)
+
+@app.get("/api/usage/stats")
+async def usage_stats():
+    """Usage recorder buffer and flush counters"""
+    return accounting.stats()
+
+@app.get("/api/prompting/stats")
+async def prompting_stats():
+    """Estimated product tokens sent per prompt kind, and saved against raw product dumps"""
+    return prompting.stats()
+
+@app.get("/api/similarity/stats")
+async def similarity_stats():
+    """Product similarity indexes held by this worker: size, rebuilds and queries"""
+    return similarity.stats()
+
+@app.get("/api/orders/stats")
+async def orders_stats():
+    """Orders and line items ingested, and the co-occurrence matrices held by this worker"""
+    return {"ingest": orders.stats(), "cooccurrence": cooccurrence.stats()}
+
+@app.get("/api/shopify/stats")
+async def shopify_stats():
+    """Per-shop Admin API bucket level, queue depth by priority and throttling counts"""
+    return shopify.stats()
+
 @app.get("/api/products")
-async def list_products(shop: str, limit: int = 10):
-    c = db()
-    row = c.execute("SELECT * FROM shops WHERE shop = ?", (shop,)).fetchone()
-    if not row: raise HTTPException(401, "Not connected")
-    async with httpx.AsyncClient() as client:
-        r = await client.get(f"https://{shop}/admin/api/2024-01/products.json?limit={limit}", headers=shopify_headers(row["access_token"]))
-    if r.status_code != 200:
-        error_msg = r.text
-        print(f"Shopify API Error ({r.status_code}): {error_msg}")  # Log to console
+async def list_products(shop: str, limit: int = 10, cursor: str = None, q: str = None, fields: str = None):
+    """Products from the local catalog mirror, with cursor pagination, search and field projection"""
+    # Cursors are the last product ID of the previous page
+    if cursor is not None and not (cursor.isascii() and cursor.isdigit()):
+        raise HTTPException(400, "Invalid cursor")
+    token = await require_token(shop)
+    try:
+        await catalog.ensure_fresh(shop, token)
+    except ShopifyError as e:
+        error_msg = e.text
+        log_shopify_error(e.status_code, error_msg)
         # Check for scope approval error
-        if r.status_code == 403 and "merchant approval" in error_msg.lower():
+        if e.status_code == 403 and "merchant approval" in error_msg.lower():
             raise HTTPException(403, {
                 "error": "scope_approval_required",
                 "message": "The read_products scope requires merchant approval.",
@@ -115,12 +330,39 @@ async def list_products(shop: str, limit: int = 10):
                     "5. Try loading products again"
                 ]
             })
-        raise HTTPException(400, f"Failed to fetch products (Status {r.status_code}): {error_msg}")
-    return r.json()
+        raise HTTPException(e.http_status, f"Failed to fetch products (Status {e.status_code}): {error_msg}")
+    return await catalog.list_page(shop, limit, cursor, q, fields)
+
+@app.post("/api/products/sync")
+async def sync_products(shop: str, full: bool = False, bulk: bool = None):
+    """Refresh the local catalog mirror now (full re-sync or incremental). A full
+    re-sync uses a bulk operation for large catalogs, or as bulk forces."""
+    token = await require_token(shop)
+    try:
+        count = await (catalog.full_sync(shop, token, bulk) if full else catalog.incremental_sync(shop, token))
+    except ShopifyError as e:
+        log_shopify_error(e.status_code, e.text)
+        raise HTTPException(e.http_status, f"Failed to sync products (Status {e.status_code}): {e.text}")
+    return {"ok": True, "synced": count}
+
+@app.post("/api/orders/sync", status_code=202)
+async def sync_orders(shop: str, full: bool = False, bulk: bool = None):
+    """Queue ingestion of the shop's orders for bundle co-occurrence; progress at
+    /api/jobs/{job_id}. Incremental unless full; bulk as for /api/products/sync."""
+    await require_token(shop)
+    job_id = await jobs.enqueue(shop, "orders_sync", {"full": full, "bulk": bulk})
+    return {"job_id": job_id, "status": "queued"}
+
+async def run_orders_sync(job: jobs.Job):
+    token = await require_token(job.shop)
+    count = await job.step("sync", lambda: orders.sync(job.shop, token, job.payload["full"], job.payload["bulk"]))
+    return {"ok": True, "orders": count}
+
+jobs.register("orders_sync", run_orders_sync)
 
 CLAUDE_PROMPT = """You are an ecommerce launch assistant.
 
-Given raw product JSON, produce a JSON object with these exact fields:
+Given product JSON, produce a JSON object with these exact fields:
 
 - title: Optimized product title
 - description_html: Concise, persuasive HTML description with bullet points
@@ -132,128 +374,158 @@ Given raw product JSON, produce a JSON object with these exact fields:
 - discount_percent: Integer between 5 and 30
 - banner_copy: Short announcement bar copy for the launch
 
-Return ONLY valid JSON, no markdown code blocks, no explanations.
+Return ONLY valid JSON, no markdown code blocks, no explanations."""
 
-Product JSON:
+def claude_request(instructions: str, content: str, max_tokens: int):
+    """Messages API params with the fixed instructions as a cached system block
+    and only the per-request part in the user turn"""
+    return {
+        "model": CLAUDE_MODEL,
+        "max_tokens": max_tokens,
+        # Anthropic caches the prefix up to this marker for 5 minutes, so
+        # repeated generations (batches especially) reuse it instead of
+        # re-reading it; prefixes under the model's minimum are not cached
+        "system": [{"type": "text", "text": instructions, "cache_control": {"type": "ephemeral"}}],
+        "messages": [{"role": "user", "content": content}]
+    }
 
-```json
-{product_json}
-```"""
+def suggestion_request(product_json: dict, record: bool = True):
+    """Messages API params for one launch-asset suggestion. Build it only for a
+    prompt about to be sent: it is counted in /api/prompting/stats unless record is False."""
+    product_text = prompting.product_json(product_json)
+    if record:
+        prompting.record("generate", product_json, product_text)
+    return claude_request(CLAUDE_PROMPT, f"Product JSON:\n\n```json\n{product_text}\n```", 2000)
+
+def claude_json(response_data: dict, required: tuple = ()):
+    """llm.parse_json with its errors turned into HTTP errors"""
+    try:
+        return llm.parse_json(response_data, required)
+    except llm.LLMError as e:
+        raise HTTPException(e.http_status, e.detail) from e
+
+def parse_suggestion(response_data: dict):
+    return claude_json(response_data)
+
+async def claude_messages(payload: dict, endpoint: str):
+    """llm.messages with its errors turned into HTTP errors"""
+    try:
+        return await llm.messages(payload, endpoint)
+    except llm.LLMError as e:
+        raise HTTPException(e.http_status, e.detail) from e
 
 async def call_claude(product_json: dict):
     if not CLAUDE_API_KEY:
         raise ValueError("CLAUDE_API_KEY is not set in environment variables")
     
-    prompt = CLAUDE_PROMPT.replace("{product_json}", json.dumps(product_json)[:8000])
-    headers = {
-        "x-api-key": CLAUDE_API_KEY,
-        "anthropic-version": "2023-06-01",
-        "content-type": "application/json"
-    }
-    payload = {
-        "model": "claude-sonnet-4-20250514",
-        "max_tokens": 2000,
-        "messages": [{"role": "user", "content": prompt}]
-    }
-    
+    response_data = await claude_messages(suggestion_request(product_json), "generate")
+    return parse_suggestion(response_data)
+
+async def stream_claude(payload: dict, message: dict, endpoint: str):
+    """Yield text as it is generated. When the stream ends, message holds the
+    content and stop_reason in the same shape as a non-streaming response."""
+    text, started = [], time.monotonic()
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            r = await client.post("https://api.anthropic.com/v1/messages", headers=headers, json=payload)
-            r.raise_for_status()
-            response_data = r.json()
-    except httpx.HTTPStatusError as e:
-        error_detail = f"Claude API error: {e.response.status_code}"
-        if e.response.status_code == 401:
-            error_detail = "Invalid Claude API key. Please check your CLAUDE_API_KEY in .env file."
-        elif e.response.status_code == 404:
-            error_detail = "Claude API endpoint not found (404). Please verify your API key and endpoint are correct."
-        elif e.response.status_code == 429:
-            error_detail = "Claude API rate limit exceeded. Please try again later."
-        try:
-            error_data = e.response.json()
-            if "error" in error_data:
-                error_detail = error_data["error"].get("message", error_detail)
-        except:
-            error_detail = f"{error_detail} - Response: {e.response.text[:200]}"
-        raise HTTPException(500, f"AI generation failed: {error_detail}") from e
-    except httpx.RequestError as e:
-        raise HTTPException(500, f"Network error connecting to Claude API: {str(e)}") from e
-    
-    # Claude response format: content is an array of text blocks
-    content_blocks = response_data.get("content", [])
-    if not content_blocks or len(content_blocks) == 0:
-        raise HTTPException(500, "Claude API returned empty response")
-    
-    text = content_blocks[0].get("text", "").strip()
-    if not text:
-        raise HTTPException(500, "Claude API returned empty text content")
-    
-    # be resilient if model returns code fences
-    text = text.strip().strip("`")
-    if text.startswith("json"): 
-        text = text[4:].strip()
-    
+        r = await llm.stream(payload, endpoint)
+    except llm.LLMError as e:
+        raise HTTPException(e.http_status, e.detail) from e
+    try:
+        async for line in r.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            event = json.loads(line[5:])
+            if event["type"] == "content_block_delta" and event["delta"].get("type") == "text_delta":
+                text.append(event["delta"]["text"])
+                yield event["delta"]["text"]
+            elif event["type"] == "message_start":
+                message["model"] = event["message"].get("model")
+                message["usage"] = event["message"].get("usage", {})
+            elif event["type"] == "message_delta":
+                message["stop_reason"] = event["delta"].get("stop_reason")
+                message.setdefault("usage", {}).update(event.get("usage", {}))
+            elif event["type"] == "error":
+                raise HTTPException(500, f"AI generation failed: {event['error'].get('message')}")
+    finally:
+        await r.aclose()
+        llm.record_usage(endpoint, message.get("usage"), message.get("model") or payload.get("model"),
+                         time.monotonic() - started)
+    message["content"] = [{"type": "text", "text": "".join(text)}]
+
+def sse(event: str, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_generation(key: str, kind: str, payload: dict, parse, cached=None, first=()):
+    """Server-sent events for one generation: a field event for each top-level
+    field as soon as it is complete, then done with the validated object (the
+    same one the non-streaming endpoint returns), or error."""
+    for event, data in first:
+        yield sse(event, data)
+    if cached is not None:
+        for name, value in cached.items():
+            yield sse("field", {"name": name, "value": value})
+        yield sse("done", cached)
+        return
+    message, fields = {}, json_stream.FieldStream()
     try:
-        return json.loads(text)
-    except json.JSONDecodeError as e:
-        raise HTTPException(500, f"Claude returned invalid JSON: {str(e)}. Response: {text[:200]}")
+        async for text in stream_claude(payload, message, kind):
+            for name, value in fields.feed(text):
+                yield sse("field", {"name": name, "value": value})
+        result = parse(message)
+    except HTTPException as e:
+        yield sse("error", {"detail": e.detail})
+        return
+    except Exception as e:
+        yield sse("error", {"detail": f"AI generation failed: {str(e)}"})
+        return
+    await suggestion_cache.put(key, kind, result)
+    yield sse("done", result)
+
+async def cached_for_stream(key: str, kind: str, compute, force_refresh: bool):
+    """(value, status) from the suggestion cache, or (None, status) when the caller should stream a fresh generation"""
+    if force_refresh:
+        suggestion_cache.refreshes += 1
+        return None, "refresh"
+    value, _ = await suggestion_cache.lookup(key)
+    if value is None:
+        suggestion_cache.misses += 1
+        return None, "miss"
+    # Counts the hit and revalidates a stale entry in the background
+    return await suggestion_cache.get_or_compute(key, kind, compute)
+
+def event_stream(events, cache_status: str = None):
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if cache_status:
+        headers["X-Suggestion-Cache"] = cache_status
+    return StreamingResponse(events, media_type="text/event-stream", headers=headers)
 
 @app.get("/api/test-claude")
 async def test_claude():
     """Test endpoint to verify Claude API connection"""
-    print("Test Claude endpoint called")  # Debug log
     if not CLAUDE_API_KEY:
         return {"success": False, "error": "CLAUDE_API_KEY is not set in environment variables"}
     
     # Simple test prompt
     test_prompt = "Say 'Hello, Claude API is working!' and nothing else."
-    headers = {
-        "x-api-key": CLAUDE_API_KEY,
-        "anthropic-version": "2023-06-01",
-        "content-type": "application/json"
-    }
+    headers = llm.headers()
     payload = {
-        "model": "claude-sonnet-4-20250514",
+        "model": CLAUDE_MODEL,
         "max_tokens": 100,
         "messages": [{"role": "user", "content": test_prompt}]
     }
     
-    print(f"Testing Claude API with endpoint: https://api.anthropic.com/v1/messages")
-    print(f"Headers: {list(headers.keys())}")
-    print(f"Model: {payload['model']}")
+    log.info("Testing Claude API", extra={"url": upstream.claude_url("/v1/messages"),
+                                          "headers": list(headers.keys()), "model": payload["model"]})
     
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            r = await client.post("https://api.anthropic.com/v1/messages", headers=headers, json=payload)
-            print(f"Claude API Response Status: {r.status_code}")
-            if r.status_code != 200:
-                print(f"Claude API Response: {r.text[:500]}")
-            r.raise_for_status()
-            response_data = r.json()
-    except httpx.HTTPStatusError as e:
-        error_detail = f"Claude API error: {e.response.status_code}"
-        if e.response.status_code == 401:
-            error_detail = "Invalid Claude API key. Please check your CLAUDE_API_KEY in .env file."
-        elif e.response.status_code == 404:
-            error_detail = "Claude API endpoint not found (404). Please verify your API key and endpoint are correct."
-        elif e.response.status_code == 429:
-            error_detail = "Claude API rate limit exceeded. Please try again later."
-        try:
-            error_data = e.response.json()
-            if "error" in error_data:
-                error_detail = error_data["error"].get("message", error_detail)
-        except:
-            error_detail = f"{error_detail} - Response: {e.response.text[:200]}"
-        return {"success": False, "error": error_detail}
-    except httpx.RequestError as e:
-        return {"success": False, "error": f"Network error connecting to Claude API: {str(e)}"}
-    
-    # Parse response
-    content_blocks = response_data.get("content", [])
-    if not content_blocks or len(content_blocks) == 0:
-        return {"success": False, "error": "Claude API returned empty response"}
+        response_data = await llm.messages(payload, "test")
+    except llm.LLMError as e:
+        log.warning("Claude API test failed", extra={"status": e.status_code})
+        return {"success": False, "error": e.detail}
     
-    text = content_blocks[0].get("text", "").strip()
+    try:
+        text = llm.response_text(response_data)
+    except llm.LLMError as e:
+        return {"success": False, "error": e.detail}
     return {
         "success": True,
         "message": text,
@@ -261,214 +533,528 @@ async def test_claude():
         "usage": response_data.get("usage", {})
     }
 
+def suggestion_key(product: dict):
+    # Keyed on what Claude sees, so changes to fields it never gets are still hits
+    return suggestions.make_key("generate", prompting.product_json(product),
+                                suggestions.fingerprint(CLAUDE_PROMPT), CLAUDE_MODEL)
+
+async def generate_suggestion(product: dict, force_refresh: bool = False, slots=None):
+    """Cached launch-asset suggestion for one product; slots limits concurrent Claude calls"""
+    async def compute():
+        if slots is None:
+            return await call_claude(product)
+        async with slots, batch_claude_slots:
+            return await call_claude(product)
+    return await suggestion_cache.get_or_compute(suggestion_key(product), "generate", compute, force_refresh)
+
 @app.post("/api/generate")
-async def generate(data: dict):
+async def generate(data: dict, response: Response):
     shop = data["shop"]
     product_id = data["product_id"]
-    c = db()
-    row = c.execute("SELECT * FROM shops WHERE shop = ?", (shop,)).fetchone()
-    if not row: raise HTTPException(401, "Not connected")
-    async with httpx.AsyncClient() as client:
-        p = await client.get(f"https://{shop}/admin/api/2024-01/products/{product_id}.json", headers=shopify_headers(row["access_token"]))
-    if p.status_code != 200:
-        error_msg = p.text
-        print(f"Shopify API Error ({p.status_code}): {error_msg}")
-        raise HTTPException(400, f"Failed to fetch product (Status {p.status_code}): {error_msg}")
-    product = p.json()["product"]
+    token = await require_token(shop)
+    accounting.attribute(shop, product_id)
+    try:
+        product = await catalog.load_product(shop, token, product_id)
+    except ShopifyError as e:
+        log_shopify_error(e.status_code, e.text)
+        raise HTTPException(e.http_status, f"Failed to fetch product (Status {e.status_code}): {e.text}")
     try:
-        result = await call_claude(product)
+        result, cache_status = await generate_suggestion(product, bool(data.get("force_refresh")))
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, f"AI generation failed: {str(e)}")
+    response.headers["X-Suggestion-Cache"] = cache_status
     return {"product": product, "suggestion": result}
 
-@app.post("/api/apply")
-async def apply_changes(data: dict):
+@app.post("/api/generate/stream")
+async def generate_stream(data: dict):
+    """Streaming /api/generate: product, field..., then done or error events"""
     shop = data["shop"]
     product_id = data["product_id"]
-    s = data["suggestion"]
-    c = db()
-    row = c.execute("SELECT * FROM shops WHERE shop = ?", (shop,)).fetchone()
-    if not row: raise HTTPException(401, "Not connected")
-    token = row["access_token"]
-    
-    # 1) Update product fields
-    # Handle tags - convert array to comma-separated string if needed
+    token = await require_token(shop)
+    accounting.attribute(shop, product_id)
+    try:
+        product = await catalog.load_product(shop, token, product_id)
+    except ShopifyError as e:
+        log_shopify_error(e.status_code, e.text)
+        raise HTTPException(e.http_status, f"Failed to fetch product (Status {e.status_code}): {e.text}")
+    key = suggestion_key(product)
+    cached, cache_status = await cached_for_stream(
+        key, "generate", lambda: call_claude(product), bool(data.get("force_refresh")))
+    if cached is None and not CLAUDE_API_KEY:
+        raise HTTPException(500, "AI generation failed: CLAUDE_API_KEY is not set in environment variables")
+    # Cache hits send nothing to Claude
+    payload = suggestion_request(product) if cached is None else None
+    events = stream_generation(key, "generate", payload, parse_suggestion, cached, first=[("product", product)])
+    return event_stream(events, cache_status)
+
+async def load_batch_products(shop: str, token: str, product_ids: list, collection_id=None):
+    """(products, missing_ids) for a list of product IDs or a whole collection"""
+    try:
+        if collection_id:
+            return await catalog.load_collection(shop, token, collection_id), []
+        found = await catalog.load_products(shop, token, product_ids)
+        return ([found[int(i)] for i in product_ids if int(i) in found],
+                [i for i in product_ids if int(i) not in found])
+    except ShopifyError as e:
+        log_shopify_error(e.status_code, e.text)
+        raise HTTPException(e.http_status, f"Failed to fetch products (Status {e.status_code}): {e.text}")
+
+@app.post("/api/generate/batch")
+async def generate_batch(data: dict):
+    """Generate suggestions for many products; streams one NDJSON line per product as each completes"""
+    shop = data["shop"]
+    product_ids = data.get("product_ids") or []
+    collection_id = data.get("collection_id")
+    if not product_ids and not collection_id:
+        raise HTTPException(400, "Provide product_ids or collection_id")
+    concurrency = max(1, min(int(data.get("concurrency") or BATCH_CONCURRENCY), BATCH_MAX_CONCURRENCY))
+    force_refresh = bool(data.get("force_refresh"))
+    token = await require_token(shop)
+    products, missing = await load_batch_products(shop, token, product_ids, collection_id)
+    if len(products) > BATCH_MAX_PRODUCTS:
+        raise HTTPException(400, f"Batch too large: {len(products)} products (max {BATCH_MAX_PRODUCTS})")
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def one(product):
+        accounting.attribute(shop, product["id"])
+        try:
+            result, cache_status = await generate_suggestion(product, force_refresh, slots)
+            return {"product_id": product["id"], "ok": True, "suggestion": result, "cache": cache_status}
+        except Exception as e:
+            # One product failing must not fail the batch
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            return {"product_id": product["id"], "ok": False, "error": detail}
+
+    async def results():
+        succeeded = 0
+        for product_id in missing:
+            yield json.dumps({"product_id": product_id, "ok": False, "error": "Product not found"}) + "\n"
+        tasks = [asyncio.create_task(one(p)) for p in products]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                item = await next_done
+                succeeded += item["ok"]
+                yield json.dumps(item) + "\n"
+        finally:
+            # Client went away: stop generating for it
+            for task in tasks:
+                task.cancel()
+        total = len(products) + len(missing)
+        yield json.dumps({"done": True, "total": total, "succeeded": succeeded, "failed": total - succeeded}) + "\n"
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
+
+async def store_batch_suggestion(item: dict, message: dict):
+    # Batch results land in the suggestion cache, so /api/generate serves them instantly
+    value = parse_suggestion(message)
+    if item.get("cache_key"):
+        await suggestion_cache.put(item["cache_key"], "generate", value)
+    return value
+
+claude_batches.on_result("generate", store_batch_suggestion)
+
+@app.post("/api/claude-batches")
+async def create_claude_batch(data: dict):
+    """Queue suggestions for many products through the Message Batches API (offline, lower cost)"""
+    shop = data["shop"]
+    product_ids = data.get("product_ids") or []
+    collection_id = data.get("collection_id")
+    if not product_ids and not collection_id:
+        raise HTTPException(400, "Provide product_ids or collection_id")
+    if not CLAUDE_API_KEY:
+        raise HTTPException(500, "CLAUDE_API_KEY is not set in environment variables")
+    token = await require_token(shop)
+    products, missing = await load_batch_products(shop, token, product_ids, collection_id)
+
+    items, cached = [], 0
+    for product in products:
+        key = suggestion_key(product)
+        if not data.get("force_refresh"):
+            value, fresh = await suggestion_cache.lookup(key)
+            if fresh:
+                cached += 1
+                continue
+        items.append({"custom_id": f"product-{product['id']}", "product_id": product["id"],
+                      "cache_key": key, "params": suggestion_request(product, record=False)})
+    if not items:
+        return {"job_id": None, "submitted": 0, "cached": cached, "missing": missing}
+    try:
+        job_id = await claude_batches.submit(shop, "generate", items, CLAUDE_API_KEY)
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(500, f"Batch submission failed ({e.response.status_code}): {e.response.text[:200]}")
+    except httpx.RequestError as e:
+        raise HTTPException(500, f"Network error connecting to Claude API: {str(e)}")
+    # Counted once Anthropic has accepted them
+    submitted = {item["product_id"] for item in items}
+    for product in products:
+        if product["id"] in submitted:
+            prompting.record("generate", product, prompting.product_json(product))
+    return {"job_id": job_id, "submitted": len(items), "cached": cached, "missing": missing}
+
+@app.get("/api/claude-batches/{job_id}")
+async def get_claude_batch(job_id: int, shop: str, results: bool = True):
+    """Status, request counts and (once ended) per-product results of a Message Batches job"""
+    job = await claude_batches.get_job(job_id, shop, results)
+    if job is None:
+        raise HTTPException(404, "Batch job not found")
+    return job
+
+@app.get("/api/jobs/stats")
+async def jobs_stats():
+    """Background job counts by status and worker/watcher counts"""
+    return await jobs.stats()
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: int, shop: str):
+    """Status, current step, completed steps and (once finished) result or error of a background job"""
+    job = await jobs.get(job_id, shop)
+    if job is None:
+        raise HTTPException(404, "Job not found")
+    return job
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: int, shop: str):
+    """Server-sent job events: the job each time it changes, until it succeeds or fails"""
+    if await jobs.get(job_id, shop) is None:
+        raise HTTPException(404, "Job not found")
+
+    async def events():
+        async for job in jobs.watch(job_id, shop):
+            yield sse("job", job)
+
+    return event_stream(events())
+
+@app.post("/api/apply", status_code=202)
+async def apply_changes(data: dict, idempotency_key: str = Header(None)):
+    """Queue the product update and discount creation; progress at /api/jobs/{job_id}"""
+    shop = data["shop"]
+    await require_token(shop)
+    job_id = await jobs.enqueue(shop, "apply", {"product_id": data["product_id"], "suggestion": data["suggestion"]},
+                                idempotency_key)
+    return {"job_id": job_id, "status": "queued"}
+
+def step_error(message: str, response: httpx.Response):
+    """JobError for a failed Shopify call; throttling and server errors are retried"""
+    log_shopify_error(response.status_code, response.text)
+    return jobs.JobError(f"{message} (Status {response.status_code}): {response.text}",
+                         retryable=response.status_code == 429 or response.status_code >= 500)
+
+PRODUCT_UPDATE = """
+mutation($input: ProductInput!) {
+  productUpdate(input: $input) {
+    product { id title descriptionHtml tags updatedAt }
+    userErrors { field message }
+  }
+}
+"""
+
+DISCOUNT_CREATE = """
+mutation($discount: DiscountCodeBasicInput!) {
+  discountCodeBasicCreate(basicCodeDiscount: $discount) {
+    codeDiscountNode { id }
+    userErrors { field code message }
+  }
+}
+"""
+
+DISCOUNT_CODES_ADD = """
+mutation($id: ID!, $codes: [DiscountRedeemCodeInput!]!) {
+  discountRedeemCodeBulkAdd(discountId: $id, codes: $codes) {
+    bulkCreation { id }
+    userErrors { field code message }
+  }
+}
+"""
+
+APPLY_BATCH_CONCURRENCY = int(os.getenv("APPLY_BATCH_CONCURRENCY", "8"))
+
+def user_errors(message: str, errors: list):
+    return jobs.JobError(f"{message}: " + "; ".join(e["message"] for e in errors))
+
+async def update_product_fields(shop: str, token: str, product_id, s: dict):
+    """Title, description, tags and SEO of one product in a single productUpdate"""
     tags = s["tags"]
-    if isinstance(tags, list):
-        tags = ", ".join(tags)
-    
-    payload = {
-        "product": {
-            "id": product_id,
-            "title": s["title"],
-            "body_html": s["description_html"],
-            "tags": tags
-        }
+    if isinstance(tags, str):
+        tags = [t.strip() for t in tags.split(",") if t.strip()]
+    product_input = {
+        "id": shopify.gid("Product", product_id),
+        "title": s["title"],
+        "descriptionHtml": s["description_html"],
+        "tags": tags,
     }
-    async with httpx.AsyncClient() as client:
-        up = await client.put(f"https://{shop}/admin/api/2024-01/products/{product_id}.json",
-                              headers=shopify_headers(token), json=payload)
-        if up.status_code not in (200, 201):
-            error_msg = up.text
-            print(f"Shopify API Error ({up.status_code}): {error_msg}")
-            raise HTTPException(400, f"Product update failed (Status {up.status_code}): {error_msg}")
-    
-    # 2) Update SEO (metafields product.* or use SEO fields via GraphQL – for MVP, store as metafields)
-    # Note: Metafields require owner_resource, owner_id, and type. For MVP, we'll skip this or use GraphQL
-    # Skipping metafields for now to keep MVP simple - can be added later
-    
-    # 3) Create a discount code (price rule + code)
-    price_rule = {
-      "price_rule": {
-        "title": f"Launch Discount: {s['discount_code']}",
-        "target_type": "line_item", 
-        "target_selection": "all",
-        "allocation_method": "across",
-        "value_type": "percentage",
-        "value": f"-{int(s['discount_percent'])}",  # Negative for discount
-        "customer_selection": "all",
-        "starts_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-      }
+    if s.get("seo_title") or s.get("seo_description"):
+        product_input["seo"] = {"title": s.get("seo_title"), "description": s.get("seo_description")}
+    data = await shopify.graphql(shop, token, PRODUCT_UPDATE, {"input": product_input})
+    result = data["productUpdate"]
+    if result["userErrors"]:
+        raise user_errors("Product update failed", result["userErrors"])
+    # Keep the catalog mirror in step with what we just wrote
+    updated = result["product"]
+    mirrored = await catalog.get_product(shop, product_id)
+    if mirrored:
+        await catalog.upsert(shop, [{**mirrored, "title": updated["title"], "body_html": updated["descriptionHtml"],
+                                     "tags": ", ".join(updated["tags"]), "updated_at": updated["updatedAt"]}])
+    return {"product_id": updated["id"]}
+
+async def create_code_discount(shop: str, token: str, codes: list, percent, title: str = None):
+    """One percentage discount redeemable with every code in codes. A code already
+    taken by a discount at another percentage stays with it, under "elsewhere"."""
+    discount = {
+        "title": title or f"Launch Discount: {codes[0]}",
+        "code": codes[0],
+        "startsAt": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "customerSelection": {"all": True},
+        "customerGets": {"value": {"percentage": int(percent) / 100}, "items": {"all": True}},
     }
-    async with httpx.AsyncClient() as client:
-        pr = await client.post(f"https://{shop}/admin/api/2024-01/price_rules.json",
-                               headers=shopify_headers(token), json=price_rule)
-        if pr.status_code not in (200, 201):
-            error_msg = pr.text
-            print(f"Shopify API Error ({pr.status_code}): {error_msg}")
-            raise HTTPException(400, f"Price rule creation failed (Status {pr.status_code}): {error_msg}")
-        pr_id = pr.json()["price_rule"]["id"]
-        dc = await client.post(f"https://{shop}/admin/api/2024-01/price_rules/{pr_id}/discount_codes.json",
-                               headers=shopify_headers(token), json={"discount_code":{"code": s["discount_code"]}})
-        if dc.status_code not in (200, 201):
-            error_msg = dc.text
-            print(f"Shopify API Error ({dc.status_code}): {error_msg}")
-            raise HTTPException(400, f"Discount code creation failed (Status {dc.status_code}): {error_msg}")
-    
-    c.execute("INSERT INTO runs(shop, product_id, cost_tokens, created_at) VALUES(?,?,?,?)",
-              (shop, str(product_id), 0, int(time.time())))
-    c.commit()
-    return {"ok": True}
+    data = await shopify.graphql(shop, token, DISCOUNT_CREATE, {"discount": discount})
+    result = data["discountCodeBasicCreate"]
+    if result["userErrors"]:
+        # The code already exists (an earlier attempt or apply created it): reuse it
+        taken = any(e.get("code") == "TAKEN" for e in result["userErrors"])
+        existing = taken and await shopify.find_code_discount(shop, token, codes[0])
+        if not existing:
+            raise user_errors("Discount creation failed", result["userErrors"])
+        if existing["percent"] != int(percent):
+            # Another discount owns it; the other codes still get one at this percentage
+            taken = {"discount_id": existing["id"], "percent": existing["percent"]}
+            if len(codes) == 1:
+                return taken
+            created = await create_code_discount(shop, token, codes[1:], percent, title)
+            return {**created, "elsewhere": {**created.get("elsewhere", {}), codes[0].upper(): taken}}
+        discount_id = existing["id"]
+    else:
+        discount_id = result["codeDiscountNode"]["id"]
+    # Further codes are added to the same discount; Shopify creates them in the background
+    for i in range(1, len(codes), 250):
+        data = await shopify.graphql(shop, token, DISCOUNT_CODES_ADD,
+                                     {"id": discount_id, "codes": [{"code": c} for c in codes[i:i + 250]]})
+        if data["discountRedeemCodeBulkAdd"]["userErrors"]:
+            raise user_errors("Adding discount codes failed", data["discountRedeemCodeBulkAdd"]["userErrors"])
+    return {"discount_id": discount_id, "percent": int(percent)}
 
-@app.post("/api/generate-bundle")
-async def generate_bundle(data: dict):
+async def run_apply(job: jobs.Job):
+    shop = job.shop
+    product_id = job.payload["product_id"]
+    s = job.payload["suggestion"]
+    token = await require_token(shop)
+
+    # Product fields and SEO go in one productUpdate; the discount is independent
+    # of it, so both mutations run at once. Let both finish before failing, so
+    # a retry sees every checkpoint.
+    results = await asyncio.gather(
+        job.step("update_product", lambda: update_product_fields(shop, token, product_id, s)),
+        job.step("discount", lambda: create_code_discount(shop, token, [s["discount_code"]], s["discount_percent"])),
+        return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    created = results[1]
+
+    async def record_run():
+        # Tokens spent generating for the product since it was last applied
+        tokens = await accounting.product_tokens(shop, [product_id])
+        await store.add_run(shop, product_id, tokens.get(str(product_id), 0))
+    await job.step("record_run", record_run)
+    return {"ok": True, "product_id": product_id, "discount": created}
+
+jobs.register("apply", run_apply)
+
+@app.post("/api/apply/batch", status_code=202)
+async def apply_batch(data: dict, idempotency_key: str = Header(None)):
+    """Queue many approved suggestions as one job: {"shop", "items": [{"product_id", "suggestion"}]}.
+    Per-item results are in the job result at /api/jobs/{job_id}."""
     shop = data["shop"]
-    product_a_id = data["product_a_id"]
-    product_b_id = data["product_b_id"]
+    items = data.get("items") or []
+    if not items:
+        raise HTTPException(400, "Provide items")
+    if len(items) > BATCH_MAX_PRODUCTS:
+        raise HTTPException(400, f"Batch too large: {len(items)} items (max {BATCH_MAX_PRODUCTS})")
+    for n, item in enumerate(items):
+        s = item.get("suggestion") if isinstance(item, dict) else None
+        if not isinstance(s, dict) or not item.get("product_id"):
+            raise HTTPException(400, f"Item {n} needs a product_id and a suggestion")
+        if not isinstance(s.get("discount_code"), str) or not s["discount_code"].strip():
+            raise HTTPException(400, f"Item {n} needs a discount_code")
+        if whole_percent(s.get("discount_percent")) is None:
+            raise HTTPException(400, f"Item {n} needs a discount_percent that is a whole number from 1 to 100")
+    await require_token(shop)
+    job_id = await jobs.enqueue(shop, "apply_batch", {"items": [
+        {"product_id": item["product_id"], "suggestion": item["suggestion"]} for item in items
+    ]}, idempotency_key)
+    return {"job_id": job_id, "status": "queued", "items": len(items)}
 
-    c = db()
-    row = c.execute("SELECT * FROM shops WHERE shop = ?", (shop,)).fetchone()
-    if not row:
-        raise HTTPException(401, "Not connected")
-    token = row["access_token"]
+def whole_percent(value):
+    """value as a whole percentage from 1 to 100, or None"""
+    if isinstance(value, str) and value.strip().isdigit():
+        value = int(value)
+    if isinstance(value, bool) or not isinstance(value, int) or not 1 <= value <= 100:
+        return None
+    return value
 
-    async with httpx.AsyncClient() as client:
-        pa = await client.get(
-            f"https://{shop}/admin/api/2024-10/products/{product_a_id}.json",
-            headers=shopify_headers(token)
-        )
-        pb = await client.get(
-            f"https://{shop}/admin/api/2024-10/products/{product_b_id}.json",
-            headers=shopify_headers(token)
-        )
+def discount_groups(items: list):
+    """({percent: [codes]}, {CODE: percent}) for a batch. Repeated codes are
+    created once; codes with the same percentage share one discount instead of one each."""
+    codes = {}
+    for item in items:
+        code = item["suggestion"]["discount_code"]
+        # Shopify codes are case-insensitive; the first item to use a code sets its percentage
+        codes.setdefault(code.upper(), (code, whole_percent(item["suggestion"]["discount_percent"])))
+    groups = {}
+    for code, percent in codes.values():
+        groups.setdefault(percent, []).append(code)
+    return groups, {key: percent for key, (_, percent) in codes.items()}
+
+async def run_apply_batch(job: jobs.Job):
+    shop = job.shop
+    items = job.payload["items"]
+    token = await require_token(shop)
+    groups, percent_of = discount_groups(items)
+    # graphql() already paces calls to the shop's query budget; this bounds how many wait on it
+    slots = asyncio.Semaphore(APPLY_BATCH_CONCURRENCY)
+
+    async def bounded(name, fn):
+        async with slots:
+            return await job.step(name, fn)
 
-    if pa.status_code != 200:
-        error_msg = pa.text
-        print(f"Shopify API Error ({pa.status_code}): {error_msg}")
-        raise HTTPException(400, f"Failed to fetch product A (Status {pa.status_code}): {error_msg}")
-    if pb.status_code != 200:
-        error_msg = pb.text
-        print(f"Shopify API Error ({pb.status_code}): {error_msg}")
-        raise HTTPException(400, f"Failed to fetch product B (Status {pb.status_code}): {error_msg}")
+    def discount(percent, codes):
+        title = f"Launch Discount: {percent}% off" if len(codes) > 1 else None
+        return bounded(f"discount:{percent}", lambda: create_code_discount(shop, token, codes, percent, title))
 
-    product_a = pa.json()["product"]
-    product_b = pb.json()["product"]
+    def product(item):
+        return bounded(f"product:{item['product_id']}",
+                       lambda: update_product_fields(shop, token, item["product_id"], item["suggestion"]))
 
-    # Build prompt
-    PROMPT = f"""
-You are a Shopify ecommerce expert.
+    percents = list(groups)
+    outcomes = await asyncio.gather(*[discount(p, groups[p]) for p in percents],
+                                    *[product(item) for item in items], return_exceptions=True)
+    discounts = dict(zip(percents, outcomes[:len(percents)]))
 
-Here are two products in JSON:
+    results, retry = [], False
+    for item, updated in zip(items, outcomes[len(percents):]):
+        s = item["suggestion"]
+        discount_result = discounts[percent_of[s["discount_code"].upper()]]
+        error = next((e for e in (updated, discount_result) if isinstance(e, BaseException)), None)
+        if error is None:
+            discount_result = discount_result.get("elsewhere", {}).get(s["discount_code"].upper(), discount_result)
+        percent = whole_percent(s["discount_percent"])
+        if error is None and discount_result.get("percent", percent) != percent:
+            # The code was created earlier, or by another item of the batch, at another percentage
+            existing = discount_result["percent"]
+            results.append({"product_id": item["product_id"], "ok": False, "discount_code": s["discount_code"],
+                            "discount_id": discount_result["discount_id"],
+                            "error": f"Discount code {s['discount_code']} is already "
+                                     + (f"{existing}% off" if existing is not None else "a discount of another kind")
+                                     + f", not {percent}% off"})
+        elif error is None:
+            results.append({"product_id": item["product_id"], "ok": True, "discount_code": s["discount_code"],
+                            "discount_id": discount_result["discount_id"]})
+        else:
+            retry = retry or jobs.is_retryable(error)
+            results.append({"product_id": item["product_id"], "ok": False,
+                            "error": getattr(error, "detail", None) or str(error)})
+    failed = sum(1 for r in results if not r["ok"])
+    # Completed items are checkpointed, so a retry only repeats the failed ones
+    if retry and job.attempts < jobs.JOB_MAX_ATTEMPTS:
+        raise jobs.JobError(f"{failed} of {len(items)} items failed", retryable=True)
 
-Product A:
-{json.dumps(product_a)[:6000]}
+    async def record_runs():
+        applied = [r["product_id"] for r in results if r["ok"]]
+        tokens = await accounting.product_tokens(shop, applied)
+        await store.add_runs(shop, {p: tokens.get(str(p), 0) for p in applied})
+    await job.step("record_runs", record_runs)
+    return {"total": len(items), "succeeded": len(items) - failed, "failed": failed,
+            "discounts": len(groups), "items": results}
 
-Product B:
-{json.dumps(product_b)[:6000]}
+jobs.register("apply_batch", run_apply_batch)
+
+BUNDLE_PROMPT = """You are a Shopify ecommerce expert.
+
+You will be given two products in JSON, Product A and Product B.
 
 Create a NEW Shopify bundle product.
 
 Return ONLY valid JSON with no explanation:
-{{
+{
   "title": "...",
   "description_html": "...",
   "tags": "...",
   "bundle_price_percent_off": 10,
   "bundle_notes": "..."
-}}
-    """
+}"""
 
-    headers = {
-        "x-api-key": CLAUDE_API_KEY,
-        "anthropic-version": "2023-06-01",
-        "content-type": "application/json"
-    }
+def bundle_products_json(product_a: dict, product_b: dict):
+    budget = prompting.PROMPT_BUNDLE_PRODUCT_TOKENS
+    return prompting.product_json(product_a, budget), prompting.product_json(product_b, budget)
 
-    payload = {
-        "model": "claude-sonnet-4-20250514",
-        "max_tokens": 800,
-        "messages": [{"role": "user", "content": PROMPT}]
-    }
+async def call_claude_bundle(product_a: dict, product_b: dict):
+    text_a, text_b = bundle_products_json(product_a, product_b)
+    prompting.record("bundle", product_a, text_a)
+    prompting.record("bundle", product_b, text_b)
+    payload = claude_request(BUNDLE_PROMPT, f"Product A:\n{text_a}\n\nProduct B:\n{text_b}", 800)
 
-    try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            r = await client.post(
-                "https://api.anthropic.com/v1/messages",
-                headers=headers,
-                json=payload
-            )
-            r.raise_for_status()
-            response_data = r.json()
-    except httpx.HTTPStatusError as e:
-        error_detail = f"Claude API error: {e.response.status_code}"
-        if e.response.status_code == 401:
-            error_detail = "Invalid Claude API key. Please check your CLAUDE_API_KEY in .env file."
-        elif e.response.status_code == 404:
-            error_detail = "Claude API endpoint not found (404). Please verify your API key and endpoint are correct."
-        elif e.response.status_code == 429:
-            error_detail = "Claude API rate limit exceeded. Please try again later."
-        try:
-            error_data = e.response.json()
-            if "error" in error_data:
-                error_detail = error_data["error"].get("message", error_detail)
-        except:
-            error_detail = f"{error_detail} - Response: {e.response.text[:200]}"
-        raise HTTPException(500, f"AI generation failed: {error_detail}") from e
-    except httpx.RequestError as e:
-        raise HTTPException(500, f"Network error connecting to Claude API: {str(e)}") from e
-    
-    # Claude response format: content is an array of text blocks
-    content_blocks = response_data.get("content", [])
-    if not content_blocks or len(content_blocks) == 0:
-        raise HTTPException(500, "Claude API returned empty response")
-    
-    text = content_blocks[0].get("text", "").strip()
-    if not text:
-        raise HTTPException(500, "Claude API returned empty text content")
-    
-    # be resilient if model returns code fences
-    text = text.strip().strip("`")
-    if text.startswith("json"): 
-        text = text[4:].strip()
-    if text.startswith("```json"):
-        text = text[7:].strip()
-    if text.endswith("```"):
-        text = text[:-3].strip()
+    response_data = await claude_messages(payload, "bundle")
+    return claude_json(response_data)
 
+@app.get("/api/bundles/suggest")
+async def suggest_bundles(shop: str, product_id: int = None, k: int = 10, source: str = "auto"):
+    """Top-k bundle pairs, or the best partners for product_id, without a Claude call.
+    source=orders ranks by how often products are bought together (lift, see
+    /api/orders/sync), source=catalog by how related their listings are; auto uses
+    orders when there are enough and the catalog otherwise. Each pair can be sent
+    to /api/generate-bundle as is."""
+    if not 1 <= k <= 100:
+        raise HTTPException(400, "k must be between 1 and 100")
+    if source not in ("auto", "orders", "catalog"):
+        raise HTTPException(400, "source must be auto, orders or catalog")
+    token = await require_token(shop)
     try:
-        bundle_data = json.loads(text)
-    except json.JSONDecodeError as e:
-        raise HTTPException(500, f"Claude returned invalid JSON: {str(e)}. Response: {text[:200]}")
+        await catalog.ensure_fresh(shop, token)
+    except ShopifyError as e:
+        log_shopify_error(e.status_code, e.text)
+        raise HTTPException(e.http_status, f"Failed to fetch products (Status {e.status_code}): {e.text}")
+    if source != "catalog":
+        await orders.ensure_fresh(shop, token)
+        result = await cooccurrence.suggest(shop, product_id, k)
+        if result is not None and (result["pairs"] or source == "orders"):
+            return {**result, "source": "orders"}
+        if source == "orders":
+            raise HTTPException(404, f"Product {product_id} has no stored orders")
+    result = await similarity.suggest(shop, product_id, k)
+    if result is None:
+        raise HTTPException(404, f"Product {product_id} is not in the catalog")
+    return {**result, "source": "catalog"}
+
+@app.post("/api/generate-bundle")
+async def generate_bundle(data: dict, response: Response):
+    shop = data["shop"]
+    product_a_id = data["product_a_id"]
+    product_b_id = data["product_b_id"]
+
+    token = await require_token(shop)
+    accounting.attribute(shop)
+
+    # Served from the catalog mirror; misses are fetched concurrently over the shared pool
+    product_a, product_b = await asyncio.gather(
+        catalog.load_product(shop, token, product_a_id),
+        catalog.load_product(shop, token, product_b_id),
+        return_exceptions=True,
+    )
+    for label, result in (("A", product_a), ("B", product_b)):
+        if isinstance(result, ShopifyError):
+            log_shopify_error(result.status_code, result.text)
+            raise HTTPException(400, f"Failed to fetch product {label} (Status {result.status_code}): {result.text}")
+        if isinstance(result, BaseException):
+            raise result
+
+    # Keyed on the ordered pair: A+B and B+A are different prompts
+    key = suggestions.make_key("bundle", *bundle_products_json(product_a, product_b),
+                               suggestions.fingerprint(BUNDLE_PROMPT), CLAUDE_MODEL)
+    bundle_data, cache_status = await suggestion_cache.get_or_compute(
+        key, "bundle", lambda: call_claude_bundle(product_a, product_b), bool(data.get("force_refresh")))
+    response.headers["X-Suggestion-Cache"] = cache_status
     return {
         "product_a": product_a,
         "product_b": product_b,
@@ -514,18 +1100,15 @@ async def agent_intent(data: dict):
     
     return intent
 
-@app.post("/api/create-bundle")
-async def create_bundle(data: dict):
+@app.post("/api/create-bundle", status_code=202)
+async def create_bundle(data: dict, idempotency_key: str = Header(None)):
+    """Queue creation of the bundle product; progress at /api/jobs/{job_id}"""
     shop = data["shop"]
     product_a = data["product_a"]
     product_b = data["product_b"]
     bundle = data["bundle"]
 
-    c = db()
-    row = c.execute("SELECT * FROM shops WHERE shop = ?", (shop,)).fetchone()
-    if not row:
-        raise HTTPException(401, "Not connected")
-    token = row["access_token"]
+    await require_token(shop)
 
     # Calculate bundle price
     price_a = float(product_a["variants"][0]["price"])
@@ -571,78 +1154,91 @@ async def create_bundle(data: dict):
         })
     }
 
-    try:
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            r = await client.post(
-                f"https://{shop}/admin/api/2024-10/products.json",
-                headers=shopify_headers(token),
-                json=payload
-            )
-            if r.status_code not in (200, 201):
-                error_msg = r.text
-                print(f"Shopify API Error ({r.status_code}): {error_msg}")
-                raise HTTPException(400, f"Bundle creation failed (Status {r.status_code}): {error_msg}")
-            
-            created_product = r.json()
-            
-            # Create metafields separately after product creation
-            if created_product.get("product"):
-                product_id = created_product["product"]["id"]
-                
-                try:
-                    metafield_payload = {
-                        "metafield": {
-                            "namespace": metafield_data["namespace"],
-                            "key": metafield_data["key"],
-                            "type": metafield_data["type"],
-                            "value": metafield_data["value"],
-                            "owner_resource": "product",
-                            "owner_id": product_id
-                        }
+    job_id = await jobs.enqueue(shop, "create_bundle", {"product": payload, "metafield": metafield_data},
+                                idempotency_key)
+    return {"job_id": job_id, "status": "queued"}
+
+async def run_create_bundle(job: jobs.Job):
+    shop = job.shop
+    payload = job.payload["product"]
+    metafield_data = job.payload["metafield"]
+    token = await require_token(shop)
+
+    async def create_product():
+        if job.attempts > 1:
+            # An earlier attempt may have created it without recording it (e.g. it timed out)
+            existing = await shopify.find_product(shop, token, payload["product"]["title"], "Bundle",
+                                                  job.created_at - 60)
+            if existing:
+                return {"product": existing}
+        # Product creation with images can be slow on Shopify's side
+        r = await shopify.request(
+            shop, "POST",
+            shopify.admin_url(shop, "products.json", "2024-10"),
+            token,
+            json=payload,
+            timeout=120.0
+        )
+        if r.status_code not in (200, 201):
+            raise step_error("Bundle creation failed", r)
+        
+        created_product = r.json()
+        if created_product.get("product"):
+            await catalog.upsert(shop, [created_product["product"]])
+        return created_product
+
+    created_product = await job.step("create_product", create_product)
+    
+    # Create metafields separately after product creation
+    if created_product.get("product"):
+        product_id = created_product["product"]["id"]
+
+        async def create_metafield():
+            try:
+                metafield_payload = {
+                    "metafield": {
+                        "namespace": metafield_data["namespace"],
+                        "key": metafield_data["key"],
+                        "type": metafield_data["type"],
+                        "value": metafield_data["value"],
+                        "owner_resource": "product",
+                        "owner_id": product_id
                     }
-                    async with httpx.AsyncClient(timeout=60.0) as metafield_client:
-                        mf_r = await metafield_client.post(
-                            f"https://{shop}/admin/api/2024-10/metafields.json",
-                            headers=shopify_headers(token),
-                            json=metafield_payload
-                        )
-                        if mf_r.status_code not in (200, 201):
-                            print(f"Warning: Metafield creation failed ({mf_r.status_code}): {mf_r.text}")
-                            # Don't fail the whole request if metafield creation fails
-                except Exception as e:
-                    print(f"Warning: Could not create metafield: {str(e)}")
+                }
+                mf_r = await shopify.request(
+                    shop, "POST",
+                    shopify.admin_url(shop, "metafields.json", "2024-10"),
+                    token,
+                    json=metafield_payload
+                )
+                if mf_r.status_code not in (200, 201):
+                    log.warning("Metafield creation failed",
+                                extra={"status": mf_r.status_code, "body": mf_r.text[:1000]})
                     # Don't fail the whole request if metafield creation fails
-            
-            return {"created_product": created_product}
-    except httpx.ReadTimeout:
-        raise HTTPException(504, "Request to Shopify API timed out. The bundle may have been created. Please check your Shopify admin.")
-    except httpx.RequestError as e:
-        raise HTTPException(500, f"Network error connecting to Shopify API: {str(e)}")
+                    return False
+            except Exception as e:
+                log.warning("Could not create metafield: %s", e)
+                # Don't fail the whole request if metafield creation fails
+                return False
+            return True
 
-@app.post("/api/generate-announcement")
-async def generate_announcement(data: dict):
-    """Generate an announcement bar snippet using Claude AI"""
-    shop = data["shop"]
-    prompt = data["prompt"]
+        await job.step("metafield", create_metafield)
     
-    c = db()
-    row = c.execute("SELECT * FROM shops WHERE shop = ?", (shop,)).fetchone()
-    if not row:
-        raise HTTPException(401, "Not connected")
-    
-    AI_PROMPT = f"""You are a Shopify Theme UI expert.
+    return {"created_product": created_product}
+
+jobs.register("create_bundle", run_create_bundle)
 
-Generate an announcement bar snippet based on this request:
+ANNOUNCEMENT_PROMPT = """You are a Shopify Theme UI expert.
 
-"{prompt}"
+Generate an announcement bar snippet based on the user's request.
 
 Return ONLY valid JSON (no markdown, no code fences, no explanations):
 
-{{
+{
   "filename": "ai-announcement-bar.liquid",
   "content": "<div style='background: #000; color: #fff; padding: 12px; text-align: center;'>Your message here</div>",
   "preview_html": "<!DOCTYPE html><html><head><meta charset='utf-8'></head><body><div style='background: #000; color: #fff; padding: 12px; text-align: center;'>Your message here</div></body></html>"
-}}
+}
 
 CRITICAL RULES:
 - Return ONLY the JSON object, nothing else
@@ -652,93 +1248,55 @@ CRITICAL RULES:
 - Ensure all strings are properly closed
 - Do not use markdown code blocks
 """
-    
-    headers = {
-        "x-api-key": CLAUDE_API_KEY,
-        "anthropic-version": "2023-06-01",
-        "content-type": "application/json"
-    }
-    
-    payload = {
-        "model": "claude-sonnet-4-20250514",
-        "max_tokens": 2000,
-        "messages": [{"role": "user", "content": AI_PROMPT}]
-    }
-    
-    try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            res = await client.post(
-                "https://api.anthropic.com/v1/messages",
-                headers=headers,
-                json=payload
-            )
-            res.raise_for_status()
-            response_data = res.json()
-    except httpx.HTTPStatusError as e:
-        error_detail = f"Claude API error: {e.response.status_code}"
-        if e.response.status_code == 401:
-            error_detail = "Invalid Claude API key. Please check your CLAUDE_API_KEY in .env file."
-        try:
-            error_data = e.response.json()
-            if "error" in error_data:
-                error_detail = error_data["error"].get("message", error_detail)
-        except:
-            error_detail = f"{error_detail} - Response: {e.response.text[:200]}"
-        raise HTTPException(500, f"AI generation failed: {error_detail}") from e
-    except httpx.RequestError as e:
-        raise HTTPException(500, f"Network error connecting to Claude API: {str(e)}")
-    
-    content_blocks = response_data.get("content", [])
-    if not content_blocks or len(content_blocks) == 0:
-        raise HTTPException(500, "Claude API returned empty response")
-    
-    text = content_blocks[0].get("text", "").strip()
-    if not text:
-        raise HTTPException(500, "Claude API returned empty text content")
-    
+
+async def call_claude_announcement(prompt: str):
+    response_data = await claude_messages(announcement_request(prompt), "announcement")
+    return parse_announcement(response_data)
+
+def announcement_request(prompt: str):
+    return claude_request(ANNOUNCEMENT_PROMPT, f'Generate an announcement bar snippet based on this request:\n\n"{prompt}"', 2000)
+
+def parse_announcement(response_data: dict):
     # Check if response was truncated
-    stop_reason = response_data.get("stop_reason", "")
-    if stop_reason == "max_tokens":
+    if response_data.get("stop_reason") == "max_tokens":
         raise HTTPException(500, "Response was truncated. Please try a shorter prompt or simpler design.")
+    return claude_json(response_data, ("filename", "content", "preview_html"))
+
+@app.post("/api/generate-announcement")
+async def generate_announcement(data: dict, response: Response):
+    """Generate an announcement bar snippet using Claude AI"""
+    shop = data["shop"]
+    prompt = data["prompt"]
     
-    # Clean up code fences and markdown
-    text = text.strip()
-    # Remove markdown code blocks
-    if text.startswith("```"):
-        # Find the first newline after ```
-        first_newline = text.find("\n")
-        if first_newline != -1:
-            text = text[first_newline:].strip()
-        if text.endswith("```"):
-            text = text[:-3].strip()
-    # Remove any leading "json" keyword
-    if text.lower().startswith("json"):
-        text = text[4:].strip()
-    
-    # Try to extract JSON if there's extra text
-    # Look for the first { and last }
-    first_brace = text.find("{")
-    last_brace = text.rfind("}")
-    if first_brace != -1 and last_brace != -1 and last_brace > first_brace:
-        text = text[first_brace:last_brace + 1]
+    await require_token(shop)
+    accounting.attribute(shop)
     
-    try:
-        announcement = json.loads(text)
-        # Validate required fields
-        if "filename" not in announcement or "content" not in announcement or "preview_html" not in announcement:
-            raise ValueError("Missing required fields: filename, content, or preview_html")
-        return announcement
-    except json.JSONDecodeError as e:
-        # Try to provide more helpful error message
-        error_pos = getattr(e, 'pos', None)
-        if error_pos:
-            context_start = max(0, error_pos - 100)
-            context_end = min(len(text), error_pos + 100)
-            context = text[context_start:context_end]
-            raise HTTPException(500, f"Claude returned invalid JSON at position {error_pos}: {str(e)}. Context: ...{context}...")
-        raise HTTPException(500, f"Claude returned invalid JSON: {str(e)}. Response preview: {text[:500]}")
-    except ValueError as e:
-        raise HTTPException(500, f"Invalid response format: {str(e)}")
+    # Whitespace-only differences produce the same snippet
+    normalized = " ".join(prompt.split())
+    key = announcement_key(normalized)
+    announcement, cache_status = await suggestion_cache.get_or_compute(
+        key, "announcement", lambda: call_claude_announcement(normalized), bool(data.get("force_refresh")))
+    response.headers["X-Suggestion-Cache"] = cache_status
+    return announcement
+
+def announcement_key(prompt: str):
+    return suggestions.make_key("announcement", prompt,
+                                suggestions.fingerprint(ANNOUNCEMENT_PROMPT), CLAUDE_MODEL)
+
+@app.post("/api/generate-announcement/stream")
+async def generate_announcement_stream(data: dict):
+    """Streaming /api/generate-announcement: field..., then done or error events"""
+    shop = data["shop"]
+    await require_token(shop)
+    accounting.attribute(shop)
+    normalized = " ".join(data["prompt"].split())
+    key = announcement_key(normalized)
+    cached, cache_status = await cached_for_stream(
+        key, "announcement", lambda: call_claude_announcement(normalized), bool(data.get("force_refresh")))
+    if cached is None and not CLAUDE_API_KEY:
+        raise HTTPException(500, "AI generation failed: CLAUDE_API_KEY is not set in environment variables")
+    events = stream_generation(key, "announcement", announcement_request(normalized), parse_announcement, cached)
+    return event_stream(events, cache_status)
 
 @app.post("/api/publish-announcement")
 async def publish_announcement(data: dict):
@@ -747,179 +1305,92 @@ async def publish_announcement(data: dict):
     filename = data["filename"]
     content = data["content"]
     
-    c = db()
-    row = c.execute("SELECT * FROM shops WHERE shop = ?", (shop,)).fetchone()
-    if not row:
-        raise HTTPException(401, "Not connected")
-    token = row["access_token"]
+    token = await require_token(shop)
     
-    # Find main theme - try older API versions that allow asset modifications
-    # Try 2022-10 first (more permissive), fallback to 2023-01
-    api_versions = ["2022-10", "2023-01"]
-    themes_data = None
-    working_version = None
-    
-    async with httpx.AsyncClient() as client:
-        for api_version in api_versions:
-            themes = await client.get(
-                f"https://{shop}/admin/api/{api_version}/themes.json",
-                headers=shopify_headers(token)
-            )
-            if themes.status_code == 200:
-                themes_data = themes.json()
-                working_version = api_version
-                break
-        if themes_data is None:
-            raise HTTPException(400, f"Failed to fetch themes with any API version. Tried: {', '.join(api_versions)}")
-    
-    theme_id = next((t for t in themes_data["themes"] if t["role"] == "main"), None)
-    if not theme_id:
-        raise HTTPException(400, "Main theme not found")
-    theme_id = theme_id["id"]
-    
-    payload = {
-        "asset": {
-            "key": f"snippets/{filename}",
-            "value": content
-        }
-    }
-    
-    async with httpx.AsyncClient() as client:
-        up = await client.put(
-            f"https://{shop}/admin/api/{working_version}/themes/{theme_id}/assets.json",
-            headers=shopify_headers(token),
-            json=payload
-        )
-        if up.status_code not in (200, 201):
-            error_msg = up.text
-            raise HTTPException(400, f"Failed to publish snippet (Status {up.status_code}): {error_msg}")
+    try:
+        up, theme = await themes.put_asset(shop, token, f"snippets/{filename}", content)
+    except themes.ThemeError as e:
+        raise HTTPException(400, str(e))
+    if up.status_code not in (200, 201):
+        error_msg = up.text
+        raise HTTPException(400, f"Failed to publish snippet (Status {up.status_code}): {error_msg}")
     
-    return {"ok": True, "theme_id": theme_id}
+    return {"ok": True, "theme_id": theme["theme_id"]}
 
-@app.post("/api/inject-announcement")
-async def inject_announcement(data: dict):
-    """Inject the announcement bar snippet into theme.liquid"""
+@app.post("/api/inject-announcement", status_code=202)
+async def inject_announcement(data: dict, idempotency_key: str = Header(None)):
+    """Queue injection of the announcement bar snippet into theme.liquid; progress at /api/jobs/{job_id}"""
     shop = data["shop"]
     filename = data["filename"]  # ai-announcement-bar.liquid
     
-    c = db()
-    row = c.execute("SELECT * FROM shops WHERE shop = ?", (shop,)).fetchone()
-    if not row:
-        raise HTTPException(401, "Not connected")
-    token = row["access_token"]
-    
-    # Fetch theme list - try older API versions that allow asset modifications
-    api_versions = ["2022-10", "2023-01"]
-    themes_data = None
-    working_version = None
-    
-    async with httpx.AsyncClient() as client:
-        for api_version in api_versions:
-            themes = await client.get(
-                f"https://{shop}/admin/api/{api_version}/themes.json",
-                headers=shopify_headers(token)
-            )
-            if themes.status_code == 200:
-                themes_data = themes.json()
-                working_version = api_version
-                break
-        
-        if themes_data is None:
-            raise HTTPException(400, f"Failed to fetch themes with any API version. Tried: {', '.join(api_versions)}")
-    
-    theme_id = next((t for t in themes_data["themes"] if t["role"] == "main"), None)
-    if not theme_id:
-        raise HTTPException(400, "Main theme not found")
-    theme_id = theme_id["id"]
+    await require_token(shop)
+    job_id = await jobs.enqueue(shop, "inject_announcement", {"filename": filename}, idempotency_key)
+    return {"job_id": job_id, "status": "queued"}
+
+async def run_inject_announcement(job: jobs.Job):
+    shop = job.shop
+    filename = job.payload["filename"]
+    token = await require_token(shop)
+
+    found = {}
+
+    async def find_layout():
+        try:
+            layout = await themes.layout(shop, token)
+        except themes.ThemeError as e:
+            raise jobs.JobError(str(e))
+        # The layout body can be large: keep it out of the checkpoint
+        found["content"] = layout.pop("content", None)
+        return layout
+
+    layout = await job.step("layout", find_layout)
+
+    async def inject():
+        location = layout
+        # Read once here, unless this run just looked it up
+        content = found.get("content")
+        if content is None:
+            content = await themes.asset_value(shop, token, location, location["key"])
+        if content is None:
+            # The theme or key is gone (switched themes without a webhook reaching us)
+            await themes.forget(shop)
+            location = await find_layout()
+            content = found["content"]
+        working_version, theme_id, layout_key = location["api_version"], location["theme_id"], location["key"]
+
+        # Remove .liquid extension for render tag
+        snippet_name = filename.replace(".liquid", "")
+        render_snippet = f"{{% render '{snippet_name}' %}}"
     
-    # Fetch theme.liquid - try common layout file names
-    layout_candidates = ["layout/theme.liquid", "layout/theme", "templates/theme.liquid", "templates/theme", "theme.liquid", "theme"]
-    layout_key = None
-    content = None
+        if render_snippet in content:
+            return {"ok": True, "message": "Already injected"}
     
-    async with httpx.AsyncClient() as client:
-        # First, try direct lookup for each candidate
-        for candidate in layout_candidates:
-            query_params = urlencode({"asset[key]": candidate})
-            tl = await client.get(
-                f"https://{shop}/admin/api/{working_version}/themes/{theme_id}/assets.json?{query_params}",
-                headers=shopify_headers(token)
+        # Inject after <body> tag
+        if "<body" in content:
+            before, rest = content.split("<body", 1)
+            pos = rest.find(">") + 1
+            new_content = (
+                before + "<body" + rest[:pos] + "\n  " + render_snippet + "\n" + rest[pos:]
             )
-            if tl.status_code == 200:
-                asset_data = tl.json()
-                # Verify we got the asset with the right key
-                if "asset" in asset_data:
-                    asset_key = asset_data["asset"].get("key")
-                    if asset_key == candidate or asset_key.endswith("/theme.liquid") or asset_key.endswith("/theme"):
-                        content = asset_data["asset"]["value"]
-                        layout_key = asset_key  # Use the exact key from response
-                        break
-        
-        # If not found, try listing all assets to find the main layout
-        if layout_key is None:
-            all_assets = await client.get(
-                f"https://{shop}/admin/api/{working_version}/themes/{theme_id}/assets.json",
-                headers=shopify_headers(token)
-            )
-            if all_assets.status_code == 200:
-                assets_data = all_assets.json()
-                # Look for theme.liquid in layout or templates folder
-                for asset in assets_data.get("assets", []):
-                    key = asset.get("key", "")
-                    if key in ["layout/theme.liquid", "layout/theme", "templates/theme.liquid", "templates/theme"]:
-                        # Fetch the full content
-                        query_params = urlencode({"asset[key]": key})
-                        asset_resp = await client.get(
-                            f"https://{shop}/admin/api/{working_version}/themes/{theme_id}/assets.json?{query_params}",
-                            headers=shopify_headers(token)
-                        )
-                        if asset_resp.status_code == 200:
-                            asset_data = asset_resp.json()
-                            content = asset_data["asset"]["value"]
-                            layout_key = key
-                            break
-        
-        if layout_key is None or content is None:
-            raise HTTPException(404, f"Could not find theme layout file. Please ensure your theme has a layout/theme.liquid file.")
-    
-    # Remove .liquid extension for render tag
-    snippet_name = filename.replace(".liquid", "")
-    render_snippet = f"{{% render '{snippet_name}' %}}"
-    
-    if render_snippet in content:
-        return {"ok": True, "message": "Already injected"}
-    
-    # Inject after <body> tag
-    if "<body" in content:
-        before, rest = content.split("<body", 1)
-        pos = rest.find(">") + 1
-        new_content = (
-            before + "<body" + rest[:pos] + "\n  " + render_snippet + "\n" + rest[pos:]
-        )
-    else:
-        new_content = render_snippet + "\n" + content
+        else:
+            new_content = render_snippet + "\n" + content
     
-    payload = {
-        "asset": {
-            "key": layout_key,
-            "value": new_content
+        payload = {
+            "asset": {
+                "key": layout_key,
+                "value": new_content
+            }
         }
-    }
     
-    # Debug: log what we're trying to update
-    print(f"Attempting to update theme asset: theme_id={theme_id}, key={layout_key}")
+        log.info("Updating theme asset", extra={"theme_id": theme_id, "key": layout_key})
     
-    async with httpx.AsyncClient() as client:
-        up = await client.put(
-            f"https://{shop}/admin/api/{working_version}/themes/{theme_id}/assets.json",
-            headers=shopify_headers(token),
-            json=payload
-        )
+        up = await shopify.request(shop, "PUT", themes.assets_url(shop, location), token, json=payload)
         if up.status_code not in (200, 201):
             error_msg = up.text
-            print(f"PUT request failed: Status {up.status_code}, Response: {error_msg}")
-            print(f"Payload key: {layout_key}, Theme ID: {theme_id}, API Version: {working_version}")
-            
+            log.warning("Theme asset update failed", extra={
+                "status": up.status_code, "body": error_msg[:1000], "key": layout_key,
+                "theme_id": theme_id, "api_version": working_version})
+        
             # Provide helpful error message
             if up.status_code == 404:
                 detailed_error = f"""Theme asset modification failed (404). 
@@ -937,11 +1408,16 @@ SOLUTIONS:
 
 Snippet location: snippets/{filename}
 Layout file: {layout_key}"""
-                raise HTTPException(400, detailed_error)
+                raise jobs.JobError(detailed_error)
             else:
-                raise HTTPException(400, f"Failed to inject into theme (Status {up.status_code}): {error_msg}")
+                raise jobs.JobError(f"Failed to inject into theme (Status {up.status_code}): {error_msg}",
+                                    retryable=up.status_code == 429 or up.status_code >= 500)
     
-    return {"ok": True}
+        return {"ok": True}
+
+    return await job.step("inject", inject)
+
+jobs.register("inject_announcement", run_inject_announcement)
 
 if __name__ == "__main__":
     import uvicorn
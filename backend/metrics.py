@@ -0,0 +1,237 @@
+import re, time, bisect, contextvars
+import httpx
+
+# Process-local metrics in the Prometheus text format, served at /metrics:
+# request histograms per route, upstream call histograms and in-flight gauges
+# per upstream, endpoint and status, DB query timings and Claude token
+# counters. Each uvicorn worker keeps its own, so scrape every worker.
+#
+# Each request also collects the time it spent in Shopify, Claude and the DB
+# and answers with a Server-Timing header summing them. Concurrent calls are
+# each counted in full, and a streamed response's header only covers the time
+# before its first byte.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+DB_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+registry = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in pairs) + "}" if pairs else ""
+
+def _number(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        registry.append(self)
+
+    def _key(self, labels: dict):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for key, value in sorted(self._values.items()):
+            yield from self._samples(key, value)
+
+    def _samples(self, key, value):
+        yield f"{self.name}{_labels(self.labels, key)} {_number(value)}"
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self._values.get(key)
+        if series is None:
+            # Per-bucket counts (the last is +Inf), sum, count
+            series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def _samples(self, key, value):
+        counts, total, count = value
+        cumulative = 0
+        for bound, n in zip((*self.buckets, float("inf")), counts):
+            cumulative += n
+            yield f"{self.name}_bucket{_labels(self.labels, key, [('le', _number(bound))])} {cumulative}"
+        yield f"{self.name}_sum{_labels(self.labels, key)} {_number(total)}"
+        yield f"{self.name}_count{_labels(self.labels, key)} {count}"
+
+def render() -> str:
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+http_requests = Histogram("http_request_duration_seconds", "Time to answer a request, by route",
+                          ("method", "route", "status"))
+http_in_flight = Gauge("http_requests_in_flight", "Requests being answered")
+upstream_requests = Histogram("upstream_request_duration_seconds",
+                              "Upstream calls by upstream, endpoint and status, until the body is read",
+                              ("upstream", "endpoint", "status"))
+upstream_in_flight = Gauge("upstream_requests_in_flight", "Upstream calls under way", ("upstream",))
+db_queries = Histogram("db_query_duration_seconds", "Time a DB call ran on its worker thread", ("op",),
+                       DB_BUCKETS)
+db_waits = Histogram("db_queue_wait_seconds", "Time a DB call waited for a worker thread", ("op",), DB_BUCKETS)
+claude_tokens = Counter("claude_tokens_total", "Claude tokens by endpoint and kind (input, output, cache)",
+                        ("endpoint", "type"))
+
+# Server-Timing
+
+_timings = contextvars.ContextVar("server_timing", default=None)
+
+def add_timing(kind: str, seconds: float):
+    """Count seconds against kind in the current request's Server-Timing, if there is one"""
+    timings = _timings.get()
+    if timings is not None:
+        spent, calls = timings.get(kind, (0.0, 0))
+        timings[kind] = (spent + seconds, calls + 1)
+
+def server_timing(timings: dict, total: float) -> str:
+    parts = [f'{kind};desc="{calls} call{"s" if calls != 1 else ""}";dur={spent * 1000:.1f}'
+             for kind, (spent, calls) in timings.items()]
+    return ", ".join([*parts, f"total;dur={total * 1000:.1f}"])
+
+def _route(scope) -> str:
+    """Path template of the route that answered, so IDs in paths don't each become a series"""
+    endpoint, app = scope.get("endpoint"), scope.get("app")
+    if endpoint is not None and app is not None:
+        for route in app.routes:
+            if getattr(route, "endpoint", None) is endpoint:
+                return route.path
+    return "unmatched"
+
+class MetricsMiddleware:
+    """Times every HTTP request and adds its Server-Timing header"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        timings, started, status = {}, time.perf_counter(), 500
+        token = _timings.set(timings)
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                header = server_timing(timings, time.perf_counter() - started)
+                message = {**message, "headers": [*message.get("headers", []), (b"server-timing", header.encode())]}
+            await send(message)
+
+        http_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            http_in_flight.dec()
+            http_requests.observe(time.perf_counter() - started, method=scope["method"], route=_route(scope),
+                                  status=status)
+            _timings.reset(token)
+
+# Upstream calls
+
+_VERSION = re.compile(r"^/admin/api/[^/]+/")
+_IDS = re.compile(r"/(\d+|msgbatch_\w+)(?=[/.]|$)")
+
+def endpoint_name(path: str) -> str:
+    """/admin/api/{version}/products/{id}.json for a request path"""
+    if not path.startswith(("/admin/", "/v1/")):
+        # Bulk operation result files and other one-off downloads
+        return "download"
+    return _IDS.sub("/{id}", _VERSION.sub("/admin/api/{version}/", path))
+
+class _TimedStream(httpx.AsyncByteStream):
+    def __init__(self, stream, done):
+        self._stream = stream
+        self._done = done
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            self._done()
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """Wraps a transport to time each call from sending it until its body is
+    read or closed, for the upstream metrics and Server-Timing"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, upstream: str):
+        self.transport = transport
+        self.upstream = upstream
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        endpoint, started = endpoint_name(request.url.path), time.perf_counter()
+        upstream_in_flight.inc(upstream=self.upstream)
+
+        def done(status):
+            elapsed = time.perf_counter() - started
+            upstream_in_flight.dec(upstream=self.upstream)
+            upstream_requests.observe(elapsed, upstream=self.upstream, endpoint=endpoint, status=status)
+            add_timing(self.upstream, elapsed)
+
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            done("error")
+            raise
+        closed = False
+
+        def close():
+            nonlocal closed
+            if not closed:
+                closed = True
+                done(response.status_code)
+
+        response.stream = _TimedStream(response.stream, close)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+# DB
+
+def record_db(op: str, waited: float, ran: float, total: float):
+    if waited is not None:
+        db_waits.observe(waited, op=op)
+    if ran is not None:
+        db_queries.observe(ran, op=op)
+    add_timing("db", total)
@@ -0,0 +1,201 @@
+import os, json, time, asyncio, logging
+from datetime import datetime
+import store
+import upstream
+import shopify
+import webhooks
+import cooccurrence
+from shopify import ShopifyError, admin_url, next_page_url
+
+# Order line items for bundle co-occurrence (see cooccurrence.py). Only what
+# the matrix needs is kept: one row per product per order with its quantity,
+# so a million line items stay a few tens of MB on disk and nothing per order
+# is held in memory beyond the page or bulk batch being written.
+#
+# Orders arrive from paginated orders.json, a bulk operation for large
+# histories, and the orders/create webhook. Lines are only ever inserted, so
+# overlapping syncs and redelivered webhooks count each order once. Without
+# the read_all_orders scope Shopify only returns the last 60 days.
+#
+# Once a shop has been synced, queries keep it fresh: every
+# ORDERS_REFRESH_SECONDS while orders/create isn't subscribed (it needs
+# protected customer data access), every ORDERS_MAX_AGE_SECONDS once it is.
+
+PAGE_SIZE = 250
+ORDERS_LOOKBACK_DAYS = int(os.getenv("ORDERS_LOOKBACK_DAYS", "365"))
+ORDERS_BULK_THRESHOLD = int(os.getenv("ORDERS_BULK_THRESHOLD", "2500"))
+SYNC_OVERLAP_SECONDS = 300
+BULK_BATCH_SIZE = 1000
+ORDERS_REFRESH_SECONDS = float(os.getenv("ORDERS_REFRESH_SECONDS", "300"))
+ORDERS_MAX_AGE_SECONDS = float(os.getenv("ORDERS_MAX_AGE_SECONDS", "86400"))
+
+ORDERS_BULK_QUERY = """
+{
+  orders(query: "created_at:>='%s'") {
+    edges { node {
+      id legacyResourceId createdAt cancelledAt
+      lineItems { edges { node { id quantity product { legacyResourceId } } } }
+    } }
+  }
+}
+"""
+
+_locks = {}
+_tasks = set()
+_stats = {"orders": 0, "lines": 0, "skipped_cancelled": 0, "syncs": 0, "refreshes": 0}
+
+log = logging.getLogger(__name__)
+
+def _lock(shop):
+    lock = _locks.get(shop)
+    if lock is None:
+        lock = _locks[shop] = asyncio.Lock()
+    return lock
+
+def _timestamp(value: str) -> int:
+    return int(datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp())
+
+def _since(unix_time: float) -> str:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(unix_time))
+
+def _rows(shop: str, order: dict):
+    """(shop, order_id, product_id, quantity, created_at) per product in the order"""
+    quantities = {}
+    for item in order.get("line_items") or []:
+        # Custom items and deleted products have no product to bundle
+        if item.get("product_id"):
+            product_id = int(item["product_id"])
+            quantities[product_id] = quantities.get(product_id, 0) + int(item.get("quantity") or 1)
+    created_at = _timestamp(order["created_at"])
+    return [(shop, int(order["id"]), product_id, quantity, created_at) for product_id, quantity in quantities.items()]
+
+async def ingest(shop: str, orders: list) -> int:
+    """Store the line items of orders; returns the number of rows offered"""
+    rows = []
+    for order in orders:
+        if order.get("cancelled_at"):
+            _stats["skipped_cancelled"] += 1
+            continue
+        rows += _rows(shop, order)
+    if rows:
+        await store.executemany(
+            "INSERT OR IGNORE INTO order_lines(shop, order_id, product_id, quantity, created_at) VALUES(?,?,?,?,?)",
+            rows)
+        cooccurrence.mark_stale(shop)
+    _stats["orders"] += len(orders)
+    _stats["lines"] += len(rows)
+    return len(rows)
+
+async def _fetch_all(shop: str, token: str, since: str) -> int:
+    url = admin_url(shop, "orders.json")
+    query = {"limit": PAGE_SIZE, "status": "any", "created_at_min": since,
+             "fields": "id,created_at,cancelled_at,line_items"}
+    count = 0
+    while url:
+        r = await shopify.request(shop, "GET", url, token, shopify.BULK, params=query)
+        if r.status_code != 200:
+            raise ShopifyError(r.status_code, r.text)
+        page = r.json().get("orders", [])
+        count += len(page)
+        await ingest(shop, page)
+        # page_info URLs already carry every allowed parameter
+        url, query = next_page_url(r.headers.get("link")), None
+    return count
+
+def _from_graphql(node: dict):
+    """orders.json shape of a bulk order line"""
+    return {"id": int(node["legacyResourceId"]), "created_at": node["createdAt"],
+            "cancelled_at": node.get("cancelledAt"), "line_items": []}
+
+async def _bulk_orders(url: str):
+    """Yield orders from a bulk result file as it downloads; line items follow their order"""
+    async with upstream.shopify_client().stream("GET", url) as r:
+        if r.status_code != 200:
+            raise ShopifyError(r.status_code, (await r.aread()).decode(errors="replace")[:500])
+        order, parent = None, None
+        async for line in r.aiter_lines():
+            if not line.strip():
+                continue
+            node = json.loads(line)
+            if "__parentId" not in node:
+                if order is not None:
+                    yield order
+                order, parent = _from_graphql(node), node["id"]
+            elif node["__parentId"] == parent:
+                product = node.get("product") or {}
+                order["line_items"].append({"product_id": product.get("legacyResourceId"),
+                                            "quantity": node.get("quantity")})
+        if order is not None:
+            yield order
+
+async def _bulk_fetch_all(shop: str, token: str, since: str) -> int:
+    url = await shopify.run_bulk_query(shop, token, ORDERS_BULK_QUERY % since)
+    count, batch = 0, []
+    if url:
+        async for order in _bulk_orders(url):
+            batch.append(order)
+            if len(batch) >= BULK_BATCH_SIZE:
+                await ingest(shop, batch)
+                count, batch = count + len(batch), []
+        await ingest(shop, batch)
+    return count + len(batch)
+
+async def _order_count(shop: str, token: str, since: str) -> int:
+    r = await shopify.request(shop, "GET", admin_url(shop, "orders/count.json"), token, shopify.BULK,
+                              params={"status": "any", "created_at_min": since})
+    if r.status_code != 200:
+        raise ShopifyError(r.status_code, r.text)
+    return r.json()["count"]
+
+async def _synced_at(shop: str):
+    row = await store.fetchone("SELECT synced_at FROM orders_sync WHERE shop = ?", (shop,))
+    return row["synced_at"] if row else None
+
+async def sync(shop: str, token: str, full: bool = False, bulk: bool = None) -> int:
+    """Ingest orders created since the last sync, or the last ORDERS_LOOKBACK_DAYS
+    on the first sync or a full one (which also drops what was stored). bulk=None
+    picks a bulk operation for long histories. Returns the number of orders read."""
+    async with _lock(shop):
+        started = time.time()
+        synced_at = None if full else await _synced_at(shop)
+        if synced_at is None:
+            since = _since(started - ORDERS_LOOKBACK_DAYS * 86400)
+        else:
+            since = _since(synced_at - SYNC_OVERLAP_SECONDS)
+        if full:
+            await store.execute("DELETE FROM order_lines WHERE shop = ?", (shop,))
+            cooccurrence.forget(shop)
+        if bulk is None:
+            bulk = await _order_count(shop, token, since) >= ORDERS_BULK_THRESHOLD
+        count = await (_bulk_fetch_all(shop, token, since) if bulk else _fetch_all(shop, token, since))
+        await store.execute("INSERT OR REPLACE INTO orders_sync(shop, synced_at) VALUES(?,?)", (shop, int(started)))
+        _stats["syncs"] += 1
+        log.info("Orders synced", extra={"shop": shop, "orders": count, "bulk": bulk, "full": full})
+        return count
+
+async def _refresh_in_background(shop: str, token: str):
+    try:
+        await sync(shop, token)
+        _stats["refreshes"] += 1
+    except Exception as e:
+        log.warning("Orders refresh failed: %s", e, extra={"shop": shop})
+
+async def ensure_fresh(shop: str, token: str):
+    """Refresh a synced shop's orders in the background when they are stale.
+    Shops never synced are left alone: the first sync is an explicit job."""
+    synced_at = await _synced_at(shop)
+    if synced_at is None or _lock(shop).locked():
+        return
+    # The orders/create webhook stores new orders as they come, so once it is
+    # registered polling is only a safety net for missed deliveries
+    if await webhooks.registered(shop, "order_webhooks"):
+        stale = time.time() - synced_at > ORDERS_MAX_AGE_SECONDS
+    else:
+        stale = time.time() - synced_at > ORDERS_REFRESH_SECONDS
+    if stale:
+        task = asyncio.create_task(_refresh_in_background(shop, token))
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+def stats():
+    return dict(_stats)
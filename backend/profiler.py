@@ -0,0 +1,162 @@
+import os, sys, time, heapq, random, asyncio, weakref, threading, contextvars
+from collections import Counter
+import logs
+
+# Opt-in sampling profiler for live workers. A session (started over HTTP, no
+# restart needed) samples the event loop thread's Python stack every few
+# milliseconds and charges each sample to the request whose task is running
+# at that moment, including tasks the request spawned. When a request ends,
+# its profile is kept if it is among the slowest N of the session.
+#
+# Profiles are collapsed stacks ("root;...;leaf count" per line), which
+# flamegraph.pl, speedscope and inferno read as they are. Only time spent
+# running Python on the event loop shows up: waiting on Shopify, Claude or the
+# DB does not, which /metrics and Server-Timing already cover. Sessions and
+# profiles are per worker.
+
+# Unset disables the profiler; the endpoints then answer 404
+PROFILER_TOKEN = os.getenv("PROFILER_TOKEN")
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "600"))
+PROFILER_MAX_KEEP = int(os.getenv("PROFILER_MAX_KEEP", "50"))
+PROFILER_MAX_DEPTH = 128
+
+_profile = contextvars.ContextVar("profile", default=None)
+# Task -> Profile of the request it works for
+_tasks = weakref.WeakKeyDictionary()
+
+_session = None
+_kept = []  # min-heap of (duration, seq, Profile): the slowest requests so far
+_stats = {"sessions": 0, "profiled": 0, "samples": 0}
+
+class Profile:
+    def __init__(self, request_id, method, path):
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.started = time.time()
+        self.duration = None
+        self.stacks = Counter()
+
+    def summary(self) -> dict:
+        return {"request_id": self.request_id, "method": self.method, "path": self.path,
+                "started": self.started, "duration_ms": round(self.duration * 1000, 1),
+                "samples": sum(self.stacks.values())}
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+class _Session:
+    def __init__(self, loop, seconds, keep, interval, sample_rate):
+        self.loop = loop
+        self.until = time.monotonic() + seconds
+        self.keep = keep
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.loop_thread = threading.get_ident()
+        self.stopped = threading.Event()
+        self.previous_factory = loop.get_task_factory()
+        self.thread = threading.Thread(target=self._sample, name="profiler", daemon=True)
+
+    def active(self) -> bool:
+        return not self.stopped.is_set() and time.monotonic() < self.until
+
+    def _task_factory(self, loop, coro, **kwargs):
+        # Runs in the spawning task's context, so children inherit its request
+        if self.previous_factory is not None:
+            task = self.previous_factory(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        profile = _profile.get()
+        if profile is not None:
+            _tasks[task] = profile
+        return task
+
+    def _sample(self):
+        while not self.stopped.wait(self.interval):
+            if time.monotonic() >= self.until:
+                break
+            # asyncio keeps the running task per loop in a private dict; reading
+            # it from another thread is a race we accept for a sampler
+            task = asyncio.tasks._current_tasks.get(self.loop)
+            profile = _tasks.get(task) if task is not None else None
+            frame = sys._current_frames().get(self.loop_thread) if profile is not None else None
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < PROFILER_MAX_DEPTH:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            profile.stacks[";".join(reversed(stack))] += 1
+            _stats["samples"] += 1
+        self.stopped.set()
+
+def enabled() -> bool:
+    return bool(PROFILER_TOKEN)
+
+def start(seconds: float = 60, keep: int = 10, interval_ms: float = 5, sample_rate: float = 1.0) -> dict:
+    """Start a session on the running loop, replacing any current one and its profiles"""
+    global _session
+    stop()
+    loop = asyncio.get_running_loop()
+    _session = _Session(loop, min(seconds, PROFILER_MAX_SECONDS), max(1, min(keep, PROFILER_MAX_KEEP)),
+                        max(interval_ms, 1) / 1000, min(max(sample_rate, 0.0), 1.0))
+    _kept.clear()
+    loop.set_task_factory(_session._task_factory)
+    _session.thread.start()
+    _stats["sessions"] += 1
+    return status()
+
+def stop() -> dict:
+    if _session is not None and _session.thread.is_alive():
+        _session.stopped.set()
+        _session.thread.join()
+    if _session is not None and _session.loop.get_task_factory() == _session._task_factory:
+        _session.loop.set_task_factory(_session.previous_factory)
+    return status()
+
+def status() -> dict:
+    session = {}
+    if _session is not None:
+        session = {"active": _session.active(), "seconds_left": round(max(_session.until - time.monotonic(), 0), 1),
+                   "keep": _session.keep, "interval_ms": _session.interval * 1000,
+                   "sample_rate": _session.sample_rate}
+    return {"enabled": enabled(), "active": False, **session,
+            "profiles": [p.summary() for _, _, p in sorted(_kept, reverse=True)]}
+
+def profile(request_id: str):
+    return next((p for _, _, p in _kept if p.request_id == request_id), None)
+
+def stats() -> dict:
+    return {**_stats, "kept": len(_kept), "active": _session is not None and _session.active()}
+
+def _finish(profile: Profile, duration: float):
+    profile.duration = duration
+    _stats["profiled"] += 1
+    entry = (duration, _stats["profiled"], profile)
+    if len(_kept) < _session.keep:
+        heapq.heappush(_kept, entry)
+    elif duration > _kept[0][0]:
+        heapq.heapreplace(_kept, entry)
+
+class ProfilerMiddleware:
+    """Registers each request with the current session, if one is running"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        session = _session
+        if (scope["type"] != "http" or session is None or not session.active()
+                or random.random() >= session.sample_rate):
+            return await self.app(scope, receive, send)
+        profile = Profile(logs.request_id(), scope["method"], scope["path"])
+        task, token, started = asyncio.current_task(), _profile.set(profile), time.perf_counter()
+        _tasks[task] = profile
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _tasks.pop(task, None)
+            _profile.reset(token)
+            if session is _session:
+                _finish(profile, time.perf_counter() - started)
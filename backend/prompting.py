@@ -0,0 +1,108 @@
+import os, re, json, html, logging
+
+# Product -> prompt projection. Raw products.json carries admin IDs, image
+# metadata, timestamps and inventory that Claude has no use for, and slicing
+# the dump at a fixed length can cut it mid-value. product_json keeps only what
+# the copy is written from, as valid compact JSON under a token budget, giving
+# up variant detail first and description text last.
+
+PROMPT_PRODUCT_TOKENS = int(os.getenv("PROMPT_PRODUCT_TOKENS", "1500"))
+# Per product in a bundle prompt, which carries two
+PROMPT_BUNDLE_PRODUCT_TOKENS = int(os.getenv("PROMPT_BUNDLE_PRODUCT_TOKENS", "1000"))
+PROMPT_MAX_VARIANTS = int(os.getenv("PROMPT_MAX_VARIANTS", "10"))
+
+# What the prompts used to send: the raw dump cut at this many characters
+RAW_PROMPT_CHARS = {"generate": 8000, "bundle": 6000}
+
+_TAG = re.compile(r"<[^>]+>")
+_BLOCK_END = re.compile(r"</(p|div|li|h[1-6]|tr)>|<br\s*/?>", re.I)
+_SPACE = re.compile(r"[ \t\r\f\v]+")
+_PIECES = re.compile(r"\w+|[^\w\s]+")
+
+def estimate_tokens(text: str) -> int:
+    """Rough Claude token count without a tokenizer: about four characters per
+    word or run of punctuation. Errs high rather than low on product JSON."""
+    return sum((len(p) + 3) // 4 for p in _PIECES.findall(text))
+
+def strip_html(value: str) -> str:
+    """Text of an HTML fragment, keeping paragraph and list breaks"""
+    text = html.unescape(_TAG.sub("", _BLOCK_END.sub("\n", value or "")))
+    lines = (_SPACE.sub(" ", line).strip() for line in text.split("\n"))
+    return "\n".join(line for line in lines if line)
+
+def _price(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def project(product: dict) -> dict:
+    """The fields copy is written from, with empty ones left out"""
+    variants = product.get("variants") or []
+    prices = [p for p in (_price(v.get("price")) for v in variants) if p is not None]
+    tags = product.get("tags") or []
+    projected = {
+        "title": product.get("title"),
+        "vendor": product.get("vendor"),
+        "product_type": product.get("product_type"),
+        "tags": [t.strip() for t in tags.split(",") if t.strip()] if isinstance(tags, str) else tags,
+        "description": strip_html(product.get("body_html")),
+        "options": [{"name": o.get("name"), "values": o.get("values")} for o in product.get("options") or []
+                    # Shopify's placeholder for products without options
+                    if o.get("name") != "Title" or o.get("values") != ["Default Title"]],
+        "price_range": {"min": min(prices), "max": max(prices)} if prices else None,
+        "variant_count": len(variants),
+        "variants": [{k: v[k] for k in ("title", "price", "compare_at_price") if v.get(k)}
+                     for v in variants if v.get("title") != "Default Title"],
+    }
+    return {k: v for k, v in projected.items() if v not in (None, "", [], 0)}
+
+def _dump(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+def product_json(product: dict, budget: int = PROMPT_PRODUCT_TOKENS) -> str:
+    """Compact JSON of project(product) within budget estimated tokens"""
+    projected = project(product)
+    if "variants" in projected:
+        projected["variants"] = projected["variants"][:PROMPT_MAX_VARIANTS]
+    text = _dump(projected)
+    # Over budget: drop variant detail (the count and price range stay), then trim the description
+    while estimate_tokens(text) > budget and projected.get("variants"):
+        projected["variants"] = projected["variants"][:len(projected["variants"]) // 2]
+        if not projected["variants"]:
+            del projected["variants"]
+        text = _dump(projected)
+    overflow = estimate_tokens(text) - budget
+    if overflow > 0 and projected.get("description"):
+        description = projected["description"]
+        keep = max(0, len(description) - overflow * 4)
+        projected["description"] = description[:keep].rsplit(" ", 1)[0] + "…" if keep else ""
+        text = _dump({k: v for k, v in projected.items() if v != ""})
+    return text
+
+_stats = {}
+
+log = logging.getLogger(__name__)
+
+def record(kind: str, product: dict, text: str) -> dict:
+    """Count tokens sent to Claude for one product against what the raw dump
+    would have cost; call only for prompts actually sent. Returns this call's figures."""
+    tokens = estimate_tokens(text)
+    raw_tokens = estimate_tokens(json.dumps(product)[:RAW_PROMPT_CHARS.get(kind, 8000)])
+    s = _stats.get(kind)
+    if s is None:
+        s = _stats[kind] = {"calls": 0, "tokens": 0, "raw_tokens": 0}
+    s["calls"] += 1
+    s["tokens"] += tokens
+    s["raw_tokens"] += raw_tokens
+    call = {"kind": kind, "product_id": product.get("id"), "tokens": tokens, "raw_tokens": raw_tokens,
+            "saved": raw_tokens - tokens}
+    log.info("Product prompt", extra=call)
+    return call
+
+def stats():
+    return {
+        kind: {**s, "saved": s["raw_tokens"] - s["tokens"],
+               "avg_saved": round((s["raw_tokens"] - s["tokens"]) / s["calls"], 1) if s["calls"] else None}
+        for kind, s in _stats.items()
+    }
@@ -0,0 +1,334 @@
+import os, re, json, time, heapq, random, asyncio, itertools
+import httpx
+import upstream
+
+# Shared helpers for the Shopify Admin REST and GraphQL APIs, and the per-shop
+# request scheduler every Admin API call goes through.
+
+API_VERSION = "2024-01"
+
+# Shopify's REST leaky bucket: 40 requests that drain at 2/s on standard plans
+# (Plus shops report a larger bucket, and the leak rate is scaled to match).
+SHOPIFY_BUCKET_SIZE = int(os.getenv("SHOPIFY_BUCKET_SIZE", "40"))
+SHOPIFY_LEAK_RATE = float(os.getenv("SHOPIFY_LEAK_RATE", "2"))
+# Slots bulk work leaves free so interactive calls never queue behind it
+SHOPIFY_BULK_HEADROOM = int(os.getenv("SHOPIFY_BULK_HEADROOM", "10"))
+SHOPIFY_MAX_RETRIES = int(os.getenv("SHOPIFY_MAX_RETRIES", "4"))
+# GraphQL has its own bucket, measured in query cost points: 1000 restored at
+# 50/s on standard plans. Every response reports the actual figures.
+SHOPIFY_GRAPHQL_POINTS = float(os.getenv("SHOPIFY_GRAPHQL_POINTS", "1000"))
+SHOPIFY_GRAPHQL_RESTORE_RATE = float(os.getenv("SHOPIFY_GRAPHQL_RESTORE_RATE", "50"))
+SHOPIFY_BULK_POLL_SECONDS = float(os.getenv("SHOPIFY_BULK_POLL_SECONDS", "2"))
+
+# Request priorities; lower goes first
+INTERACTIVE = 0
+BULK = 1
+
+class ShopifyError(Exception):
+    def __init__(self, status_code: int, text: str):
+        super().__init__(f"Shopify API Error ({status_code}): {text}")
+        self.status_code = status_code
+        self.text = text
+
+    @property
+    def http_status(self):
+        """Status to answer our own client with: throttling stays a 429, the rest are a 400"""
+        return 429 if self.status_code == 429 else 400
+
+def shopify_headers(token: str):
+    return {"X-Shopify-Access-Token": token, "Content-Type": "application/json", "Accept": "application/json"}
+
+def admin_url(shop: str, path: str, version: str = API_VERSION) -> str:
+    return upstream.shopify_url(shop, f"/admin/api/{version}/{path}")
+
+_LINK_NEXT = re.compile(r'<([^>]+)>;\s*rel="next"')
+
+def next_page_url(link_header: str):
+    """URL of the next page from a cursor-paginated response's Link header"""
+    if not link_header:
+        return None
+    m = _LINK_NEXT.search(link_header)
+    return m.group(1) if m else None
+
+_sequence = itertools.count()
+
+class Bucket:
+    """Local model of one shop's leaky bucket. Requests wait in a priority queue
+    and only the head of the queue is admitted, once the bucket has room."""
+
+    def __init__(self, shop: str):
+        self.shop = shop
+        self.capacity = SHOPIFY_BUCKET_SIZE
+        self.leak_rate = SHOPIFY_LEAK_RATE
+        self.level = 0.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.in_flight = 0
+        self.queue = []
+        self._waiters = {}
+        self.requests = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        self.max_points = SHOPIFY_GRAPHQL_POINTS
+        self.restore_rate = SHOPIFY_GRAPHQL_RESTORE_RATE
+        self.points = self.max_points
+        self.points_updated = time.monotonic()
+        self.graphql_requests = 0
+        self.graphql_throttled = 0
+
+    def _delay(self, priority: int):
+        """Seconds until a request at priority may be sent"""
+        now = time.monotonic()
+        self.level = max(0.0, self.level - (now - self.updated) * self.leak_rate)
+        self.updated = now
+        if now < self.paused_until:
+            return self.paused_until - now
+        limit = self.capacity - (SHOPIFY_BULK_HEADROOM if priority >= BULK else 0)
+        excess = self.level + self.in_flight + 1 - max(limit, 1)
+        return excess / self.leak_rate if excess > 0 else 0
+
+    def _notify(self):
+        # Only the head of the queue can be admitted, so only it needs waking
+        if self.queue:
+            waiter = self._waiters.get(self.queue[0])
+            if waiter is not None and not waiter.done():
+                waiter.set_result(None)
+
+    async def _wait(self, entry, timeout):
+        loop = asyncio.get_running_loop()
+        waiter = self._waiters[entry] = loop.create_future()
+        timer = loop.call_later(timeout, lambda: waiter.done() or waiter.set_result(None)) if timeout else None
+        try:
+            await waiter
+        finally:
+            if timer:
+                timer.cancel()
+            del self._waiters[entry]
+
+    async def acquire(self, priority: int):
+        entry = (priority, next(_sequence))
+        heapq.heappush(self.queue, entry)
+        started = time.monotonic()
+        try:
+            while True:
+                delay = self._delay(priority) if self.queue[0] == entry else None
+                if delay == 0:
+                    break
+                await self._wait(entry, delay)
+        except BaseException:
+            self.queue.remove(entry)
+            heapq.heapify(self.queue)
+            self._notify()
+            raise
+        heapq.heappop(self.queue)
+        self.in_flight += 1
+        self.requests += 1
+        self.wait_seconds += time.monotonic() - started
+        self._notify()
+
+    def release(self, response: httpx.Response = None):
+        self.in_flight -= 1
+        # X-Shopify-Shop-Api-Call-Limit: "32/40" is the bucket as Shopify sees it
+        limit = response.headers.get("x-shopify-shop-api-call-limit") if response is not None else None
+        if limit and "/" in limit:
+            used, capacity = limit.split("/", 1)
+            self.capacity = int(capacity)
+            self.leak_rate = SHOPIFY_LEAK_RATE * self.capacity / SHOPIFY_BUCKET_SIZE
+            self.level, self.updated = float(used), time.monotonic()
+        elif response is not None:
+            self.level += 1
+        self._notify()
+
+    def throttle(self, response: httpx.Response, attempt: int):
+        """Shopify said 429: treat the bucket as full and pause until Retry-After, with jitter"""
+        self.throttled += 1
+        try:
+            retry_after = float(response.headers.get("retry-after", "2"))
+        except ValueError:
+            retry_after = 2.0
+        # Doubles on repeated 429s; jitter keeps concurrent retries from landing together
+        delay = retry_after * (2 ** attempt) * random.uniform(1.0, 1.5)
+        self.level = float(self.capacity)
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    def _available(self):
+        now = time.monotonic()
+        self.points = min(self.max_points, self.points + (now - self.points_updated) * self.restore_rate)
+        self.points_updated = now
+        return self.points
+
+    def spend(self, cost: float):
+        """Seconds to wait before a GraphQL query of this cost; reserves the points"""
+        delay = max(0.0, (cost - self._available()) / self.restore_rate)
+        self.points -= cost
+        return delay
+
+    def refund(self, requested: float, actual: float):
+        """Give back what a query reserved beyond its actual cost"""
+        self._available()
+        self.points = min(self.max_points, self.points + requested - actual)
+
+    def throttle_status(self, status: dict):
+        # extensions.cost.throttleStatus is the GraphQL bucket as Shopify sees it
+        self.max_points = float(status.get("maximumAvailable", self.max_points))
+        self.restore_rate = float(status.get("restoreRate", self.restore_rate))
+        self.points = float(status.get("currentlyAvailable", self.points))
+        self.points_updated = time.monotonic()
+
+    def stats(self):
+        self._delay(BULK)  # brings level up to date
+        return {
+            "queued_interactive": sum(1 for p, _ in self.queue if p < BULK),
+            "queued_bulk": sum(1 for p, _ in self.queue if p >= BULK),
+            "in_flight": self.in_flight,
+            "level": round(self.level, 1),
+            "capacity": self.capacity,
+            "paused_for": round(max(0.0, self.paused_until - time.monotonic()), 2),
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "avg_wait": round(self.wait_seconds / self.requests, 4) if self.requests else None,
+            "graphql_points": round(self._available(), 1),
+            "graphql_requests": self.graphql_requests,
+            "graphql_throttled": self.graphql_throttled,
+        }
+
+_buckets = {}
+
+def bucket(shop: str) -> Bucket:
+    b = _buckets.get(shop)
+    if b is None:
+        b = _buckets[shop] = Bucket(shop)
+    return b
+
+async def request(shop: str, method: str, url: str, token: str = None, priority: int = INTERACTIVE, **kwargs):
+    """Send one Admin API request through shop's bucket. 429s are retried after
+    Retry-After; the final response is returned whatever its status."""
+    b = bucket(shop)
+    if token is not None:
+        kwargs.setdefault("headers", shopify_headers(token))
+    for attempt in range(SHOPIFY_MAX_RETRIES + 1):
+        await b.acquire(priority)
+        r = None
+        try:
+            r = await upstream.shopify_client().request(method, url, **kwargs)
+        finally:
+            b.release(r)
+        if r.status_code != 429 or attempt == SHOPIFY_MAX_RETRIES:
+            return r
+        b.throttle(r, attempt)
+    return r
+
+def gid(resource: str, id) -> str:
+    """GraphQL global ID for a REST ID, e.g. gid("Product", 1) -> gid://shopify/Product/1"""
+    return f"gid://shopify/{resource}/{id}"
+
+def _throttled(errors: list):
+    return any((e.get("extensions") or {}).get("code") == "THROTTLED" for e in errors)
+
+async def graphql(shop: str, token: str, query: str, variables: dict = None, cost: float = 10):
+    """data of one Admin GraphQL query through shop's GraphQL budget. cost is the
+    expected query cost; throttled queries are retried once the points are back."""
+    b = bucket(shop)
+    for attempt in range(SHOPIFY_MAX_RETRIES + 1):
+        delay = b.spend(cost)
+        if delay:
+            await asyncio.sleep(delay)
+        b.graphql_requests += 1
+        try:
+            r = await upstream.shopify_client().post(admin_url(shop, "graphql.json"), headers=shopify_headers(token),
+                                                     json={"query": query, "variables": variables or {}})
+        except BaseException:
+            b.refund(cost, 0)
+            raise
+        if r.status_code == 429 and attempt < SHOPIFY_MAX_RETRIES:
+            # Not run: give the points back before reserving them again
+            b.refund(cost, 0)
+            b.graphql_throttled += 1
+            b.throttle(r, attempt)
+            await asyncio.sleep(max(0.0, b.paused_until - time.monotonic()))
+            continue
+        if r.status_code != 200:
+            b.refund(cost, 0)
+            raise ShopifyError(r.status_code, r.text)
+        body = r.json()
+        costs = (body.get("extensions") or {}).get("cost") or {}
+        if costs.get("throttleStatus"):
+            b.throttle_status(costs["throttleStatus"])
+        else:
+            b.refund(cost, costs.get("actualQueryCost") or cost)
+        errors = body.get("errors") or []
+        if errors and _throttled(errors) and attempt < SHOPIFY_MAX_RETRIES:
+            b.graphql_throttled += 1
+            cost = costs.get("requestedQueryCost") or cost
+            continue
+        if errors:
+            raise ShopifyError(r.status_code, json.dumps(errors))
+        return body["data"]
+
+# Bulk operations: Shopify runs one query over the whole store in the background
+# and leaves the result as a JSONL file, costing a few query points in total
+
+BULK_DONE = ("COMPLETED", "FAILED", "CANCELED", "EXPIRED")
+
+async def run_bulk_query(shop: str, token: str, query: str):
+    """Run query as a bulk operation and wait for it; returns the result file URL
+    (None when the query matched nothing)"""
+    data = await graphql(shop, token, """
+        mutation($query: String!) {
+          bulkOperationRunQuery(query: $query) { bulkOperation { id status } userErrors { field message } }
+        }
+    """, {"query": query})
+    result = data["bulkOperationRunQuery"]
+    if result["userErrors"]:
+        raise ShopifyError(400, json.dumps(result["userErrors"]))
+    operation = result["bulkOperation"]
+    while operation["status"] not in BULK_DONE:
+        await asyncio.sleep(SHOPIFY_BULK_POLL_SECONDS)
+        data = await graphql(shop, token, """
+            query($id: ID!) { node(id: $id) { ... on BulkOperation { id status errorCode objectCount url } } }
+        """, {"id": operation["id"]}, cost=1)
+        operation = data["node"]
+    if operation["status"] != "COMPLETED":
+        raise ShopifyError(400, f"Bulk operation {operation['status'].lower()}: {operation.get('errorCode')}")
+    return operation.get("url")
+
+def stats():
+    shops = {shop: b.stats() for shop, b in _buckets.items()}
+    return {
+        "queued": sum(s["queued_interactive"] + s["queued_bulk"] for s in shops.values()),
+        "in_flight": sum(s["in_flight"] for s in shops.values()),
+        "throttled": sum(s["throttled"] for s in shops.values()),
+        "shops": shops,
+    }
+
+# Lookups that let retried writes find what an earlier attempt already created
+
+async def find_code_discount(shop: str, token: str, code: str):
+    """{"id", "percent"} of the code discount that owns code, or None; percent
+    (0-100) is None unless it is a percentage discount"""
+    data = await graphql(shop, token, """
+        query($code: String!) { codeDiscountNodeByCode(code: $code) {
+          id
+          codeDiscount { ... on DiscountCodeBasic { customerGets { value { ... on DiscountPercentage { percentage } } } } }
+        } }
+    """, {"code": code}, cost=1)
+    node = data.get("codeDiscountNodeByCode")
+    if not node:
+        return None
+    value = ((node.get("codeDiscount") or {}).get("customerGets") or {}).get("value") or {}
+    percentage = value.get("percentage")
+    if percentage is None:
+        return {"id": node["id"], "percent": None}
+    percent = round(percentage * 100, 2)
+    return {"id": node["id"], "percent": int(percent) if percent.is_integer() else percent}
+
+def _since(unix_time: float):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(unix_time))
+
+async def find_product(shop: str, token: str, title: str, product_type: str, since: float):
+    """A product with this title and type created after since, or None"""
+    r = await request(shop, "GET", admin_url(shop, "products.json"), token,
+                      params={"title": title, "product_type": product_type, "created_at_min": _since(since)})
+    if r.status_code != 200:
+        raise ShopifyError(r.status_code, r.text)
+    return next((p for p in r.json().get("products", []) if p["title"] == title), None)
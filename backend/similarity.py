@@ -0,0 +1,277 @@
+import os, re, html, json, time, zlib, heapq, asyncio
+import numpy as np
+import store
+import cache
+
+# Per-shop product similarity index over the catalog mirror, for suggesting
+# bundle pairs without asking Claude. Each product becomes a hashed TF-IDF
+# vector of its title, tags, product type, vendor and description (word and
+# title-bigram features hashed into SIMILARITY_DIM buckets), L2-normalised so
+# a dot product is the cosine similarity.
+#
+# Indexes are built on first use and then refreshed incrementally: only rows
+# the mirror wrote since the last refresh are re-hashed, and deleted products
+# are dropped. Catalog writes in this worker mark the index stale right away;
+# writes by other workers are picked up within SIMILARITY_MAX_AGE seconds.
+#
+# "Complementary" means related but not interchangeable: near-duplicates
+# (variants listed as separate products) are skipped and pairs of the same
+# product type count for less than cross-type pairs.
+
+SIMILARITY_DIM = int(os.getenv("SIMILARITY_DIM", "1024"))
+SIMILARITY_MAX_AGE = float(os.getenv("SIMILARITY_MAX_AGE", "60"))
+SIMILARITY_MAX_SHOPS = int(os.getenv("SIMILARITY_MAX_SHOPS", "200"))
+SIMILARITY_IDLE_TTL = float(os.getenv("SIMILARITY_IDLE_TTL", "3600"))
+# Pairs at or above this similarity are the same product, not a bundle
+SIMILARITY_DUPLICATE = float(os.getenv("SIMILARITY_DUPLICATE", "0.8"))
+SIMILARITY_SAME_TYPE_WEIGHT = float(os.getenv("SIMILARITY_SAME_TYPE_WEIGHT", "0.5"))
+# Shop-wide pair search covers this many most recently updated products
+SIMILARITY_PAIR_SCAN = int(os.getenv("SIMILARITY_PAIR_SCAN", "2000"))
+BODY_WORDS = 300
+BLOCK_ROWS = 512
+
+# Feature weights by field
+WEIGHTS = {"title": 2.0, "bigram": 1.5, "tag": 1.5, "type": 1.0, "vendor": 1.0, "body": 1.0}
+
+STOP_WORDS = frozenset("""a an and are as at be by for from has have in is it its of on or our that the this
+to was were will with you your we us all any can more most new not only so than too very""".split())
+
+_WORD = re.compile(r"[a-z0-9]+(?:['-][a-z0-9]+)*")
+_TAG = re.compile(r"<[^>]+>")
+
+indexes = cache.TTLCache("similarity_index", SIMILARITY_MAX_SHOPS, SIMILARITY_IDLE_TTL)
+_stale = set()
+_locks = {}
+_stats = {"builds": 0, "refreshes": 0, "rehashed": 0, "queries": 0, "pair_scans": 0}
+
+def _words(text: str):
+    return [w for w in _WORD.findall((text or "").lower()) if w not in STOP_WORDS and len(w) > 1]
+
+def _bucket(feature: str) -> int:
+    return zlib.crc32(feature.encode()) % SIMILARITY_DIM
+
+def features(product: dict) -> dict:
+    """{feature: weight} for a product"""
+    found = {}
+
+    def add(feature, weight):
+        found[feature] = found.get(feature, 0.0) + weight
+
+    title = _words(product.get("title"))
+    for w in title:
+        add(w, WEIGHTS["title"])
+    for a, b in zip(title, title[1:]):
+        add(f"{a} {b}", WEIGHTS["bigram"])
+    for tag in (product.get("tags") or "").split(","):
+        tag = tag.strip().lower()
+        if tag:
+            add(f"tag:{tag}", WEIGHTS["tag"])
+            for w in _words(tag):
+                add(w, WEIGHTS["tag"])
+    kind = (product.get("product_type") or "").strip().lower()
+    if kind:
+        add(f"type:{kind}", WEIGHTS["type"])
+        for w in _words(kind):
+            add(w, WEIGHTS["type"])
+    vendor = (product.get("vendor") or "").strip().lower()
+    if vendor:
+        add(f"vendor:{vendor}", WEIGHTS["vendor"])
+    body = html.unescape(_TAG.sub(" ", product.get("body_html") or ""))
+    for w in _words(body)[:BODY_WORDS]:
+        add(w, WEIGHTS["body"])
+    return found
+
+def term_row(product: dict) -> np.ndarray:
+    """Sublinear term weights of a product in hashed feature space"""
+    row = np.zeros(SIMILARITY_DIM, dtype=np.float32)
+    for feature, weight in features(product).items():
+        row[_bucket(feature)] += weight
+    return np.log1p(row, out=row)
+
+class Index:
+    """One shop's term matrix, with the vectors and pair results derived from it"""
+
+    def __init__(self, ids, terms, info, watermark):
+        self.ids = ids            # int64 product IDs, one per row
+        self.terms = terms        # float32 (rows, SIMILARITY_DIM) sublinear term weights
+        self.info = info          # per row: {"id", "title", "product_type", "vendor", "updated_at"}
+        self.watermark = watermark  # products.synced of the newest row seen
+        self.checked_at = time.monotonic()
+        self.rows = {int(i): n for n, i in enumerate(ids)}
+        self._vectors = None
+        self._types = None
+        self._pairs = {}
+
+    @property
+    def vectors(self) -> np.ndarray:
+        if self._vectors is None:
+            df = np.count_nonzero(self.terms, axis=0)
+            idf = np.log((1 + len(self.ids)) / (1 + df)).astype(np.float32) + 1
+            vectors = self.terms * idf
+            norms = np.sqrt(np.einsum("ij,ij->i", vectors, vectors))
+            vectors /= np.maximum(norms, 1e-12)[:, None]
+            self._vectors = vectors
+        return self._vectors
+
+    @property
+    def types(self) -> np.ndarray:
+        if self._types is None:
+            self._types = np.array([(p["product_type"] or "").strip().lower() for p in self.info], dtype=object)
+        return self._types
+
+    def __len__(self):
+        return len(self.ids)
+
+def _product_info(row: dict) -> dict:
+    return {"id": row["id"], "title": row["title"], "product_type": row["product_type"],
+            "vendor": row["vendor"], "updated_at": row["updated_at"]}
+
+def _refresh(conn, shop: str, old):
+    """A new Index with the mirror's changes since old (or everything) applied.
+    Runs on a DB worker thread, so hashing stays off the event loop."""
+    watermark = old.watermark if old is not None else -1
+    # synced has one-second resolution: re-read the boundary second rather than
+    # miss rows, but only re-hash those whose updated_at moved
+    stamps = conn.execute("SELECT id, updated_at, synced FROM products WHERE shop = ? AND synced >= ?",
+                          (shop, watermark)).fetchall()
+    if old is not None:
+        stamps = [r for r in stamps if r["synced"] > watermark or r["id"] not in old.rows
+                  or old.info[old.rows[r["id"]]]["updated_at"] != r["updated_at"]]
+    watermark = max([watermark, *(r["synced"] for r in stamps)])
+    changed = []
+    for start in range(0, len(stamps), 500):
+        chunk = [r["id"] for r in stamps[start:start + 500]]
+        changed += conn.execute(
+            "SELECT id, title, vendor, product_type, tags, updated_at, data FROM products "
+            f"WHERE shop = ? AND id IN ({','.join('?' * len(chunk))})", [shop, *chunk]).fetchall()
+    current = {r[0] for r in conn.execute("SELECT id FROM products WHERE shop = ?", (shop,))}
+    if old is not None and not changed and len(current) == len(old) and all(i in old.rows for i in current):
+        old.checked_at = time.monotonic()
+        return old
+
+    updates = {}
+    for r in changed:
+        product = json.loads(r["data"])
+        # The indexed columns win over the JSON blob if they ever disagree
+        product.update({k: r[k] for k in ("title", "vendor", "product_type", "tags")})
+        updates[r["id"]] = (term_row(product), _product_info(r))
+    added = [i for i in updates if i in current]
+    if old is not None:
+        kept = np.array([i in current and i not in updates for i in old.ids.tolist()], dtype=bool)
+        ids, terms = old.ids[kept], old.terms[kept]
+        info = [meta for meta, keep in zip(old.info, kept) if keep]
+    else:
+        ids, terms, info = np.zeros(0, dtype=np.int64), np.zeros((0, SIMILARITY_DIM), dtype=np.float32), []
+    if added:
+        ids = np.concatenate([ids, np.array(added, dtype=np.int64)])
+        terms = np.vstack([terms, *(updates[i][0][None, :] for i in added)])
+        info += [updates[i][1] for i in added]
+    _stats["rehashed"] += len(updates)
+    index = Index(ids, terms, info, watermark)
+    # Derive these here too, rather than on the event loop at the first query
+    index.vectors, index.types
+    return index
+
+def _lock(shop):
+    lock = _locks.get(shop)
+    if lock is None:
+        lock = _locks[shop] = asyncio.Lock()
+    return lock
+
+def mark_stale(shop: str):
+    """The shop's catalog mirror changed; refresh its index before the next query"""
+    _stale.add(shop)
+
+async def get_index(shop: str) -> Index:
+    index = indexes.get(shop)
+    if index is not None and shop not in _stale and time.monotonic() - index.checked_at < SIMILARITY_MAX_AGE:
+        return index
+    async with _lock(shop):
+        index = indexes.get(shop)
+        if index is None or shop in _stale or time.monotonic() - index.checked_at >= SIMILARITY_MAX_AGE:
+            _stale.discard(shop)
+            refreshed = await store.run(_refresh, shop, index)
+            _stats["builds" if index is None else "refreshes"] += 1
+            indexes.set(shop, refreshed)
+            index = refreshed
+    return index
+
+def _scores(index: Index, similarities: np.ndarray, kinds) -> np.ndarray:
+    """Complementarity scores from cosine similarities; excluded pairs score -inf"""
+    scores = np.where(kinds, similarities * SIMILARITY_SAME_TYPE_WEIGHT, similarities)
+    return np.where(similarities >= SIMILARITY_DUPLICATE, -np.inf, scores)
+
+def _pair(index: Index, a: int, b: int, score: float, similarity: float) -> dict:
+    return {"product_a_id": int(index.ids[a]), "product_b_id": int(index.ids[b]),
+            "score": round(float(score), 4), "similarity": round(float(similarity), 4),
+            "product_a": index.info[a], "product_b": index.info[b]}
+
+def partners(index: Index, product_id: int, k: int = 10) -> list:
+    """The k best bundle partners for one product, best first"""
+    row = index.rows[int(product_id)]
+    vectors = index.vectors
+    similarities = vectors @ vectors[row]
+    kind = index.types[row]
+    scores = _scores(index, similarities, (index.types == kind) & (kind != ""))
+    scores[row] = -np.inf
+    k = min(k, len(index) - 1)
+    if k <= 0:
+        return []
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [_pair(index, row, int(j), scores[j], similarities[j]) for j in top if scores[j] > 0]
+
+def _scan_pairs(index: Index, k: int) -> list:
+    """Best k pairs among the most recently updated products, each product in at most one pair"""
+    rows = np.arange(len(index))
+    if len(rows) > SIMILARITY_PAIR_SCAN:
+        recent = sorted(rows.tolist(), key=lambda n: index.info[n]["updated_at"] or "", reverse=True)
+        rows = np.array(recent[:SIMILARITY_PAIR_SCAN])
+    vectors, types = index.vectors[rows], index.types[rows]
+    # Enough candidates that the one-pair-per-product rule still leaves k
+    want = 4 * k
+    candidates = []
+    for start in range(0, len(rows), BLOCK_ROWS):
+        block = slice(start, start + BLOCK_ROWS)
+        similarities = vectors[block] @ vectors.T
+        same = (types[block, None] == types[None, :]) & (types[block, None] != "")
+        scores = _scores(index, similarities, same)
+        # Each pair once: only partners after the row itself
+        scores[np.tril_indices(scores.shape[0], k=start, m=scores.shape[1])] = -np.inf
+        flat = scores.ravel()
+        take = min(want, flat.size)
+        for n in np.argpartition(-flat, take - 1)[:take]:
+            if flat[n] > 0:
+                i, j = divmod(int(n), scores.shape[1])
+                candidates.append((float(flat[n]), start + i, j, float(similarities[i, j])))
+        candidates = heapq.nlargest(want, candidates)
+    pairs, used = [], set()
+    for score, i, j, similarity in candidates:
+        if i not in used and j not in used:
+            used.update((i, j))
+            pairs.append(_pair(index, int(rows[i]), int(rows[j]), score, similarity))
+            if len(pairs) == k:
+                break
+    return pairs
+
+async def suggest(shop: str, product_id=None, k: int = 10) -> dict:
+    """Top-k bundle pairs for the shop, or the top-k partners of product_id. None if the product isn't indexed."""
+    index = await get_index(shop)
+    _stats["queries"] += 1
+    if product_id is not None:
+        if int(product_id) not in index.rows:
+            return None
+        return {"pairs": partners(index, product_id, k), "indexed": len(index)}
+    pairs = index._pairs.get(k)
+    if pairs is None:
+        # Block matrix products release the GIL; run them off the event loop
+        pairs = index._pairs[k] = await asyncio.to_thread(_scan_pairs, index, k)
+        _stats["pair_scans"] += 1
+    return {"pairs": pairs, "indexed": len(index)}
+
+def stats():
+    shops = [(shop, index) for shop, (index, _) in indexes._data.items()]
+    return {**_stats, "dim": SIMILARITY_DIM, "shops": len(shops),
+            "products": sum(len(index) for _, index in shops),
+            "bytes": sum(index.terms.nbytes + (index._vectors.nbytes if index._vectors is not None else 0)
+                         for _, index in shops)}
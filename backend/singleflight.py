@@ -0,0 +1,59 @@
+import asyncio
+
+# Request coalescing: concurrent callers with the same key share one upstream
+# call instead of each issuing their own. The shared call runs as its own task,
+# so one caller going away (client disconnect -> cancellation) does not affect
+# the others; it is only cancelled once every caller waiting on it has left.
+
+groups = {}
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self.abandoned = 0
+        self._inflight = {}
+        groups[name] = self
+
+    def _forget(self, key, call):
+        if self._inflight.get(key) is call:
+            del self._inflight[key]
+
+    async def do(self, key, fn):
+        """Await fn(), or the already running call for key"""
+        call = self._inflight.get(key)
+        if call is None:
+            call = self._inflight[key] = _Call(asyncio.ensure_future(fn()))
+            call.task.add_done_callback(lambda _, key=key, call=call: self._forget(key, call))
+            self.calls += 1
+        else:
+            self.coalesced += 1
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                # Every caller was cancelled; nobody is left to use the result
+                self._forget(key, call)
+                call.task.cancel()
+                self.abandoned += 1
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "abandoned": self.abandoned,
+            "in_flight": len(self._inflight),
+        }
+
+def stats():
+    return {name: group.stats() for name, group in groups.items()}
@@ -0,0 +1,223 @@
+import os, time, sqlite3, asyncio, threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+# SQLite persistence layer.
+# Schema is migrated once at startup, the database runs in WAL mode, and every
+# query runs on a small bounded pool of worker threads (one connection per
+# thread) so handlers never block the event loop on disk I/O.
+
+DB_PATH = os.getenv("DB_PATH", "app.db")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL")  # WAL + NORMAL is durable across app crashes
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+
+# Append-only, one statement per entry: each is applied once and recorded in
+# PRAGMA user_version.
+# Existing databases created by the old db() helper already have these tables,
+# hence IF NOT EXISTS on the first migrations.
+MIGRATIONS = [
+    """CREATE TABLE IF NOT EXISTS shops(
+      id INTEGER PRIMARY KEY, shop TEXT UNIQUE, access_token TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS runs(
+      id INTEGER PRIMARY KEY, shop TEXT, product_id TEXT, cost_tokens INTEGER, created_at INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS runs_shop_created ON runs(shop, created_at)",
+    # Local product catalog mirror (see catalog.py)
+    """CREATE TABLE IF NOT EXISTS products(
+      shop TEXT NOT NULL, id INTEGER NOT NULL, title TEXT, vendor TEXT, product_type TEXT, tags TEXT,
+      status TEXT, updated_at TEXT, data TEXT NOT NULL, synced INTEGER NOT NULL,
+      PRIMARY KEY(shop, id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS catalog_sync(
+      shop TEXT PRIMARY KEY, synced_at INTEGER
+    )""",
+    # Webhook delivery dedup and per-shop change markers (see webhooks.py)
+    """CREATE TABLE IF NOT EXISTS webhook_events(
+      webhook_id TEXT PRIMARY KEY, shop TEXT, topic TEXT, received_at INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS webhook_events_received ON webhook_events(received_at)",
+    """CREATE TABLE IF NOT EXISTS shop_changes(
+      shop TEXT NOT NULL, resource TEXT NOT NULL, changed_at INTEGER, PRIMARY KEY(shop, resource)
+    )""",
+    # Cached Claude generations (see suggestions.py)
+    """CREATE TABLE IF NOT EXISTS suggestions(
+      key TEXT PRIMARY KEY, kind TEXT, value TEXT NOT NULL, created_at INTEGER, accessed_at INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS suggestions_accessed ON suggestions(accessed_at)",
+    # Message Batches jobs and their per-request results (see claude_batches.py)
+    """CREATE TABLE IF NOT EXISTS claude_batches(
+      id INTEGER PRIMARY KEY, shop TEXT, kind TEXT, anthropic_id TEXT UNIQUE, status TEXT,
+      request_counts TEXT, created_at INTEGER, updated_at INTEGER, ended_at INTEGER
+    )""",
+    "CREATE INDEX IF NOT EXISTS claude_batches_status ON claude_batches(status)",
+    """CREATE TABLE IF NOT EXISTS claude_batch_items(
+      batch_id INTEGER NOT NULL REFERENCES claude_batches(id), custom_id TEXT NOT NULL, product_id TEXT,
+      cache_key TEXT, status TEXT, result TEXT, error TEXT, PRIMARY KEY(batch_id, custom_id)
+    )""",
+    # Durable background jobs with per-step checkpoints (see jobs.py)
+    """CREATE TABLE IF NOT EXISTS jobs(
+      id INTEGER PRIMARY KEY, shop TEXT NOT NULL, kind TEXT NOT NULL, idempotency_key TEXT,
+      status TEXT NOT NULL, step TEXT, payload TEXT NOT NULL, checkpoint TEXT, result TEXT, error TEXT,
+      attempts INTEGER NOT NULL DEFAULT 0, run_after INTEGER NOT NULL DEFAULT 0,
+      created_at INTEGER, updated_at INTEGER, UNIQUE(shop, idempotency_key)
+    )""",
+    "CREATE INDEX IF NOT EXISTS jobs_queue ON jobs(status, run_after)",
+    # Token usage of every Claude call (see accounting.py)
+    """CREATE TABLE IF NOT EXISTS llm_usage(
+      id INTEGER PRIMARY KEY, shop TEXT, product_id TEXT, endpoint TEXT NOT NULL, model TEXT,
+      input_tokens INTEGER NOT NULL DEFAULT 0, output_tokens INTEGER NOT NULL DEFAULT 0,
+      cache_creation_input_tokens INTEGER NOT NULL DEFAULT 0, cache_read_input_tokens INTEGER NOT NULL DEFAULT 0,
+      latency_ms INTEGER, created_at INTEGER NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS llm_usage_created ON llm_usage(created_at)",
+    "CREATE INDEX IF NOT EXISTS llm_usage_shop_created ON llm_usage(shop, created_at)",
+    "CREATE INDEX IF NOT EXISTS llm_usage_shop_product ON llm_usage(shop, product_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS runs_shop_product ON runs(shop, product_id, created_at)",
+    # ID of the HTTP request that queued the job, carried into its logs and upstream calls
+    "ALTER TABLE jobs ADD COLUMN request_id TEXT",
+    # One row per product per order, for bundle co-occurrence (see orders.py)
+    """CREATE TABLE IF NOT EXISTS order_lines(
+      id INTEGER PRIMARY KEY, shop TEXT NOT NULL, order_id INTEGER NOT NULL, product_id INTEGER NOT NULL,
+      quantity INTEGER NOT NULL, created_at INTEGER NOT NULL, UNIQUE(shop, order_id, product_id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS order_lines_shop_id ON order_lines(shop, id)",
+    """CREATE TABLE IF NOT EXISTS orders_sync(
+      shop TEXT PRIMARY KEY, synced_at INTEGER
+    )""",
+    # Expiry sweep of the suggestion cache
+    "CREATE INDEX IF NOT EXISTS suggestions_created ON suggestions(created_at)",
+    # Process running a job and until when; an expired lease means it stopped (see jobs.py)
+    "ALTER TABLE jobs ADD COLUMN owner TEXT",
+    "ALTER TABLE jobs ADD COLUMN lease_until INTEGER",
+]
+
+_executor = None
+_local = threading.local()
+_connections = []
+_lock = threading.Lock()
+_ready = False
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, timeout=DB_BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute("PRAGMA foreign_keys = ON")
+    return conn
+
+def init_db():
+    """Enable WAL and apply pending migrations. Safe to call more than once."""
+    global _ready
+    with _lock:
+        if _ready:
+            return
+        conn = _connect()
+        try:
+            conn.execute("PRAGMA journal_mode = WAL")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for i, sql in enumerate(MIGRATIONS[version:], start=version + 1):
+                with conn:
+                    conn.execute(sql)
+                    conn.execute(f"PRAGMA user_version = {i}")
+        finally:
+            conn.close()
+        _ready = True
+
+def _conn():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        init_db()
+        conn = _local.conn = _connect()
+        with _lock:
+            _connections.append(conn)
+    return conn
+
+def _pool():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+    return _executor
+
+def close_db():
+    global _executor, _ready
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+    with _lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+        _ready = False
+
+async def run(fn, *args):
+    """Run fn(conn, *args) on a pooled connection without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    submitted, timing = time.perf_counter(), {}
+
+    def call():
+        started = timing["started"] = time.perf_counter()
+        try:
+            return fn(_conn(), *args)
+        finally:
+            timing["ran"] = time.perf_counter() - started
+
+    try:
+        return await loop.run_in_executor(_pool(), call)
+    finally:
+        # fetchone, execute...; or jobs.insert for queries run from elsewhere
+        op = fn.__name__.lstrip("_") if fn.__module__ == __name__ else f"{fn.__module__}.{fn.__name__}"
+        started = timing.get("started")
+        metrics.record_db(op, started - submitted if started else None, timing.get("ran"),
+                          time.perf_counter() - submitted)
+
+def _fetchone(conn, sql, params):
+    row = conn.execute(sql, params).fetchone()
+    return dict(row) if row else None
+
+def _fetchall(conn, sql, params):
+    return [dict(r) for r in conn.execute(sql, params).fetchall()]
+
+def _execute(conn, sql, params):
+    with conn:
+        return conn.execute(sql, params).rowcount
+
+def _executemany(conn, sql, rows):
+    with conn:
+        return conn.executemany(sql, rows).rowcount
+
+async def fetchone(sql: str, params=()):
+    return await run(_fetchone, sql, params)
+
+async def fetchall(sql: str, params=()):
+    return await run(_fetchall, sql, params)
+
+async def execute(sql: str, params=()):
+    return await run(_execute, sql, params)
+
+async def executemany(sql: str, rows):
+    return await run(_executemany, sql, list(rows))
+
+# shops
+
+async def get_shop(shop: str):
+    return await fetchone("SELECT * FROM shops WHERE shop = ?", (shop,))
+
+async def save_shop(shop: str, access_token: str):
+    await execute("INSERT OR REPLACE INTO shops(shop, access_token) VALUES(?,?)", (shop, access_token))
+
+async def delete_shop(shop: str):
+    await execute("DELETE FROM shops WHERE shop = ?", (shop,))
+
+# runs
+
+async def add_run(shop: str, product_id: str, cost_tokens: int = 0):
+    await execute("INSERT INTO runs(shop, product_id, cost_tokens, created_at) VALUES(?,?,?,?)",
+                  (shop, str(product_id), cost_tokens, int(time.time())))
+
+async def add_runs(shop: str, cost_tokens: dict):
+    """One run per product in {product_id: cost_tokens}"""
+    now = int(time.time())
+    await executemany("INSERT INTO runs(shop, product_id, cost_tokens, created_at) VALUES(?,?,?,?)",
+                      [(shop, str(p), tokens, now) for p, tokens in cost_tokens.items()])
@@ -0,0 +1,163 @@
+import os, json, time, hashlib, asyncio, logging
+import store
+import cache
+from singleflight import SingleFlight
+
+# Persistent content-addressed cache for Claude generations.
+# Keys hash the input as Claude sees it together with the prompt template and
+# model, so any change to what is sent, the prompt or the model is a miss. Entries are
+# fresh for SUGGESTION_CACHE_TTL; for a further SUGGESTION_CACHE_STALE seconds
+# they are still served but regenerated in the background. The least recently
+# used entries are evicted beyond SUGGESTION_CACHE_MAX_ENTRIES.
+#
+# Reads never write: a hit only notes the access in memory (at most once per
+# SUGGESTION_CACHE_TOUCH_SECONDS per key), and a sweep every
+# SUGGESTION_CACHE_SWEEP_SECONDS writes those in one batch, then drops expired
+# entries and trims to the size limit.
+
+SUGGESTION_CACHE_TTL = float(os.getenv("SUGGESTION_CACHE_TTL", str(7 * 24 * 3600)))
+SUGGESTION_CACHE_STALE = float(os.getenv("SUGGESTION_CACHE_STALE", str(30 * 24 * 3600)))
+SUGGESTION_CACHE_MAX_ENTRIES = int(os.getenv("SUGGESTION_CACHE_MAX_ENTRIES", "10000"))
+SUGGESTION_CACHE_SWEEP_SECONDS = float(os.getenv("SUGGESTION_CACHE_SWEEP_SECONDS", "60"))
+SUGGESTION_CACHE_TOUCH_SECONDS = float(os.getenv("SUGGESTION_CACHE_TOUCH_SECONDS", "300"))
+
+log = logging.getLogger(__name__)
+
+def fingerprint(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+def make_key(kind: str, *parts) -> str:
+    raw = json.dumps([kind, *parts], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+class SuggestionCache:
+    name = "suggestions"
+
+    def __init__(self):
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self._revalidating = {}
+        self._touched = {}   # key -> last access not yet written
+        self.sweeps = 0
+        self.evicted = 0
+        # Identical concurrent generations (double clicks, retries) share one Claude call
+        self.flight = SingleFlight("claude")
+        cache.caches[self.name] = self
+
+    async def lookup(self, key):
+        """(value, fresh) for key, or (None, None); does not touch the counters"""
+        row = await store.fetchone("SELECT value, created_at, accessed_at FROM suggestions WHERE key = ?", (key,))
+        if row is None:
+            return None, None
+        now = time.time()
+        age = now - row["created_at"]
+        if age > SUGGESTION_CACHE_TTL + SUGGESTION_CACHE_STALE:
+            return None, None
+        if now - row["accessed_at"] >= SUGGESTION_CACHE_TOUCH_SECONDS:
+            self._touched[key] = int(now)
+        return json.loads(row["value"]), age <= SUGGESTION_CACHE_TTL
+
+    async def put(self, key, kind, value):
+        now = int(time.time())
+        await store.execute(
+            "INSERT OR REPLACE INTO suggestions(key, kind, value, created_at, accessed_at) VALUES(?,?,?,?,?)",
+            (key, kind, json.dumps(value), now, now))
+
+    async def sweep(self):
+        """Write noted accesses, drop expired entries and trim to SUGGESTION_CACHE_MAX_ENTRIES"""
+        touched, self._touched = self._touched, {}
+        now = int(time.time())
+
+        def run(conn):
+            with conn:
+                conn.executemany("UPDATE suggestions SET accessed_at = max(accessed_at, ?) WHERE key = ?",
+                                 [(at, key) for key, at in touched.items()])
+                expired = conn.execute("DELETE FROM suggestions WHERE created_at < ?",
+                                       (now - int(SUGGESTION_CACHE_TTL + SUGGESTION_CACHE_STALE),)).rowcount
+                return expired + conn.execute(
+                    """DELETE FROM suggestions WHERE key IN (
+                         SELECT key FROM suggestions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)""",
+                    (SUGGESTION_CACHE_MAX_ENTRIES,)).rowcount
+
+        self.evicted += await store.run(run)
+        self.sweeps += 1
+
+    async def _compute(self, key, kind, compute):
+        async def generate_and_store():
+            value = await compute()
+            await self.put(key, kind, value)
+            return value
+        return await self.flight.do(key, generate_and_store)
+
+    async def _revalidate(self, key, kind, compute):
+        try:
+            await self._compute(key, kind, compute)
+        except Exception as e:
+            log.warning("Background refresh of %s suggestion failed: %s", kind, e)
+        finally:
+            self._revalidating.pop(key, None)
+
+    async def get_or_compute(self, key: str, kind: str, compute, force_refresh: bool = False):
+        """Return (value, status) where status is hit, stale, miss or refresh"""
+        if force_refresh:
+            self.refreshes += 1
+            return await self._compute(key, kind, compute), "refresh"
+        value, fresh = await self.lookup(key)
+        if value is None:
+            self.misses += 1
+            return await self._compute(key, kind, compute), "miss"
+        if fresh:
+            self.hits += 1
+            return value, "hit"
+        self.stale_hits += 1
+        if key not in self._revalidating:
+            self._revalidating[key] = asyncio.create_task(self._revalidate(key, kind, compute))
+        return value, "stale"
+
+    def stats(self):
+        total = self.hits + self.stale_hits + self.misses
+        return {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "revalidating": len(self._revalidating),
+            "pending_touches": len(self._touched),
+            "sweeps": self.sweeps,
+            "evicted": self.evicted,
+            "hit_ratio": round((self.hits + self.stale_hits) / total, 4) if total else None,
+            "ttl": SUGGESTION_CACHE_TTL,
+            "stale_window": SUGGESTION_CACHE_STALE,
+            "max_entries": SUGGESTION_CACHE_MAX_ENTRIES,
+        }
+
+suggestion_cache = SuggestionCache()
+
+_sweeper = None
+
+async def _sweep_forever():
+    while True:
+        await asyncio.sleep(SUGGESTION_CACHE_SWEEP_SECONDS)
+        try:
+            await suggestion_cache.sweep()
+        except Exception as e:
+            log.warning("Suggestion cache sweep failed: %s", e)
+
+def start_sweeper():
+    global _sweeper
+    if _sweeper is None:
+        _sweeper = asyncio.create_task(_sweep_forever())
+
+async def stop_sweeper():
+    global _sweeper
+    if _sweeper is not None:
+        _sweeper.cancel()
+        try:
+            await _sweeper
+        except asyncio.CancelledError:
+            pass
+        _sweeper = None
+    # Accesses noted since the last sweep still count for eviction order
+    await suggestion_cache.sweep()
@@ -0,0 +1,56 @@
+import os, tempfile
+
+# Settings are read at import time: point every module at a scratch database
+# and make the fakes answer at once before anything else is imported
+os.environ.update({
+    "DB_PATH": os.path.join(tempfile.mkdtemp(), "test.db"),
+    "CLAUDE_API_KEY": "test",
+    "LOG_LEVEL": "WARNING",
+    "FAKE_PRODUCTS": "30",
+    "FAKE_VARIANTS": "2",
+    "FAKE_ORDERS": "600",
+    "FAKE_BATCH_SECONDS": "0",
+    "FAKE_BULK_SECONDS": "0",
+    "SHOPIFY_BULK_POLL_SECONDS": "0.01",
+})
+
+import httpx
+import pytest
+import store
+import upstream
+from fakes import shopify as fake_shopify, anthropic as fake_anthropic
+
+# Tests share one database; each uses its own shop domain
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+@pytest.fixture
+async def fakes():
+    """Upstream clients pointed at the in-process fake Shopify and Anthropic apps"""
+    store.init_db()
+    await upstream.close_clients()
+    upstream._clients["shopify"] = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake_shopify.app))
+    upstream._clients["claude"] = httpx.AsyncClient(transport=httpx.ASGITransport(app=fake_anthropic.app))
+    yield {"shopify": fake_shopify, "anthropic": fake_anthropic}
+    await upstream.close_clients()
+
+@pytest.fixture
+async def client(fakes):
+    """Client for the app itself, without its lifespan's background workers"""
+    import main
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as c:
+        yield c
+
+@pytest.fixture
+def run_job():
+    """Run one queued job to its end in the test, without the background workers"""
+    import jobs
+
+    async def run(job_id):
+        row = await store.fetchone("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        await jobs._run(row)
+        return await jobs.get(job_id)
+
+    return run
@@ -0,0 +1,89 @@
+import pytest
+import store
+import jobs
+import main
+
+pytestmark = pytest.mark.anyio
+
+def item(product_id, code="LAUNCH10", percent=10):
+    return {"product_id": product_id, "suggestion": {
+        "title": f"Better product {product_id}", "description_html": "<p>Better</p>", "tags": "a, b",
+        "discount_code": code, "discount_percent": percent}}
+
+async def apply(client, shop, items):
+    r = await client.post("/api/apply/batch", json={"shop": shop, "items": items})
+    assert r.status_code == 202, r.text
+    return r.json()["job_id"]
+
+def test_discount_groups_share_one_discount_per_percentage():
+    groups, percent_of = main.discount_groups([
+        item(1, "SAVE10", 10), item(2, "save10", 20), item(3, "B", 10), item(4, "C", "20")])
+    # Codes are case-insensitive and the first item to use one sets its percentage
+    assert groups == {10: ["SAVE10", "B"], 20: ["C"]}
+    assert percent_of == {"SAVE10": 10, "B": 10, "C": 20}
+
+@pytest.mark.parametrize("suggestion, error", [
+    ({"discount_percent": 10}, "discount_code"),
+    ({"discount_code": "  ", "discount_percent": 10}, "discount_code"),
+    ({"discount_code": "X"}, "discount_percent"),
+    ({"discount_code": "X", "discount_percent": "ten"}, "discount_percent"),
+    ({"discount_code": "X", "discount_percent": 12.5}, "discount_percent"),
+    ({"discount_code": "X", "discount_percent": True}, "discount_percent"),
+    ({"discount_code": "X", "discount_percent": 0}, "discount_percent"),
+])
+async def test_items_without_a_usable_discount_are_rejected(client, suggestion, error):
+    shop = "apply-invalid.myshopify.com"
+    await store.save_shop(shop, "token")
+    items = [item(1), {"product_id": 2, "suggestion": {**item(2)["suggestion"], **suggestion}}]
+    for key in ("discount_code", "discount_percent"):
+        if key not in suggestion:
+            items[1]["suggestion"].pop(key)
+    r = await client.post("/api/apply/batch", json={"shop": shop, "items": items})
+    assert r.status_code == 400
+    assert r.json()["detail"].startswith("Item 1") and error in r.json()["detail"]
+
+async def test_a_retry_repeats_only_the_failed_items(client, fakes, run_job, monkeypatch):
+    shop = "apply-retry.myshopify.com"
+    calls = fakes["shopify"].calls
+    await store.save_shop(shop, "token")
+    job_id = await apply(client, shop, [item(1), item(2), item(3, "LAUNCH20", 20)])
+
+    update_product_fields, attempts = main.update_product_fields, []
+
+    async def flaky(shop, token, product_id, s):
+        attempts.append(product_id)
+        if product_id == 2 and attempts.count(2) == 1:
+            raise jobs.JobError("Shopify is busy", retryable=True)
+        return await update_product_fields(shop, token, product_id, s)
+
+    monkeypatch.setattr(main, "update_product_fields", flaky)
+    calls.clear()
+    job = await run_job(job_id)
+    assert job["status"] == "queued"
+    assert job["error"] == "1 of 3 items failed"
+    assert calls["graphql discountCodeBasicCreate"] == 2
+
+    job = await run_job(job_id)
+    assert job["status"] == "succeeded"
+    assert sorted(attempts) == [1, 2, 2, 3]
+    # The discounts were checkpointed by the first attempt
+    assert calls["graphql discountCodeBasicCreate"] == 2
+    assert job["result"]["succeeded"] == 3
+    assert job["result"]["discounts"] == 2
+
+async def test_a_reused_code_at_another_percentage_is_reported(client, fakes, run_job):
+    shop = "apply-taken.myshopify.com"
+    await store.save_shop(shop, "token")
+    assert (await run_job(await apply(client, shop, [item(1, "SPRING", 15)])))["result"]["succeeded"] == 1
+
+    job = await run_job(await apply(client, shop, [
+        item(2, "spring", 10), item(3, "SPRING", 15), item(4, "NEW", 10), item(5, "new", 20)]))
+    assert job["status"] == "succeeded"
+    results = {r["product_id"]: r for r in job["result"]["items"]}
+    assert not results[2]["ok"]
+    assert results[2]["error"] == "Discount code spring is already 15% off, not 10% off"
+    assert results[3]["ok"] and results[3]["discount_id"] == results[2]["discount_id"]
+    # NEW shares a percentage with spring but not its existing discount
+    assert results[4]["ok"] and results[4]["discount_id"] != results[2]["discount_id"]
+    assert results[5]["error"] == "Discount code new is already 10% off, not 20% off"
+    assert job["result"]["failed"] == 2
@@ -0,0 +1,96 @@
+import json
+import httpx
+import pytest
+import store
+import upstream
+import catalog
+from shopify import ShopifyError
+
+pytestmark = pytest.mark.anyio
+
+def bulk_file(lines, chunk: int = 7):
+    """Shopify client serving lines as one JSONL file, in chunks that split lines mid-way"""
+    body = "".join(json.dumps(line) + "\n" for line in lines).encode()
+
+    async def chunks():
+        for i in range(0, len(body), chunk):
+            yield body[i:i + chunk]
+
+    return httpx.AsyncClient(transport=httpx.MockTransport(lambda request: httpx.Response(200, content=chunks())))
+
+def product_line(i):
+    return {"id": f"gid://shopify/Product/{i}", "legacyResourceId": str(i), "title": f"Product {i}",
+            "tags": ["a", "b"], "status": "ACTIVE", "updatedAt": "2024-06-01T00:00:00Z"}
+
+def variant_line(product, v):
+    return {"id": f"gid://shopify/ProductVariant/{v}", "legacyResourceId": str(v), "title": f"Variant {v}",
+            "price": "5.00", "__parentId": f"gid://shopify/Product/{product}"}
+
+def image_line(product, image):
+    return {"id": f"gid://shopify/ProductImage/{image}", "url": f"https://cdn.example.com/{image}.jpg",
+            "__parentId": f"gid://shopify/Product/{product}"}
+
+async def test_children_are_attached_to_the_product_before_them(fakes):
+    upstream._clients["shopify"] = bulk_file([
+        product_line(1), variant_line(1, 10), variant_line(1, 11), image_line(1, 100),
+        product_line(2),
+        product_line(3), image_line(3, 300), variant_line(3, 30),
+        # A child whose parent isn't the product being read is dropped, not misattached
+        variant_line(1, 12),
+    ])
+    products = [p async for p in catalog._bulk_products("https://shop/bulk.jsonl")]
+
+    assert [p["id"] for p in products] == [1, 2, 3]
+    first, second, third = products
+    assert [v["id"] for v in first["variants"]] == [10, 11]
+    assert all(v["product_id"] == 1 and v["price"] == "5.00" for v in first["variants"])
+    assert first["images"] == [{"id": 100, "product_id": 1, "src": "https://cdn.example.com/100.jpg", "alt": None}]
+    assert first["tags"] == "a, b" and first["status"] == "active"
+    assert second["variants"] == [] and second["images"] == []
+    assert [v["id"] for v in third["variants"]] == [30] and [i["id"] for i in third["images"]] == [300]
+
+async def test_failed_download_raises():
+    upstream._clients["shopify"] = httpx.AsyncClient(
+        transport=httpx.MockTransport(lambda request: httpx.Response(403, text="AccessDenied")))
+    with pytest.raises(ShopifyError) as e:
+        [p async for p in catalog._bulk_products("https://shop/bulk.jsonl")]
+    assert e.value.status_code == 403
+    await upstream.close_clients()
+
+async def test_bulk_sync_mirrors_what_rest_sync_does(fakes):
+    assert await catalog.full_sync("rest.myshopify.com", "token", bulk=False) == 30
+    assert await catalog.full_sync("bulk.myshopify.com", "token", bulk=True) == 30
+    for product_id in (1, 17, 30):
+        rest = await catalog.get_product("rest.myshopify.com", product_id)
+        bulk = await catalog.get_product("bulk.myshopify.com", product_id)
+        # Bulk lines carry no options; everything else matches
+        rest.pop("options", None)
+        assert bulk == rest
+
+async def test_bulk_full_sync_drops_products_deleted_upstream(fakes, monkeypatch):
+    shop = "shrinking.myshopify.com"
+    await catalog.full_sync(shop, "token", bulk=True)
+    # Sync stamps are whole seconds: make the first sync an earlier one
+    await store.execute("UPDATE products SET synced = synced - 10 WHERE shop = ?", (shop,))
+    monkeypatch.setattr(fakes["shopify"], "FAKE_PRODUCTS", 20)
+    assert await catalog.full_sync(shop, "token", bulk=True) == 20
+    row = await store.fetchone("SELECT count(*) AS n, max(id) AS last FROM products WHERE shop = ?", (shop,))
+    assert (row["n"], row["last"]) == (20, 20)
+
+async def test_first_sync_of_a_large_catalog_is_a_bulk_operation(client, fakes, monkeypatch):
+    shop = "first-sync.myshopify.com"
+    await store.save_shop(shop, "token")
+    monkeypatch.setattr(catalog, "CATALOG_BULK_THRESHOLD", 20)
+    fakes["shopify"].calls.clear()
+    r = await client.get("/api/products", params={"shop": shop, "limit": 50})
+    assert r.status_code == 200
+    assert len(r.json()["products"]) == 30
+    assert fakes["shopify"].calls["graphql bulkOperationRunQuery"] == 1
+    assert fakes["shopify"].calls["GET /admin/api/{version}/products.json"] == 0
+
+async def test_first_sync_of_a_small_catalog_pages(fakes):
+    shop = "first-sync-small.myshopify.com"
+    fakes["shopify"].calls.clear()
+    assert await catalog.incremental_sync(shop, "token") == 30
+    assert fakes["shopify"].calls["graphql bulkOperationRunQuery"] == 0
+    assert await catalog.get_product(shop, 30) is not None
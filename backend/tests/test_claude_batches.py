@@ -0,0 +1,65 @@
+import pytest
+import store
+import claude_batches
+import main
+from suggestions import suggestion_cache
+
+pytestmark = pytest.mark.anyio
+
+SHOP = "batches.myshopify.com"
+
+def product(i):
+    return {"id": i, "title": f"Product {i}", "body_html": "<p>Test</p>", "vendor": "Test", "product_type": "Test",
+            "variants": [{"id": i * 10, "title": "Default Title", "price": "9.99"}]}
+
+def items(products):
+    return [{"custom_id": f"product-{p['id']}", "product_id": p["id"], "cache_key": main.suggestion_key(p),
+             "params": main.suggestion_request(p, record=False)} for p in products]
+
+async def test_results_are_ingested_once_the_batch_ends(fakes, monkeypatch):
+    monkeypatch.setattr(fakes["anthropic"], "FAKE_BATCH_SECONDS", 3600)
+    monkeypatch.setattr(fakes["anthropic"], "FAKE_BATCH_ERRORS", {"product-3"})
+    submitted = items([product(i) for i in (1, 2, 3)])
+    job_id = await claude_batches.submit(SHOP, "generate", submitted, "test")
+
+    await claude_batches.poll_once("test")
+    job = await claude_batches.get_job(job_id, SHOP)
+    assert job["status"] == "in_progress"
+    assert {i["status"] for i in job["items"]} == {"pending"}
+
+    monkeypatch.setattr(fakes["anthropic"], "FAKE_BATCH_SECONDS", 0)
+    await claude_batches.poll_once("test")
+    job = await claude_batches.get_job(job_id, SHOP)
+    assert job["status"] == "ended"
+    assert job["request_counts"]["succeeded"] == 2
+    results = {i["custom_id"]: i for i in job["items"]}
+    assert results["product-1"]["status"] == "succeeded"
+    assert results["product-1"]["result"]["title"] == "Fake optimized title"
+    assert results["product-3"]["status"] == "errored"
+    assert results["product-3"]["result"] is None
+
+    # Succeeded results land in the suggestion cache for /api/generate
+    value, fresh = await suggestion_cache.lookup(submitted[0]["cache_key"])
+    assert fresh and value == results["product-1"]["result"]
+    value, _ = await suggestion_cache.lookup(submitted[2]["cache_key"])
+    assert value is None
+
+    # Collected jobs are not polled again
+    polled = fakes["anthropic"].calls["GET /v1/messages/batches/{id}/results"]
+    assert polled
+    await claude_batches.poll_once("test")
+    assert fakes["anthropic"].calls["GET /v1/messages/batches/{id}/results"] == polled
+
+async def test_batch_endpoint_skips_cached_products(client):
+    await store.save_shop(SHOP, "token")
+    r = await client.post("/api/claude-batches", json={"shop": SHOP, "product_ids": [4, 5]})
+    assert r.status_code == 200
+    assert r.json()["submitted"] == 2
+    await claude_batches.poll_once("test")
+
+    r = await client.post("/api/claude-batches", json={"shop": SHOP, "product_ids": [4, 5, 6]})
+    assert r.json()["submitted"] == 1
+    assert r.json()["cached"] == 2
+    r = await client.post("/api/generate", json={"shop": SHOP, "product_id": 4})
+    assert r.status_code == 200
+    assert r.headers["x-suggestion-cache"] == "hit"
@@ -0,0 +1,80 @@
+import pytest
+import store
+import orders
+import cooccurrence
+from fakes import orders as fake_orders
+
+pytestmark = pytest.mark.anyio
+
+PRODUCTS = 30
+
+def order(i, product_ids):
+    return {"id": i, "created_at": "2024-06-01T00:00:00Z", "cancelled_at": None,
+            "line_items": [{"product_id": p, "quantity": 1} for p in product_ids]}
+
+def baskets(n):
+    """n orders drawn like the fake's, as {order_id: [product_id, ...]}"""
+    return {i: list(fake_orders.basket(i, PRODUCTS)) for i in range(1, n + 1)}
+
+def counted(matrix):
+    """The matrix as plain dicts, independent of the order products were first seen in"""
+    products = matrix.products.tolist()
+    pairs = matrix.pairs.tocoo()
+    return (matrix.orders, dict(zip(products, matrix.counts.tolist())),
+            {(products[a], products[b]): n for a, b, n in zip(pairs.row.tolist(), pairs.col.tolist(), pairs.data.tolist())})
+
+async def build(shop):
+    return await store.run(cooccurrence._update, shop, None)
+
+async def test_planted_pairs_have_the_highest_lift(fakes):
+    shop = "cooc-planted.myshopify.com"
+    await orders.sync(shop, "token", bulk=False)
+    matrix = await cooccurrence.get_matrix(shop)
+    assert matrix.orders == 600 - 600 // 97
+    top = cooccurrence.top_pairs(matrix, 5)
+    assert len(top) == 5
+    for pair in top:
+        assert fake_orders.partner(pair["product_a_id"], PRODUCTS) == pair["product_b_id"]
+        assert pair["lift"] > 1
+    partners = cooccurrence.partners(matrix, 7, 3)
+    assert partners[0]["product_b_id"] == 8
+
+async def test_pruning_keeps_the_matrix_under_max_pairs(fakes, monkeypatch):
+    shop = "cooc-pruned.myshopify.com"
+    monkeypatch.setattr(cooccurrence, "COOC_MAX_PAIRS", 40)
+    prunes = cooccurrence.stats()["prunes"]
+    await orders.ingest(shop, [order(i, products) for i, products in baskets(600).items()])
+    matrix = await build(shop)
+    assert matrix.pairs.nnz <= 40
+    assert matrix.min_count > 1
+    assert matrix.pairs.data.min() >= matrix.min_count
+    assert cooccurrence.stats()["prunes"] > prunes
+    # Planted pairs are bought together most often, so they are what's left
+    for pair in cooccurrence.top_pairs(matrix, 5):
+        assert fake_orders.partner(pair["product_a_id"], PRODUCTS) == pair["product_b_id"]
+
+async def test_an_order_stored_in_two_parts_is_counted_once(fakes):
+    whole, split = "cooc-whole.myshopify.com", "cooc-split.myshopify.com"
+    first = baskets(200)
+    await orders.ingest(whole, [order(i, products) for i, products in first.items()]
+                        + [order(1000, [1, 2, 3, 4])])
+    # The rest of order 1000 arrives after the matrix counted its first lines
+    await orders.ingest(split, [order(i, products) for i, products in first.items()]
+                        + [order(1000, [1, 2])])
+    assert (await cooccurrence.get_matrix(split)).orders == 201
+    await orders.ingest(split, [order(1000, [1, 2, 3, 4])])
+    recounted = cooccurrence.stats()["recounted_orders"]
+    matrix = await cooccurrence.get_matrix(split)
+    assert cooccurrence.stats()["recounted_orders"] == recounted + 1
+    assert counted(matrix) == counted(await build(whole))
+    assert matrix.orders == 201
+
+async def test_chunked_build_matches_a_single_chunk(fakes, monkeypatch):
+    shop = "cooc-chunked.myshopify.com"
+    await orders.ingest(shop, [order(i, products) for i, products in baskets(300).items()])
+    # Order 5's late line is stored after every other order's
+    await orders.ingest(shop, [order(5, [29, 30])])
+    whole = counted(await build(shop))
+    monkeypatch.setattr(cooccurrence, "COOC_CHUNK_LINES", 7)
+    assert counted(await build(shop)) == whole
+    assert whole[0] == 300
@@ -0,0 +1,53 @@
+import time
+import pytest
+import store
+import jobs
+
+pytestmark = pytest.mark.anyio
+
+async def claim_all():
+    """IDs of every job claimable now, claimed by this process"""
+    claimed = []
+    while (row := await store.run(jobs._claim)) is not None:
+        claimed.append(row["id"])
+    return claimed
+
+async def lease(job_id, owner, seconds):
+    await store.execute("UPDATE jobs SET status = 'running', owner = ?, lease_until = ? WHERE id = ?",
+                        (owner, int(time.time() + seconds), job_id))
+
+async def test_idempotency_keys_are_scoped_to_the_job_kind(fakes):
+    shop = "jobs-keys.myshopify.com"
+    first = await jobs.enqueue(shop, "apply", {"n": 1}, "key-1")
+    assert await jobs.enqueue(shop, "apply", {"n": 2}, "key-1") == first
+    assert await jobs.enqueue(shop, "create_bundle", {"n": 3}, "key-1") != first
+
+async def test_a_job_another_process_is_running_is_left_alone(fakes):
+    job_id = await jobs.enqueue("jobs-live.myshopify.com", "apply", {})
+    await lease(job_id, "other-host:1:abc", 60)
+    assert job_id not in await claim_all()
+    row = await store.fetchone("SELECT status, owner, attempts FROM jobs WHERE id = ?", (job_id,))
+    assert (row["status"], row["owner"], row["attempts"]) == ("running", "other-host:1:abc", 0)
+
+async def test_a_job_whose_lease_expired_is_resumed(fakes):
+    job_id = await jobs.enqueue("jobs-dead.myshopify.com", "apply", {})
+    # Its process died a while ago
+    await lease(job_id, "other-host:2:def", -5)
+    assert job_id in await claim_all()
+    row = await store.fetchone("SELECT status, owner, lease_until, attempts FROM jobs WHERE id = ?", (job_id,))
+    assert (row["status"], row["owner"], row["attempts"]) == ("running", jobs.OWNER, 1)
+    assert row["lease_until"] >= time.time() + jobs.JOB_LEASE_SECONDS - 2
+    # Claimed once only
+    assert job_id not in await claim_all()
+
+async def test_leases_of_running_jobs_are_renewed(fakes):
+    mine = await jobs.enqueue("jobs-renew.myshopify.com", "apply", {})
+    theirs = await jobs.enqueue("jobs-renew.myshopify.com", "apply", {})
+    await lease(mine, jobs.OWNER, 1)
+    await lease(theirs, "other-host:3:123", 1)
+    await jobs.renew_leases()
+    rows = {r["id"]: r["lease_until"] for r in await store.fetchall(
+        "SELECT id, lease_until FROM jobs WHERE id IN (?, ?)", (mine, theirs))}
+    assert rows[mine] >= time.time() + jobs.JOB_LEASE_SECONDS - 2
+    assert rows[theirs] <= time.time() + 1
+    assert "owner" not in await jobs.get(mine)
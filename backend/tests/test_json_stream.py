@@ -0,0 +1,43 @@
+import json
+from json_stream import FieldStream
+
+REPLY = r'''```json
+{
+  "title": "Mug, \"Large\" {12oz}",
+  "description_html": "<p>Path C:\\mugs\\ and a \\\" quote, \u00e9t\u00e9 \ud83d\ude00</p>",
+  "tags": ["mug", "kitchen, home", "]"],
+  "seo": {"title": "Mug}", "nested": {"a": [1, {"b": "}"}]}},
+  "discount_percent": 15,
+  "empty": ""
+}
+```
+Anything after the object is ignored, even { "x": 1 }'''
+
+EXPECTED = list(json.loads(REPLY[REPLY.index("{"):REPLY.rindex("```")]).items())
+
+def stream(*chunks):
+    fields = FieldStream()
+    return [field for chunk in chunks for field in fields.feed(chunk)]
+
+def test_whole_reply():
+    assert stream(REPLY) == EXPECTED
+
+def test_one_character_at_a_time():
+    assert stream(*REPLY) == EXPECTED
+
+def test_split_anywhere():
+    # Inside strings, escapes, surrogate pairs and nested values alike
+    for split in range(1, len(REPLY)):
+        assert stream(REPLY[:split], REPLY[split:]) == EXPECTED, REPLY[:split]
+
+def test_members_are_handed_back_once_complete():
+    fields = FieldStream()
+    assert fields.feed('{"title": "A, b') == []
+    assert fields.feed('", "description_html": "long') == [("title", "A, b")]
+    assert fields.feed(' text"') == []
+    assert fields.feed('}') == [("description_html", "long text")]
+    # Nothing after the closing brace
+    assert fields.feed(', "more": 1}') == []
+
+def test_a_malformed_member_is_skipped():
+    assert stream('{"title": "ok", "price": 1.2.3, "tags": "a"}') == [("title", "ok"), ("tags", "a")]
@@ -0,0 +1,160 @@
+import asyncio
+import httpx
+import pytest
+import upstream
+import llm
+
+pytestmark = pytest.mark.anyio
+
+PAYLOAD = {"model": "claude-test", "max_tokens": 10, "messages": [{"role": "user", "content": "hi"}]}
+OK = {"content": [{"type": "text", "text": "hello"}], "model": "claude-test",
+      "usage": {"input_tokens": 3, "output_tokens": 1}}
+
+def failure(status):
+    # retry-after 0 keeps retries instant
+    return httpx.Response(status, headers={"retry-after": "0"}, json={"error": {"message": f"status {status}"}})
+
+@pytest.fixture
+def claude(fakes, monkeypatch):
+    """Queue responses (or exceptions to raise) for the Claude client; the requests sent are in .sent"""
+    monkeypatch.setattr(llm, "breaker", llm.CircuitBreaker(threshold=2, cooldown=0.05))
+
+    class Claude:
+        sent = []
+        answers = []
+
+        @staticmethod
+        async def handle(request):
+            Claude.sent.append(request)
+            answer = Claude.answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            if isinstance(answer, asyncio.Event):
+                await answer.wait()
+                return httpx.Response(200, json=OK)
+            return answer if isinstance(answer, httpx.Response) else httpx.Response(200, json=answer)
+
+    upstream._clients["claude"] = httpx.AsyncClient(transport=httpx.MockTransport(Claude.handle))
+    return Claude
+
+@pytest.mark.parametrize("status", [408, 409, 429, 500, 502, 503, 504, 529])
+async def test_transient_failures_are_retried(claude, status):
+    claude.answers += [failure(status), OK]
+    retries = llm.stats()["endpoints"].get("test", {}).get("retries", 0)
+    assert (await llm.messages(PAYLOAD, "test"))["content"][0]["text"] == "hello"
+    assert len(claude.sent) == 2
+    assert llm.stats()["endpoints"]["test"]["retries"] == retries + 1
+
+async def test_network_errors_are_retried(claude):
+    claude.answers += [httpx.ConnectError("refused"), OK]
+    assert (await llm.messages(PAYLOAD, "test"))["model"] == "claude-test"
+    assert len(claude.sent) == 2
+
+@pytest.mark.parametrize("status", [400, 401, 403, 404, 413])
+async def test_rejected_requests_are_not_retried(claude, status):
+    claude.answers += [failure(status)]
+    with pytest.raises(llm.LLMError) as e:
+        await llm.messages(PAYLOAD, "test")
+    assert e.value.status_code == status
+    assert len(claude.sent) == 1
+    # Anthropic answered: the breaker stays closed
+    assert llm.breaker.failures == 0
+
+async def test_retries_stop_after_max_retries(claude, monkeypatch):
+    monkeypatch.setattr(llm, "LLM_MAX_RETRIES", 2)
+    monkeypatch.setattr(llm, "breaker", llm.CircuitBreaker(threshold=100, cooldown=1))
+    claude.answers += [failure(503)] * 5
+    with pytest.raises(llm.LLMError) as e:
+        await llm.messages(PAYLOAD, "test")
+    assert e.value.status_code == 503
+    assert len(claude.sent) == 3
+
+async def test_no_retry_past_the_deadline(claude, monkeypatch):
+    monkeypatch.setitem(llm.DEADLINES, "test", 1)
+    claude.answers += [httpx.Response(529, headers={"retry-after": "5"}), OK]
+    with pytest.raises(llm.LLMError):
+        await llm.messages(PAYLOAD, "test")
+    assert len(claude.sent) == 1
+
+def test_backoff_honours_retry_after_and_is_capped(monkeypatch):
+    assert llm._backoff(0, httpx.Response(429, headers={"retry-after": "7"})) == 7
+    monkeypatch.setattr(llm, "LLM_BACKOFF_BASE", 1)
+    monkeypatch.setattr(llm, "LLM_BACKOFF_MAX", 4)
+    assert all(0 <= llm._backoff(attempt, httpx.Response(503)) <= 4 for attempt in range(10) for _ in range(20))
+    assert all(llm._backoff(0) <= 1 for _ in range(20))
+
+async def test_breaker_opens_probes_and_closes(claude, monkeypatch):
+    monkeypatch.setattr(llm, "LLM_MAX_RETRIES", 0)
+    breaker = llm.breaker
+    claude.answers += [failure(500), failure(500)]
+    for _ in range(2):
+        with pytest.raises(llm.LLMError):
+            await llm.messages(PAYLOAD, "test")
+    assert breaker.state == "open" and breaker.trips == 1
+
+    # Open: calls fail at once without reaching Anthropic
+    with pytest.raises(llm.LLMError) as e:
+        await llm.messages(PAYLOAD, "test")
+    assert e.value.http_status == 503
+    assert len(claude.sent) == 2 and breaker.rejected == 1
+
+    # After the cooldown one probe goes through; others are still rejected while it runs
+    await asyncio.sleep(0.06)
+    assert breaker.state == "half_open"
+    release = asyncio.Event()
+    claude.answers.append(release)
+    probe = asyncio.create_task(llm.messages(PAYLOAD, "test"))
+    while len(claude.sent) < 3:
+        await asyncio.sleep(0)
+    with pytest.raises(llm.LLMError):
+        await llm.messages(PAYLOAD, "test")
+    assert breaker.rejected == 2
+    release.set()
+    await probe
+    assert breaker.state == "closed" and breaker.failures == 0
+
+async def test_a_failed_probe_reopens_the_breaker(claude, monkeypatch):
+    monkeypatch.setattr(llm, "LLM_MAX_RETRIES", 0)
+    breaker = llm.breaker
+    claude.answers += [httpx.ConnectError("refused")] * 2
+    for _ in range(2):
+        with pytest.raises(llm.LLMError):
+            await llm.messages(PAYLOAD, "test")
+    await asyncio.sleep(0.06)
+    claude.answers.append(failure(503))
+    with pytest.raises(llm.LLMError):
+        await llm.messages(PAYLOAD, "test")
+    assert breaker.state == "open"
+    # Still the first trip, with a fresh cooldown
+    assert breaker.trips == 1
+    with pytest.raises(llm.LLMError) as e:
+        await llm.messages(PAYLOAD, "test")
+    assert e.value.http_status == 503 and len(claude.sent) == 3
+
+async def test_rate_limits_do_not_open_the_breaker(claude, monkeypatch):
+    monkeypatch.setattr(llm, "LLM_MAX_RETRIES", 0)
+    claude.answers += [failure(429)] * 3
+    for _ in range(3):
+        with pytest.raises(llm.LLMError):
+            await llm.messages(PAYLOAD, "test")
+    assert llm.breaker.state == "closed"
+
+@pytest.mark.parametrize("text", [
+    '{"title": "T", "tags": "a"}',
+    '```json\n{"title": "T", "tags": "a"}\n```',
+    '```\njson\n{"title": "T", "tags": "a"}```',
+    'Here you go:\n{"title": "T", "tags": "a"}\nHope that helps!',
+])
+def test_parse_json_tolerates_fences_and_prose(text):
+    assert llm.parse_json({"content": [{"text": text}]}, ("title",)) == {"title": "T", "tags": "a"}
+
+@pytest.mark.parametrize("response, error", [
+    ({"content": []}, "empty response"),
+    ({"content": [{"text": "  "}]}, "empty text"),
+    ({"content": [{"text": '{"title": "T",}'}]}, "invalid JSON at position"),
+    ({"content": [{"text": '{"tags": "a"}'}]}, "missing required fields: title"),
+])
+def test_parse_json_errors(response, error):
+    with pytest.raises(llm.LLMError) as e:
+        llm.parse_json(response, ("title",))
+    assert error in e.value.detail
@@ -0,0 +1,23 @@
+import httpx
+import pytest
+import upstream
+import shopify
+
+pytestmark = pytest.mark.anyio
+
+def answers(*responses):
+    """Shopify client giving these responses in turn"""
+    responses = iter(responses)
+    return httpx.AsyncClient(transport=httpx.MockTransport(lambda request: next(responses)))
+
+async def test_graphql_429s_give_their_points_back(fakes):
+    shop = "graphql-429.myshopify.com"
+    upstream._clients["shopify"] = answers(
+        httpx.Response(429, headers={"retry-after": "0"}), httpx.Response(429, headers={"retry-after": "0"}),
+        httpx.Response(200, json={"data": {"ok": True}, "extensions": {"cost": {"actualQueryCost": 5}}}))
+    b = shopify.bucket(shop)
+    b.restore_rate = 1e-6  # no refill while the test runs
+    assert await shopify.graphql(shop, "token", "{ ok }", cost=100) == {"ok": True}
+    assert b.graphql_throttled == 2
+    # Only the query that ran is paid for
+    assert b.points == pytest.approx(b.max_points - 5, abs=0.01)
@@ -0,0 +1,93 @@
+import asyncio
+import pytest
+from singleflight import SingleFlight
+
+pytestmark = pytest.mark.anyio
+
+class Upstream:
+    """fn for SingleFlight.do that waits until released, counting starts and cancellations"""
+    def __init__(self):
+        self.started = 0
+        self.cancelled = 0
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.started += 1
+        try:
+            await self.release.wait()
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        return f"result {self.started}"
+
+async def settle():
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+async def test_concurrent_callers_share_one_call():
+    flight, upstream = SingleFlight("test_share"), Upstream()
+    callers = [asyncio.create_task(flight.do("k", upstream)) for _ in range(5)]
+    await settle()
+    upstream.release.set()
+    assert await asyncio.gather(*callers) == ["result 1"] * 5
+    assert upstream.started == 1
+    assert flight.stats() == {"calls": 1, "coalesced": 4, "abandoned": 0, "in_flight": 0}
+    # Finished calls are not reused
+    assert await flight.do("k", upstream) == "result 2"
+
+async def test_a_cancelled_caller_leaves_the_call_to_the_others():
+    flight, upstream = SingleFlight("test_shield"), Upstream()
+    first = asyncio.create_task(flight.do("k", upstream))
+    second = asyncio.create_task(flight.do("k", upstream))
+    await settle()
+    first.cancel()
+    await settle()
+    assert first.cancelled()
+    assert upstream.cancelled == 0
+    upstream.release.set()
+    assert await second == "result 1"
+    assert flight.stats()["abandoned"] == 0
+
+async def test_the_call_is_cancelled_once_the_last_caller_leaves():
+    flight, upstream = SingleFlight("test_abandon"), Upstream()
+    callers = [asyncio.create_task(flight.do("k", upstream)) for _ in range(2)]
+    await settle()
+    callers[0].cancel()
+    await settle()
+    assert upstream.cancelled == 0
+    callers[1].cancel()
+    await settle()
+    assert upstream.cancelled == 1
+    assert flight.stats() == {"calls": 1, "coalesced": 1, "abandoned": 1, "in_flight": 0}
+    # A later caller starts afresh rather than joining the cancelled call
+    later = asyncio.create_task(flight.do("k", upstream))
+    await settle()
+    upstream.release.set()
+    assert await later == "result 2"
+
+async def test_errors_reach_every_caller_and_are_not_cached():
+    flight = SingleFlight("test_errors")
+    started = 0
+
+    async def failing():
+        nonlocal started
+        started += 1
+        await asyncio.sleep(0)
+        raise ValueError("upstream down")
+
+    results = await asyncio.gather(*(flight.do("k", failing) for _ in range(3)), return_exceptions=True)
+    assert [type(r) for r in results] == [ValueError] * 3
+    assert started == 1
+    with pytest.raises(ValueError):
+        await flight.do("k", failing)
+    assert started == 2
+
+async def test_keys_do_not_share_calls():
+    flight = SingleFlight("test_keys")
+
+    async def echo(value):
+        await asyncio.sleep(0)
+        return value
+
+    assert await asyncio.gather(flight.do("a", lambda: echo("a")), flight.do("b", lambda: echo("b"))) == ["a", "b"]
+    assert flight.stats()["coalesced"] == 0
@@ -0,0 +1,43 @@
+import pytest
+import store
+import themes
+
+pytestmark = pytest.mark.anyio
+
+SHOP = "themes.myshopify.com"
+SNIPPET = "ai-announcement-bar.liquid"
+
+def upstream_calls(fake):
+    return sum(n for route, n in fake.calls.items() if route.startswith(("GET", "POST", "PUT", "DELETE")))
+
+async def publish_and_inject(client, run_job):
+    r = await client.post("/api/publish-announcement", json={"shop": SHOP, "filename": SNIPPET, "content": "<div/>"})
+    assert r.status_code == 200
+    r = await client.post("/api/inject-announcement", json={"shop": SHOP, "filename": SNIPPET})
+    job = await run_job(r.json()["job_id"])
+    assert job["status"] == "succeeded"
+    return job["result"]
+
+async def test_warm_publish_and_inject_is_two_calls(client, fakes, run_job):
+    fake = fakes["shopify"]
+    await store.save_shop(SHOP, "token")
+    await themes.forget(SHOP)
+    assert await publish_and_inject(client, run_job) == {"ok": True}
+    assert "{% render 'ai-announcement-bar' %}" in fake.assets[(SHOP, "layout/theme.liquid")]
+
+    fake.calls.clear()
+    assert await publish_and_inject(client, run_job) == {"ok": True, "message": "Already injected"}
+    # The snippet PUT and one GET of the cached layout key
+    assert upstream_calls(fake) == 2
+
+async def test_inject_looks_the_layout_up_again_when_the_cached_theme_is_gone(client, fakes, run_job):
+    fake = fakes["shopify"]
+    await store.save_shop(SHOP, "token")
+    await publish_and_inject(client, run_job)
+    # The theme was switched without a webhook reaching us
+    theme = await themes.theme_cache.aget(SHOP)
+    await themes.theme_cache.aset(SHOP, {**theme, "theme_id": fake.THEME_ID + 1})
+    r = await client.post("/api/inject-announcement", json={"shop": SHOP, "filename": SNIPPET})
+    job = await run_job(r.json()["job_id"])
+    assert job["status"] == "succeeded"
+    assert (await themes.theme_cache.aget(SHOP))["theme_id"] == fake.THEME_ID
@@ -0,0 +1,112 @@
+import os, asyncio
+import shopify
+from cache import TTLCache
+from singleflight import SingleFlight
+from shopify import admin_url
+
+# Per-shop cache of the theme metadata that publishing and injecting the
+# announcement bar need: the Admin API version that still allows asset writes,
+# the main theme's ID and its layout file key. Discovering them takes up to ten
+# calls; once cached, a publish is one PUT and an inject one GET of the layout
+# right before editing it (plus the PUT, unless it is already injected).
+# Entries are dropped on a themes/publish webhook, or when Shopify answers 404
+# for a cached theme or key.
+
+# Older versions are more permissive about asset modifications; the first that works wins
+API_VERSIONS = ["2022-10", "2023-01"]
+LAYOUT_CANDIDATES = ["layout/theme.liquid", "layout/theme", "templates/theme.liquid", "templates/theme",
+                     "theme.liquid", "theme"]
+LAYOUT_KEYS = ["layout/theme.liquid", "layout/theme", "templates/theme.liquid", "templates/theme"]
+
+THEME_CACHE_SIZE = int(os.getenv("THEME_CACHE_SIZE", "10000"))
+THEME_CACHE_TTL = float(os.getenv("THEME_CACHE_TTL", "86400"))
+
+theme_cache = TTLCache("themes", THEME_CACHE_SIZE, THEME_CACHE_TTL)
+# Concurrent misses for one shop share a single discovery
+discovery = SingleFlight("theme_discovery")
+
+class ThemeError(Exception):
+    pass
+
+def assets_url(shop: str, theme: dict) -> str:
+    return admin_url(shop, f"themes/{theme['theme_id']}/assets.json", theme["api_version"])
+
+async def _discover_theme(shop: str, token: str):
+    responses = await asyncio.gather(*(
+        shopify.request(shop, "GET", admin_url(shop, "themes.json", v), token) for v in API_VERSIONS))
+    working = next(((v, r) for v, r in zip(API_VERSIONS, responses) if r.status_code == 200), None)
+    if working is None:
+        raise ThemeError(f"Failed to fetch themes with any API version. Tried: {', '.join(API_VERSIONS)}")
+    api_version, r = working
+    main = next((t for t in r.json()["themes"] if t["role"] == "main"), None)
+    if not main:
+        raise ThemeError("Main theme not found")
+    theme = {"api_version": api_version, "theme_id": main["id"]}
+    await theme_cache.aset(shop, theme)
+    return theme
+
+async def main_theme(shop: str, token: str):
+    """({"api_version", "theme_id"}, cached) for the shop's published theme"""
+    theme = await theme_cache.aget(shop)
+    if theme is not None:
+        return theme, True
+    return await discovery.do(shop, lambda: _discover_theme(shop, token)), False
+
+async def _get_asset(shop: str, token: str, theme: dict, key: str):
+    return await shopify.request(shop, "GET", assets_url(shop, theme), token, params={"asset[key]": key})
+
+async def _discover_layout(shop: str, token: str, theme: dict):
+    responses = await asyncio.gather(*(_get_asset(shop, token, theme, c) for c in LAYOUT_CANDIDATES))
+    for candidate, r in zip(LAYOUT_CANDIDATES, responses):
+        asset = r.json().get("asset") if r.status_code == 200 else None
+        if asset and (asset.get("key") == candidate or asset.get("key", "").endswith(("/theme.liquid", "/theme"))):
+            return asset["key"], asset["value"]
+    # Not at any usual key: look for it in the full asset listing
+    listing = await shopify.request(shop, "GET", assets_url(shop, theme), token)
+    if listing.status_code == 200:
+        key = next((a["key"] for a in listing.json().get("assets", []) if a.get("key") in LAYOUT_KEYS), None)
+        if key:
+            r = await _get_asset(shop, token, theme, key)
+            if r.status_code == 200:
+                return key, r.json()["asset"]["value"]
+    if listing.status_code == 404:
+        return None, None
+    raise ThemeError("Could not find theme layout file. Please ensure your theme has a layout/theme.liquid file.")
+
+async def layout(shop: str, token: str):
+    """{"api_version", "theme_id", "key"} of the main theme's layout file, plus its
+    "content" when it had to be looked up. A cached key is returned without a call:
+    read it with asset_value, and forget the shop if that finds it gone."""
+    theme, _ = await main_theme(shop, token)
+    if theme.get("layout_key"):
+        return {**theme, "key": theme["layout_key"]}
+    key, content = await _discover_layout(shop, token, theme)
+    if key:
+        await theme_cache.aset(shop, {**theme, "layout_key": key})
+        return {**theme, "key": key, "content": content}
+    await forget(shop)
+    raise ThemeError("Could not find theme layout file. Please ensure your theme has a layout/theme.liquid file.")
+
+async def asset_value(shop: str, token: str, theme: dict, key: str):
+    """Current value of an asset of theme, or None if the theme or key is gone"""
+    r = await _get_asset(shop, token, theme, key)
+    if r.status_code == 404:
+        return None
+    if r.status_code != 200:
+        raise shopify.ShopifyError(r.status_code, r.text)
+    return r.json()["asset"]["value"]
+
+async def put_asset(shop: str, token: str, key: str, value: str):
+    """(response, theme) of writing an asset into the main theme"""
+    for _ in range(2):
+        theme, cached = await main_theme(shop, token)
+        r = await shopify.request(shop, "PUT", assets_url(shop, theme), token,
+                                  json={"asset": {"key": key, "value": value}})
+        if r.status_code != 404 or not cached:
+            return r, theme
+        # Cached theme may be gone; rediscover once before giving up
+        await forget(shop)
+    return r, theme
+
+async def forget(shop: str):
+    await theme_cache.adelete(shop)
@@ -0,0 +1,76 @@
+import os
+import httpx
+import metrics
+import logs
+
+# Shared connection pools for upstream APIs.
+# One client per upstream so Shopify and Anthropic traffic get separate pools,
+# limits and timeouts, and connections are kept alive between requests.
+
+HTTP2 = os.getenv("UPSTREAM_HTTP2", "true").lower() in ("1", "true", "yes")
+
+# Point at a local stand-in (see fakes/) for offline testing
+ANTHROPIC_BASE_URL = os.getenv("ANTHROPIC_BASE_URL", "https://api.anthropic.com").rstrip("/")
+# Unset in production: each shop is served from https://{shop}
+SHOPIFY_BASE_URL = os.getenv("SHOPIFY_BASE_URL", "").rstrip("/")
+
+SHOPIFY_MAX_CONNECTIONS = int(os.getenv("SHOPIFY_MAX_CONNECTIONS", "50"))
+SHOPIFY_MAX_KEEPALIVE = int(os.getenv("SHOPIFY_MAX_KEEPALIVE", "20"))
+SHOPIFY_KEEPALIVE_EXPIRY = float(os.getenv("SHOPIFY_KEEPALIVE_EXPIRY", "30"))
+SHOPIFY_TIMEOUT = float(os.getenv("SHOPIFY_TIMEOUT", "30"))
+
+CLAUDE_MAX_CONNECTIONS = int(os.getenv("CLAUDE_MAX_CONNECTIONS", "20"))
+CLAUDE_MAX_KEEPALIVE = int(os.getenv("CLAUDE_MAX_KEEPALIVE", "10"))
+CLAUDE_KEEPALIVE_EXPIRY = float(os.getenv("CLAUDE_KEEPALIVE_EXPIRY", "60"))
+CLAUDE_TIMEOUT = float(os.getenv("CLAUDE_TIMEOUT", "60"))
+
+_clients = {}
+
+def _build(name, max_connections, max_keepalive, keepalive_expiry, timeout):
+    transport = httpx.AsyncHTTPTransport(
+        http2=HTTP2,
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        ),
+    )
+    return httpx.AsyncClient(
+        # Every call is timed for /metrics and the Server-Timing header
+        transport=metrics.InstrumentedTransport(transport, name),
+        timeout=httpx.Timeout(timeout, connect=min(timeout, 10.0)),
+        # Upstream calls carry the ID of the request or job that made them
+        event_hooks={"request": [logs.tag_outbound]},
+    )
+
+def shopify_client() -> httpx.AsyncClient:
+    """Pooled client for all {shop}.myshopify.com calls"""
+    client = _clients.get("shopify")
+    if client is None or client.is_closed:
+        client = _clients["shopify"] = _build(
+            "shopify", SHOPIFY_MAX_CONNECTIONS, SHOPIFY_MAX_KEEPALIVE, SHOPIFY_KEEPALIVE_EXPIRY, SHOPIFY_TIMEOUT)
+    return client
+
+def claude_client() -> httpx.AsyncClient:
+    """Pooled client for api.anthropic.com calls"""
+    client = _clients.get("claude")
+    if client is None or client.is_closed:
+        client = _clients["claude"] = _build(
+            "claude", CLAUDE_MAX_CONNECTIONS, CLAUDE_MAX_KEEPALIVE, CLAUDE_KEEPALIVE_EXPIRY, CLAUDE_TIMEOUT)
+    return client
+
+def claude_url(path: str) -> str:
+    return f"{ANTHROPIC_BASE_URL}{path}"
+
+def shopify_url(shop: str, path: str) -> str:
+    return f"{SHOPIFY_BASE_URL or 'https://' + shop}{path}"
+
+def open_clients():
+    shopify_client()
+    claude_client()
+
+async def close_clients():
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
@@ -0,0 +1,87 @@
+import time, asyncio, logging
+import store
+import shopify
+from shopify import admin_url
+
+# Shopify webhook bookkeeping: subscription on install, receipt deduplication
+# and a per-shop "last changed" record so other layers can check freshness
+# locally instead of asking Shopify.
+
+TOPICS = ["products/create", "products/update", "products/delete", "themes/publish", "app/uninstalled"]
+# Subscribed and tracked on their own: order topics need protected customer
+# data access, and a shop without it should still get product webhooks
+ORDER_TOPICS = ["orders/create"]
+
+# Change marker recording that each group of topics was subscribed
+GROUPS = {"webhooks": TOPICS, "order_webhooks": ORDER_TOPICS}
+
+# Resource each topic invalidates
+RESOURCES = {
+    "products/create": "products",
+    "products/update": "products",
+    "products/delete": "products",
+    "themes/publish": "themes",
+}
+
+_last_changed = {}
+
+log = logging.getLogger(__name__)
+
+async def register(shop: str, token: str, app_url: str):
+    """Subscribe the shop to every topic in TOPICS and ORDER_TOPICS. Existing
+    subscriptions are left alone."""
+    if not app_url:
+        log.warning("Skipping webhook registration: APP_URL is not set")
+        return
+    address = f"{app_url}/webhooks"
+
+    async def subscribe(topic):
+        r = await shopify.request(shop, "POST", admin_url(shop, "webhooks.json"), token, shopify.BULK,
+                                  json={"webhook": {"topic": topic, "address": address, "format": "json"}})
+        # 422 means this address is already subscribed to the topic
+        if r.status_code not in (200, 201, 422):
+            log.warning("Webhook registration failed", extra={"shop": shop, "topic": topic,
+                                                              "status": r.status_code, "body": r.text[:1000]})
+            return False
+        return True
+
+    topics = TOPICS + ORDER_TOPICS
+    results = dict(zip(topics, await asyncio.gather(*(subscribe(t) for t in topics), return_exceptions=True)))
+    for group, members in GROUPS.items():
+        if all(results[t] is True for t in members):
+            await mark_changed(shop, group)
+
+async def record_receipt(webhook_id: str, shop: str, topic: str) -> bool:
+    """Remember a delivery; False if this webhook ID was already received"""
+    inserted = await store.execute(
+        "INSERT OR IGNORE INTO webhook_events(webhook_id, shop, topic, received_at) VALUES(?,?,?,?)",
+        (webhook_id, shop, topic, int(time.time())))
+    return inserted > 0
+
+async def mark_changed(shop: str, resource: str, at: float = None):
+    at = int(at if at is not None else time.time())
+    _last_changed[(shop, resource)] = at
+    await store.execute("INSERT OR REPLACE INTO shop_changes(shop, resource, changed_at) VALUES(?,?,?)",
+                        (shop, resource, at))
+
+async def last_changed(shop: str, resource: str):
+    """Unix time of the last webhook-reported change to resource, or None"""
+    key = (shop, resource)
+    if key not in _last_changed:
+        row = await store.fetchone("SELECT changed_at FROM shop_changes WHERE shop = ? AND resource = ?", key)
+        _last_changed[key] = row["changed_at"] if row else None
+    return _last_changed[key]
+
+async def registered(shop: str, group: str = "webhooks") -> bool:
+    """True once every topic in the group (TOPICS by default, or "order_webhooks"
+    for ORDER_TOPICS) was subscribed for this shop"""
+    return await last_changed(shop, group) is not None
+
+async def forget(shop: str):
+    for key in [k for k in _last_changed if k[0] == shop]:
+        del _last_changed[key]
+    await store.execute("DELETE FROM shop_changes WHERE shop = ?", (shop,))
+
+async def prune(max_age_seconds: int = 7 * 24 * 3600):
+    """Drop delivery IDs older than Shopify's retry window"""
+    await store.execute("DELETE FROM webhook_events WHERE received_at < ?", (int(time.time()) - max_age_seconds,))
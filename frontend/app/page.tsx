@@ -180,22 +180,60 @@ export default function Home() {
     }
     setLoading(true);
     try {
-      const r = await fetch(`${base}/api/generate`, {
+      // Server-sent events: product, then one field event per completed field, then done
+      const r = await fetch(`${base}/api/generate/stream`, {
         method: "POST",
         headers: {"Content-Type":"application/json"},
         body: JSON.stringify({ shop, product_id: productId })
       });
-      if (!r.ok) throw new Error("Generation failed");
-      const j = await r.json();
-      setSuggestion(j.suggestion);
-      streamMessage(`I've generated optimized launch assets for "${j.product.title}"! Here's what I created:\n\n📝 Title: ${j.suggestion.title}\n\n📄 Description: ${j.suggestion.description_html.replace(/<[^>]*>/g, "").substring(0, 200)}...\n\n🏷️ Tags: ${j.suggestion.tags}\n\n💰 Discount: ${j.suggestion.discount_code} (${j.suggestion.discount_percent}% off)\n\nWould you like me to apply these changes to your store?`);
+      if (!r.ok || !r.body) throw new Error("Generation failed");
+      const reader = r.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = "";
+      let product: any = null;
+      let result: any = null;
+      const partial: any = {};
+      while (!result) {
+        const { done, value } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        const events = buffer.split("\n\n");
+        buffer = events.pop() || "";
+        for (const raw of events) {
+          const event = raw.match(/^event: (.*)$/m)?.[1];
+          const data = JSON.parse(raw.match(/^data: (.*)$/m)?.[1] || "null");
+          if (event === "product") product = data;
+          else if (event === "field") {
+            partial[data.name] = data.value;
+            if (partial.title) setStreamingMessage(`Generating launch assets for "${product?.title}"...\n\n📝 Title: ${partial.title}${partial.tags ? `\n\n🏷️ Tags: ${partial.tags}` : ""}`);
+          }
+          else if (event === "error") throw new Error(data.detail);
+          else if (event === "done") result = data;
+        }
+      }
+      if (!result) throw new Error("Generation failed");
+      setSuggestion(result);
+      streamMessage(`I've generated optimized launch assets for "${product?.title}"! Here's what I created:\n\n📝 Title: ${result.title}\n\n📄 Description: ${result.description_html.replace(/<[^>]*>/g, "").substring(0, 200)}...\n\n🏷️ Tags: ${result.tags}\n\n💰 Discount: ${result.discount_code} (${result.discount_percent}% off)\n\nWould you like me to apply these changes to your store?`);
     } catch (e: any) {
+      setStreamingMessage("");
       streamMessage("Failed to generate: " + e.message);
     } finally {
       setLoading(false);
     }
   };
 
+  // Store writes run as background jobs; poll until the job finishes
+  const waitForJob = async (jobId: number) => {
+    while (true) {
+      const r = await fetch(`${base}/api/jobs/${jobId}?shop=${encodeURIComponent(shop)}`);
+      if (!r.ok) throw new Error(`Could not check job status (${r.status})`);
+      const job = await r.json();
+      if (job.status === "succeeded") return job.result;
+      if (job.status === "failed") throw new Error(job.error || "Job failed");
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+    }
+  };
+
   const apply = async () => {
     if (!connected || !shop) {
       streamMessage("Please connect your Shopify store first to use this feature.");
@@ -206,10 +244,11 @@ export default function Home() {
     try {
       const r = await fetch(`${base}/api/apply`, {
         method: "POST",
-        headers: {"Content-Type":"application/json"},
+        headers: {"Content-Type":"application/json", "Idempotency-Key": crypto.randomUUID()},
         body: JSON.stringify({ shop, product_id: selected, suggestion })
       });
       if (!r.ok) throw new Error("Apply failed");
+      await waitForJob((await r.json()).job_id);
       streamMessage("✅ Successfully applied all changes to your store! Check your Shopify admin to see the updates.");
       setSuggestion(null);
     } catch (e: any) {
@@ -266,7 +305,7 @@ export default function Home() {
     try {
       const r = await fetch(`${base}/api/create-bundle`, {
         method: "POST",
-        headers: {"Content-Type":"application/json"},
+        headers: {"Content-Type":"application/json", "Idempotency-Key": crypto.randomUUID()},
         body: JSON.stringify({
           shop,
           product_a: bundleData.product_a,
@@ -280,6 +319,7 @@ export default function Home() {
         streamMessage(`❌ Failed to create bundle: ${errorMsg}`);
         return;
       }
+      await waitForJob((await r.json()).job_id);
       streamMessage("✅ Bundle created successfully in your store! You can view it in your Shopify admin.");
       setBundle(null);
       setProdA(null);